@@ -0,0 +1,44 @@
+import csv
+import logging
+import os
+from typing import Iterable
+
+# A CSV file with iata, icao and name columns. The bundled table covers the major airlines and can be replaced
+# with a fuller one
+AIRLINE_CODES_PATH = os.environ.get(
+    "AIRLINE_CODES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "airline_codes.csv")
+)
+
+
+class AirlineCodeIndex:
+    """
+    The IATA and ICAO codes of known airlines, used to tell flight numbers from other numbers without a network request.
+    """
+
+    def __init__(self, rows: Iterable[dict]):
+        iata_codes = set()
+        icao_codes = set()
+        for row in rows:
+            if row.get("iata"):
+                iata_codes.add(row["iata"].strip().upper())
+            if row.get("icao"):
+                icao_codes.add(row["icao"].strip().upper())
+        self.iata_codes = frozenset(iata_codes)
+        self.icao_codes = frozenset(icao_codes)
+
+    @classmethod
+    def load(cls, path: str) -> "AirlineCodeIndex":
+        with open(path, newline="", encoding="utf-8") as f:
+            index = cls(csv.DictReader(f))
+        logging.info(f"Loaded {len(index.iata_codes)} IATA and {len(index.icao_codes)} ICAO airline codes from {path}")
+        return index
+
+    def is_airline_code(self, code: str) -> bool:
+        """
+        :param code: A two-character IATA or three-letter ICAO code, in any case.
+        """
+        code = code.upper()
+        return code in (self.iata_codes if len(code) == 2 else self.icao_codes)
+
+
+airline_codes = AirlineCodeIndex.load(AIRLINE_CODES_PATH)
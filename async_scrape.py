@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Coroutine, Hashable, MutableMapping, Optional
+
+import httpx
+
+from http_transport import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_RETRIES, RETRY_STATUS_CODES, retry_after, \
+    retry_delay
+from scrape_flightaware import OMNISEARCH_URL, extract_trackpoll_bootstrap, flight_data_from_bootstrap, \
+    flight_page_url, flightaware_errors, flightaware_governor, flightaware_request, headers, omnisearch_params, \
+    parse_omnisearch, skip_ident_lookup
+
+
+class AsyncScrapeEngine:
+    """
+    Scrapes FlightAware with coroutines on an event loop in a background thread, so a single process can wait on
+    many fetches at once. Pages are parsed, and the shared SQLite caches queried, in small thread pools to keep the
+    loop responsive.
+    """
+
+    def __init__(self, concurrency: int, parse_workers: int, cache_workers: int = 4):
+        """
+        :param concurrency: The number of requests to FlightAware in flight at the same time.
+        :param parse_workers: The number of threads parsing pages.
+        :param cache_workers: The number of threads running blocking cache calls.
+        """
+        self.concurrency = concurrency
+        self.parse_executor = ThreadPoolExecutor(max_workers=parse_workers, thread_name_prefix="parse")
+        self.cache_executor = ThreadPoolExecutor(max_workers=cache_workers, thread_name_prefix="scrape-cache")
+        self.loop = asyncio.new_event_loop()
+        self.client: Optional[httpx.AsyncClient] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight: dict[Hashable, asyncio.Future] = {}  # Key: the result of the coroutine running for it
+        self.waiters: dict[asyncio.Future, int] = {}  # Coroutine result: number of callers waiting for it
+        self.counters = {"requests": 0, "coalesced": 0, "parsed_pages": 0}
+
+    def start(self):
+        threading.Thread(target=self.loop.run_forever, daemon=True, name="async-scrape").start()
+        asyncio.run_coroutine_threadsafe(self.open(), self.loop).result()
+
+    async def open(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.client = httpx.AsyncClient(
+            headers={**headers, "Accept-Encoding": "gzip, deflate"},
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        )
+
+    def submit(self, coroutine: Coroutine) -> Future:
+        """
+        Runs a coroutine on the engine's loop. Can be called from any thread.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def run_blocking(self, function: Callable, *args) -> Any:
+        """
+        Runs a blocking call, such as a query of a SQLite-backed cache, without holding up the loop.
+        """
+        return await self.loop.run_in_executor(self.cache_executor, function, *args)
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        """
+        Sends a GET request, retrying connection errors, timeouts and retryable status codes like http_transport.get.
+        Requests share the FlightAware rate governor with the rest of the process.
+        """
+        attempt = 0
+        while True:
+            try:
+                await asyncio.sleep(flightaware_governor.reserve())
+            except asyncio.CancelledError:
+                flightaware_governor.cancel()  # Its turn can go to another request
+                raise
+            async with self.semaphore:
+                self.counters["requests"] += 1
+                try:
+                    response = await self.client.get(url, **kwargs)
+                except httpx.TransportError as e:  # Includes timeouts
+                    if attempt >= HTTP_RETRIES:
+                        raise
+                    delay = retry_delay(attempt)
+                    logging.warning(f"Request to {url} failed ({e}), retrying in {delay:.1f}s")
+                else:
+                    flightaware_governor.record(response.status_code, retry_after(response))
+                    if response.status_code not in RETRY_STATUS_CODES or attempt >= HTTP_RETRIES:
+                        return response
+                    delay = retry_delay(attempt, response)
+                    logging.warning(f"Request to {url} returned {response.status_code}, retrying in {delay:.1f}s")
+            attempt += 1
+            await asyncio.sleep(delay)  # Without holding a slot
+
+    async def single_flight(self, key: Hashable, function: Callable[..., Awaitable[Any]], *args) -> Any:
+        """
+        Runs the coroutine function for a key, or waits for the one that is already running for it.
+        """
+        pending = self.in_flight.get(key)
+        if pending:
+            self.counters["coalesced"] += 1
+        else:
+            pending = self.in_flight[key] = asyncio.ensure_future(function(*args))
+            pending.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        self.waiters[pending] = self.waiters.get(pending, 0) + 1
+        try:
+            # Shielded, so a caller that is cancelled does not cancel a fetch other callers are waiting for
+            return await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if self.waiters[pending] == 1:
+                pending.cancel()  # Nobody else needs the result
+            raise
+        finally:
+            self.waiters[pending] -= 1
+            if not self.waiters[pending]:
+                del self.waiters[pending]
+
+    async def get_flight_ident(self, flight_number: str, unknown: MutableMapping) -> Optional[str]:
+        """
+        :param unknown: The negative cache of flight numbers omnisearch found no flight for.
+        """
+        if await self.run_blocking(skip_ident_lookup, flight_number, unknown):
+            return None
+        with flightaware_request("ident"):
+            response = await self.get(OMNISEARCH_URL, params=omnisearch_params(flight_number))
+            if response.status_code != 200:
+                flightaware_errors.inc(kind="ident", type=f"http_{response.status_code}")
+                logging.error(f"Failed to fetch ident from omnisearch for {flight_number}: {response.status_code}")
+                return None
+            ident = parse_omnisearch(flight_number, response.json())
+        if not ident:
+            await self.run_blocking(unknown.__setitem__, flight_number, True)
+        return ident
+
+    async def get_flight_data(self, ident: str) -> Optional[dict]:
+        url = flight_page_url(ident)
+        with flightaware_request("flight_page"):
+            response = await self.get(url)
+            if response.status_code == 200:
+                bootstrap = await self.loop.run_in_executor(
+                    self.parse_executor, extract_trackpoll_bootstrap, [response.content]
+                )
+                self.counters["parsed_pages"] += 1
+                if bootstrap:
+                    return flight_data_from_bootstrap(ident, url, bootstrap)
+                flightaware_errors.inc(kind="flight_page", type="no_bootstrap")
+            else:
+                flightaware_errors.inc(kind="flight_page", type=f"http_{response.status_code}")
+        logging.error(f"Failed to fetch flight data from FlightAware: {response.status_code}")
+        return None
+
+    def stats(self) -> dict:
+        return {**self.counters, "in_flight": len(self.in_flight)}
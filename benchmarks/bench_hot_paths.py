@@ -0,0 +1,179 @@
+"""
+Measures the parsing and formatting hot paths of the bot and the scraping API: flight page extraction, omnisearch
+parsing, canvas parsing, configuration lookup, flight number extraction and flight info formatting.
+
+Each case reports the time per call and the peak memory allocated during one call. Results can be saved as baselines
+and later runs compared against them, failing when a case got slower or allocates more than the tolerance allows.
+
+Usage: python benchmarks/bench_hot_paths.py [--save] [--tolerance 0.25] [--baselines path] [filter ...]
+Without --save, the run is compared with the baselines if they exist, and exits with status 1 on a regression.
+Baselines depend on the machine, so save them on the machine the comparison runs on.
+
+Pages saved from FlightAware (recorded/flightaware_*.html), omnisearch responses (recorded/omnisearch_*.json) and
+canvases exported from Slack (recorded/canvas_*.html) are added as cases next to the synthetic fixtures.
+"""
+import argparse
+import sys
+import time
+import timeit
+import tracemalloc
+from json import dumps, loads
+from pathlib import Path
+from typing import Callable
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.fixtures import canvas_config, canvas_html, canvas_line_texts, flightaware_page, \
+    omnisearch_response, trackpoll_bootstrap
+from canvas_editor import clean_canvas
+from find_json import find_json
+from flight_number_extraction import extract_flight_numbers
+from info_message_format import combine_flight_info_messages, format_flight_info_message
+from parse_canvas import parse_canvas
+from scrape_flightaware import PAGE_CHUNK_SIZE, extract_trackpoll_bootstrap, flight_data_from_bootstrap, \
+    parse_omnisearch
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+RECORDED_DIR = BENCHMARKS_DIR / "recorded"
+DEFAULT_BASELINES = BENCHMARKS_DIR / "baselines.json"
+REPEAT = 5  # Timing runs per case, the fastest is reported
+MIN_RUN_TIME = 0.2  # Seconds each timing run takes at least
+
+
+def flight_page_case(page: bytes) -> Callable[[], object]:
+    """
+    The work get_flight_data does once the page arrives: streaming extraction and building the flight information.
+    """
+    def run():
+        chunks = (page[i:i + PAGE_CHUNK_SIZE] for i in range(0, len(page), PAGE_CHUNK_SIZE))
+        return flight_data_from_bootstrap("UAL123", "https://www.flightaware.com/live/flight/UAL123",
+                                          extract_trackpoll_bootstrap(chunks))
+    return run
+
+
+def omnisearch_case(body: bytes) -> Callable[[], object]:
+    return lambda: parse_omnisearch("UAL123", loads(body))
+
+
+def canvas_case(content: str) -> Callable[[], object]:
+    return lambda: parse_canvas(clean_canvas(content))
+
+
+def find_json_case(text: str) -> Callable[[], object]:
+    return lambda: find_json(text)
+
+
+def extraction_case(texts: list[str]) -> Callable[[], object]:
+    return lambda: [extract_flight_numbers(text) for text in texts]
+
+
+def formatting_case(flight_infos: list[dict], tracking: bool) -> Callable[[], object]:
+    return lambda: combine_flight_info_messages(
+        [format_flight_info_message(flight_info, tracking) for flight_info in flight_infos]
+    )
+
+
+def build_cases() -> dict[str, Callable[[], object]]:
+    cases = {}
+    for filler_kb, points in [(100, 100), (400, 600), (1200, 2000)]:
+        cases[f"flight_page/{filler_kb}kb-{points}pts"] = flight_page_case(flightaware_page("UAL123", points, filler_kb))
+    for results in [1, 10, 50]:
+        cases[f"omnisearch/{results}-results"] = omnisearch_case(omnisearch_response("UAL123", results))
+    for lines in [20, 200, 1000]:
+        cases[f"parse_canvas/{lines}-lines"] = canvas_case(canvas_html(lines))
+    for config_kb in [1, 16, 64]:
+        cases[f"find_json/{config_kb}kb-config"] = find_json_case(f"@Flights {dumps(canvas_config(config_kb))}")
+    # A long line without any JSON, and one with an unclosed brace, so the pattern backtracks through all of it
+    long_text = " ".join(canvas_line_texts(2000))
+    cases["find_json/64kb-no-json"] = find_json_case(long_text[:64 * 1024])
+    cases["find_json/16kb-unclosed"] = find_json_case("{" + long_text[:16 * 1024])
+    for lines in [20, 200, 1000]:
+        cases[f"extract_flight_numbers/{lines}-lines"] = extraction_case(canvas_line_texts(lines))
+    flight_infos = [
+        flight_data_from_bootstrap(f"UAL{i}", f"https://www.flightaware.com/live/flight/UAL{i}",
+                                   trackpoll_bootstrap(f"UAL{i}", 0, seed=i))
+        for i in range(20)
+    ]
+    for count in [1, 20]:
+        cases[f"format_flight_info/{count}-flights"] = formatting_case(flight_infos[:count], tracking=False)
+        cases[f"format_flight_info/{count}-flights-tracking"] = formatting_case(flight_infos[:count], tracking=True)
+
+    for path in sorted(RECORDED_DIR.glob("flightaware_*.html")):
+        cases[f"flight_page/recorded-{path.stem}"] = flight_page_case(path.read_bytes())
+    for path in sorted(RECORDED_DIR.glob("omnisearch_*.json")):
+        cases[f"omnisearch/recorded-{path.stem}"] = omnisearch_case(path.read_bytes())
+    for path in sorted(RECORDED_DIR.glob("canvas_*.html")):
+        cases[f"parse_canvas/recorded-{path.stem}"] = canvas_case(path.read_text(encoding="utf-8"))
+    return cases
+
+
+def measure(function: Callable[[], object]) -> tuple[float, float]:
+    """
+    Returns the fastest time per call in milliseconds and the peak memory allocated by one call in kilobytes.
+    """
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+    number = max(number, int(number * MIN_RUN_TIME / elapsed))
+    best = min(timer.repeat(repeat=REPEAT, number=number)) / number * 1000
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak / 1024
+
+
+def compare(results: dict, baselines: dict, tolerance: float) -> list[str]:
+    """
+    Returns a description of each case that is slower or allocates more than its baseline allows.
+    """
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if not baseline:
+            continue
+        for metric, unit in [("ms", "ms"), ("peak_kb", "KB")]:
+            if result[metric] > baseline[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{name}: {metric} {result[metric]:.3f} {unit}, baseline {baseline[metric]:.3f} {unit} "
+                    f"(+{(result[metric] / baseline[metric] - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the parsing and formatting hot paths.")
+    parser.add_argument("filters", nargs="*", help="Only run cases whose name contains one of these")
+    parser.add_argument("--save", action="store_true", help="Save the results as the new baselines")
+    parser.add_argument("--baselines", type=Path, default=DEFAULT_BASELINES)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed increase over a baseline, 0.25 = 25%%")
+    args = parser.parse_args()
+
+    cases = {
+        name: function for name, function in build_cases().items()
+        if not args.filters or any(f in name for f in args.filters)
+    }
+    baselines = loads(args.baselines.read_text()) if args.baselines.exists() else {}
+    results = {}
+    print(f"{'case':<44} {'ms/call':>10} {'peak KB':>9} {'baseline ms':>12}")
+    for name, function in cases.items():
+        elapsed, peak = measure(function)
+        results[name] = {"ms": elapsed, "peak_kb": peak}
+        baseline = f"{baselines[name]['ms']:.3f}" if name in baselines else "-"
+        print(f"{name:<44} {elapsed:>10.3f} {peak:>9.1f} {baseline:>12}")
+
+    if args.save:
+        args.baselines.write_text(dumps({**baselines, **results}, indent=2, sort_keys=True) + "\n")
+        print(f"Saved {len(results)} baselines to {args.baselines} at {time.strftime('%Y-%m-%d %H:%M:%S')}")
+        return
+    regressions = compare(results, baselines, args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} regressions over {args.tolerance * 100:.0f}%:")
+        for regression in regressions:
+            print(f"  {regression}")
+        raise SystemExit(1)
+    if baselines:
+        print(f"No regressions over {args.tolerance * 100:.0f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Compares MapDataStore against the list-based map data CanvasEditor.update_map_data used to rebuild on every pass.
+
+Usage: python benchmarks/bench_map_data.py [flights] [airports]
+Defaults to 1,000 flights between 300 airports.
+"""
+import sys
+import time
+from json import dumps
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.fixtures import map_flight_entries
+from map_data_store import MapDataStore
+
+SECTIONS = {"pois": [], "themes": [], "tracking": {"arrivalDates": [], "currentlyTracking": True}, "file_id": "F0"}
+
+
+def list_pass(entries: list[dict]) -> bytes:
+    """
+    A pass as update_map_data did it before: membership tests on the airport list, a linear search for the flight,
+    and a new map that is serialised for every pass.
+    """
+    map_data = dict(SECTIONS)
+    for flight in entries:
+        for airport in (flight["origin"], flight["destination"]):
+            if airport not in map_data.get("airports", []):
+                map_data.setdefault("airports", []).append(airport)
+        flights_list = map_data.setdefault("flights", [])
+        existing_flight = next((f for f in flights_list if f.get("identifier") == flight["identifier"]), None)
+        if existing_flight:
+            flights_list.remove(existing_flight)
+        flights_list.append(flight)
+    return dumps(map_data).encode()
+
+
+def store_pass(store: MapDataStore, entries: list[dict]) -> bytes:
+    store.begin_pass()
+    for key, value in SECTIONS.items():
+        store.set_section(key, value)
+    for flight in entries:
+        store.update_flight(flight)
+    store.end_pass()
+    return store.payload()
+
+
+def measure(function, passes: list[list[dict]]) -> float:
+    """
+    Returns the average time per pass in milliseconds.
+    """
+    start = time.perf_counter()
+    for entries in passes:
+        function(entries)
+    return (time.perf_counter() - start) / len(passes) * 1000
+
+
+def main():
+    flights = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    airports = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    print(f"{flights} flights between {airports} airports")
+    print(f"{'scenario':<32} {'implementation':>14} {'ms/pass':>9}")
+    for scenario, moved in [("every flight moved", 1.0), ("10% of flights moved", 0.1), ("nothing changed", 0.0)]:
+        passes = [map_flight_entries(flights, airports, 1_790_000_000 + i * 120, moved) for i in range(1, 11)]
+        store = MapDataStore()
+        store_pass(store, map_flight_entries(flights, airports, 1_790_000_000, 1.0))  # The canvas's previous pass
+        results = {
+            "list": measure(list_pass, passes),
+            "store": measure(lambda entries: store_pass(store, entries), passes)
+        }
+        for label, elapsed in results.items():
+            print(f"{scenario:<32} {label:>14} {elapsed:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Compares the throughput of the async scrape engine with blocking worker threads, against a local FlightAware stand-in
+that answers every request after a fixed latency.
+
+Usage: python benchmarks/bench_scrape_engine.py [flights] [latency_ms]
+Defaults to 200 flights and 100 ms of latency. NUM_THREADS and ASYNC_CONCURRENCY set the concurrency as in scrape_api.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.fixtures import flightaware_page
+
+LATENCY = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.1
+PAGE = flightaware_page("UAL123", track_points=200, filler_kb=200)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like FlightAware
+
+    def do_GET(self):
+        time.sleep(LATENCY)
+        url = urlparse(self.path)
+        if url.path.startswith("/ajax/ignoreall/omnisearch/"):
+            flight_number = parse_qs(url.query)["q"][0]
+            body = dumps({"data": [{"ident": flight_number}]}).encode()
+            content_type = "application/json"
+        elif url.path.startswith("/live/flight/"):
+            body = PAGE
+            content_type = "text/html"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client cancelled the request
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stand_in() -> str:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    flights = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    os.environ["FLIGHTAWARE_BASE_URL"] = start_stand_in()  # Read when the scraper is imported
+    # Measure the engines, not the rate governor
+    os.environ.setdefault("FLIGHTAWARE_RATE", "100000")
+    os.environ.setdefault("FLIGHTAWARE_BURST", "1000")
+    from async_scrape import AsyncScrapeEngine
+    from scrape_flightaware import scrape_flightaware
+
+    threads = int(os.environ.get("NUM_THREADS", os.cpu_count()))
+    concurrency = int(os.environ.get("ASYNC_CONCURRENCY", 200))
+    flight_numbers = [f"UAL{i}" for i in range(flights)]
+    print(f"{flights} flights, {LATENCY * 1000:.0f} ms latency per request")
+    print(f"{'engine':<24} {'seconds':>8} {'flights/s':>10}")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(scrape_flightaware, flight_numbers))
+    elapsed = time.perf_counter() - start
+    if not all(results):
+        raise SystemExit("Some flights could not be scraped with threads")
+    print(f"{f'threads ({threads})':<24} {elapsed:>8.2f} {flights / elapsed:>10.1f}")
+
+    engine = AsyncScrapeEngine(concurrency=concurrency, parse_workers=int(os.environ.get("PARSE_WORKERS", 2)))
+    engine.start()
+
+    unknown = {}  # Every benchmark flight is found, so the negative cache stays empty
+
+    async def scrape(flight_number):
+        ident = await engine.get_flight_ident(flight_number, unknown)
+        return await engine.get_flight_data(ident)
+
+    async def scrape_all():
+        return await asyncio.gather(*(scrape(flight_number) for flight_number in flight_numbers))
+
+    start = time.perf_counter()
+    results = engine.submit(scrape_all()).result()
+    elapsed = time.perf_counter() - start
+    if not all(results):
+        raise SystemExit("Some flights could not be scraped with the async engine")
+    print(f"{f'async ({concurrency})':<24} {elapsed:>8.2f} {flights / elapsed:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Compares the streaming trackpollBootstrap extractor against the previous BeautifulSoup parser.
+
+Usage: python benchmarks/bench_trackpoll.py [saved_page.html ...]
+Without arguments, synthetic pages of several sizes are used.
+"""
+import sys
+import time
+import tracemalloc
+from json import loads
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bs4 import BeautifulSoup
+
+from benchmarks.fixtures import flightaware_page
+from scrape_flightaware import extract_trackpoll_bootstrap, PAGE_CHUNK_SIZE
+
+
+def soup_extract(page: bytes) -> dict:
+    """
+    The extraction get_flight_data used before the streaming extractor.
+    """
+    soup = BeautifulSoup(page.decode(), "html.parser")
+    script = soup.find("script", string=lambda text: text and "var trackpollBootstrap" in text)
+    script_content = script.string.replace("var trackpollBootstrap = ", "", 1)
+    script_content = script_content[::-1].replace(";", "", 1).strip()[::-1]
+    return loads(script_content)
+
+
+def streaming_extract(page: bytes) -> dict:
+    chunks = (page[i:i + PAGE_CHUNK_SIZE] for i in range(0, len(page), PAGE_CHUNK_SIZE))
+    return extract_trackpoll_bootstrap(chunks)
+
+
+def measure(function, page: bytes, repeat: int) -> tuple[float, int]:
+    """
+    Returns the average time per call in milliseconds and the peak traced memory of one call in bytes.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(page)
+    elapsed = (time.perf_counter() - start) / repeat * 1000
+    tracemalloc.start()
+    function(page)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    if len(sys.argv) > 1:
+        pages = {path: Path(path).read_bytes() for path in sys.argv[1:]}
+    else:
+        pages = {
+            f"synthetic {filler_kb} KB markup, {points} track points": flightaware_page("UAL123", points, filler_kb)
+            for filler_kb, points in [(100, 100), (400, 600), (1200, 2000)]
+        }
+    print(f"{'page':<48} {'size':>9} {'parser':>10} {'ms/page':>9} {'peak KB':>9}")
+    for name, page in pages.items():
+        if soup_extract(page) != streaming_extract(page):
+            raise SystemExit(f"Extractors disagree on {name}")
+        repeat = 5 if len(page) > 500_000 else 20
+        for label, function in [("soup", soup_extract), ("streaming", streaming_extract)]:
+            elapsed, peak = measure(function, page, repeat)
+            print(f"{name:<48} {len(page) // 1024:>6} KB {label:>10} {elapsed:>9.2f} {peak // 1024:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Synthetic fixtures shaped like the pages and payloads the bot and the scraping API handle.
+They are generated deterministically, so benchmark results are comparable between runs.
+"""
+import random
+from json import dumps
+
+AIRPORTS = [
+    ("Boston Logan Intl", "BOS", [-71.005, 42.364]),
+    ("Chicago O'Hare Intl", "ORD", [-87.904, 41.978]),
+    ("San Francisco Intl", "SFO", [-122.375, 37.619]),
+    ("Los Angeles Intl", "LAX", [-118.408, 33.942]),
+    ("John F Kennedy Intl", "JFK", [-73.779, 40.640]),
+    ("Seattle-Tacoma Intl", "SEA", [-122.309, 47.449]),
+    ("Denver Intl", "DEN", [-104.673, 39.862]),
+    ("London Heathrow", "LHR", [-0.454, 51.470])
+]
+
+
+def trackpoll_bootstrap(ident: str, track_points: int, seed: int = 0) -> dict:
+    """
+    Builds a trackpollBootstrap object with one flight and the given number of track points.
+    """
+    rng = random.Random(seed)
+    origin, destination = rng.sample(AIRPORTS, 2)
+    departure = 1_790_000_000 + rng.randint(0, 86_400)
+    flight = {
+        "airline": {"shortName": "United", "icao": "UAL", "iata": "UA"},
+        "codeShare": {"ident": ident},
+        "origin": {"friendlyName": origin[0], "iata": origin[1], "coord": origin[2]},
+        "destination": {"friendlyName": destination[0], "iata": destination[1], "coord": destination[2]},
+        "takeoffTimes": {"scheduled": departure, "estimated": departure + 300, "actual": None},
+        "landingTimes": {"scheduled": departure + 18_000, "estimated": departure + 18_300, "actual": None},
+        "distance": {"elapsed": rng.randint(0, 1500), "remaining": rng.randint(0, 1500)},
+        "flightPlan": {"speed": 450, "altitude": 350, "route": "DCT " * 20},
+        "track": [
+            {
+                "timestamp": departure + i * 30,
+                "coord": [rng.uniform(-120, -70), rng.uniform(30, 50)],
+                "alt": rng.randint(0, 400),
+                "gs": rng.randint(0, 550),
+                "type": "TW",
+                "isolated": False
+            }
+            for i in range(track_points)
+        ]
+    }
+    return {"version": "1.0", "summary": True, "flights": {f"{ident}-{departure}-schedule-0000": flight}}
+
+
+def flightaware_page(ident: str, track_points: int, filler_kb: int, seed: int = 0) -> bytes:
+    """
+    Builds a live flight page: markup and unrelated scripts around the trackpollBootstrap script.
+    :param ident: The flight identifier.
+    :param track_points: The number of track points in the bootstrap object.
+    :param filler_kb: Roughly how many kilobytes of other markup surround the bootstrap script.
+    """
+    rng = random.Random(seed)
+    filler = []
+    size = 0
+    while size < filler_kb * 1024:
+        part = (
+            f'<div class="flightPageDetails row-{len(filler)}"><span class="label">Detail</span>'
+            f'<a href="/live/flight/{ident}/history/{rng.randint(0, 10 ** 8)}">History</a>'
+            f'<script>window.adSlots = window.adSlots || []; window.adSlots.push({rng.random()});</script></div>\n'
+        )
+        filler.append(part)
+        size += len(part)
+    half = len(filler) // 2
+    bootstrap = dumps(trackpoll_bootstrap(ident, track_points, seed))
+    page = (
+        "<!DOCTYPE html><html><head><title>FlightAware</title></head><body>\n"
+        + "".join(filler[:half])
+        + f"<script>var trackpollBootstrap = {bootstrap};</script>\n"
+        + "".join(filler[half:])
+        + "</body></html>"
+    )
+    return page.encode()
+
+
+def map_flight_entries(flights: int, airports: int, scraped_at: float, moved: float = 1.0, seed: int = 0) -> list[dict]:
+    """
+    Builds the map entries of a canvas's flights, as CanvasEditor.update_map_data creates them.
+    :param flights: The number of flights.
+    :param airports: The number of distinct airports the flights fly between.
+    :param scraped_at: The scrape time of the flights that moved.
+    :param moved: The share of flights that moved since the previous scrape. The rest keep their earlier position.
+    """
+    rng = random.Random(seed)
+    airport_entries = [
+        {"name": f"Airport {i}", "lat": round(rng.uniform(-60, 70), 3), "lon": round(rng.uniform(-180, 180), 3)}
+        for i in range(airports)
+    ]
+    entries = []
+    for i in range(flights):
+        origin, destination = rng.sample(airport_entries, 2)
+        elapsed = rng.randint(0, 3000)
+        if rng.random() < moved:
+            elapsed += int(scraped_at) % 100
+            last_updated_at = scraped_at * 1000
+        else:
+            last_updated_at = 1_790_000_000_000
+        entries.append({
+            "identifier": f"FLT{i}",
+            "origin": origin,
+            "destination": destination,
+            "elapsedDistance": elapsed,
+            "remainingDistance": 3000 - elapsed,
+            "speed": rng.randint(300, 550),
+            "lastUpdatedAt": last_updated_at
+        })
+    return entries
+
+
+def omnisearch_response(flight_number: str, results: int, seed: int = 0) -> bytes:
+    """
+    Builds an omnisearch response with the given number of results, the first of which matches the flight number.
+    """
+    rng = random.Random(seed)
+    data = [
+        {
+            "ident": flight_number if i == 0 else f"UAL{rng.randint(1, 9999)}",
+            "description": f"United Airlines {rng.randint(1, 9999)}",
+            "origin": rng.choice(AIRPORTS)[1],
+            "destination": rng.choice(AIRPORTS)[1],
+            "type": "flight"
+        }
+        for i in range(results)
+    ]
+    return dumps({"data": data, "query": flight_number}).encode()
+
+
+def canvas_config(size_kb: int, seed: int = 0) -> dict:
+    """
+    Builds a bot configuration with nested objects, like the JSON users write in the bot mention line.
+    :param size_kb: Roughly how many kilobytes the configuration takes as JSON.
+    """
+    rng = random.Random(seed)
+    config = {"map": True, "trackNow": False, "pois": [], "themes": {"default": {"colors": {"route": "#3366ff"}}}}
+    while len(dumps(config)) < size_kb * 1024:
+        airport = rng.choice(AIRPORTS)
+        config["pois"].append({
+            "name": f"{airport[0]} lounge {len(config['pois'])}",
+            "position": {"lat": airport[2][1], "lon": airport[2][0]},
+            "style": {"icon": "star", "label": {"color": "#222222", "size": rng.randint(10, 16)}}
+        })
+    return config
+
+
+def canvas_line_texts(lines: int, seed: int = 0) -> list[str]:
+    """
+    Builds the text of canvas lines: flight numbers in the forms users write them, mixed with notes that contain
+    years, times and room numbers.
+    """
+    rng = random.Random(seed)
+    airlines = ["UA", "BA", "LH", "AA", "EZY", "DL", "U2", "AF", "KL"]
+    notes = [
+        "Hotel room {n}, check in after 15:00",
+        "Trip booked in 2025, reference ABC {n}",
+        "Meet at gate B{n} at 1200",
+        "Team offsite, {n} people"
+    ]
+    texts = []
+    for i in range(lines):
+        if rng.random() < 0.6:
+            airline = rng.choice(airlines)
+            separator = rng.choice(["", " ", "-"])
+            texts.append(f"{rng.choice(['Alice', 'Bob', 'Chen', 'Dana'])}: {airline}{separator}{rng.randint(1, 9999)}")
+        else:
+            texts.append(rng.choice(notes).format(n=rng.randint(100, 999)))
+    return texts
+
+
+def canvas_html(lines: int, config_kb: int = 1, seed: int = 0) -> str:
+    """
+    Builds a canvas as Slack exports it: a bot mention line with a configuration, then flight lines and notes,
+    some followed by a flight info line.
+    :param lines: The number of lines after the bot mention line.
+    :param config_kb: Roughly how many kilobytes the configuration in the bot mention line takes.
+    """
+    rng = random.Random(seed)
+    parts = [
+        "<html><head><title>Trip</title></head><body>\n",
+        f'<p class="line" id="temp:C:mention">@Flights {dumps(canvas_config(config_kb, seed))}</p>\n'
+    ]
+    for i, text in enumerate(canvas_line_texts(lines, seed)):
+        parts.append(f'<p class="line" id="temp:C:{i:06d}">{text}</p>\n')
+        if rng.random() < 0.3:
+            parts.append(
+                f'<p class="line" id="temp:C:{i:06d}i"><b>✈️\xa0Flight info</b> (<code>v2</code>): '
+                f'<a href="https://www.flightaware.com/live/flight/UAL{i}">United <code>UAL{i}</code></a> '
+                f'Boston Logan Intl (<code>BOS</code>) ➔ Chicago O\'Hare Intl (<code>ORD</code>)</p>\n'
+            )
+        if rng.random() < 0.1:
+            parts.append('<p class="line"></p>\n\n')
+    parts.append("</body></html>")
+    return "".join(parts)
@@ -1,18 +1,37 @@
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from enum import Enum
 from json import loads, JSONDecodeError
 from typing import Optional
 
-from requests import get
+from cachetools import LRUCache
 from slack_bolt import App
 
+from canvas_edits import CanvasEditBatch
+from event_coalescer import BotEdit
 from find_json import find_json, find_json_url
+from flight_cache import flight_data_cache
 from flight_number_extraction import extract_flight_numbers
+from flight_phase import FlightPhase, get_flight_phase, get_refresh_interval
 from info_message_format import FLIGHT_INFO_FORMAT_VERSION, FLIGHT_INFO_TITLE, format_flight_info_message, \
     combine_flight_info_messages
-from parse_canvas import CanvasLine, parse_canvas
-from scrape_flightaware import scrape_flightaware
+from http_transport import get
+from map_data_store import MapDataStore, get_map_data_store
+from metrics import Histogram
+from parse_canvas import CanvasLine, parse_canvas, canvas_line_matches
+from slack_scheduler import Priority, get_slack_scheduler
+from tracing import current_span, run_in_span, span, trace_pass
+
+SCRAPE_CONCURRENCY = int(os.environ.get("SCRAPE_CONCURRENCY", 8))  # Flights scraped in parallel per canvas pass
+CANVAS_CACHE_SIZE = int(os.environ.get("CANVAS_CACHE_SIZE", 256))  # Parsed canvases kept between passes
+
+canvas_pass_seconds = Histogram(
+    "canvas_pass_seconds", "Time taken by a CanvasEditor pass, from loading the canvas to sending its edits"
+)
 
 
 def clean_canvas(content: str) -> str:
@@ -23,47 +42,124 @@ def clean_canvas(content: str) -> str:
     )
 
 
+def get_canvas_revision(file: dict) -> Optional[tuple]:
+    """
+    Builds a revision key from a canvas file object. It changes whenever the canvas is edited.
+    :param file: The file object from files.info.
+    :return: The revision key, or None if the file object has no usable timestamps.
+    """
+    if not file.get('updated') and not file.get('date_updated'):
+        return None
+    return file.get('updated'), file.get('date_updated'), file.get('size')
+
+
+class CachedCanvas:
+    """
+    A parsed canvas, kept until the canvas changes.
+    """
+
+    def __init__(self, revision: tuple, lines: list[CanvasLine], bot_mention_line: CanvasLine, config: dict):
+        self.revision = revision
+        self.lines = lines
+        self.bot_mention_line = bot_mention_line
+        self.config = config
+
+
+canvas_cache = LRUCache(maxsize=CANVAS_CACHE_SIZE)
+canvas_cache_lock = threading.Lock()
+
+bot_revisions: dict[str, BotEdit] = {}  # {file_id: the bot's last edit}
+
+
 class CanvasEditResult(Enum):
     CURRENTLY_TRACKING = 1  # Keep sending edits on an interval
     NOT_TRACKING = 2  # Stop sending edits, no tracking
 
 
-locks = []
+locks: set[str] = set()  # Canvases with a pass running. Passes start from the scheduler, event and discovery pools
+locks_lock = threading.Lock()
 
 
 class CanvasEditor:
-    def __init__(self, app: App, file_id: str, token: str):
-        if file_id in locks:
+    def __init__(self, app: App, file_id: str, token: str, priority: Priority = Priority.BACKGROUND,
+                 bot_id: Optional[str] = None):
+        with locks_lock:  # Checked and taken together, so two pools cannot start a pass of the same canvas
+            self.skipped = file_id in locks
+            if not self.skipped:
+                locks.add(file_id)
+        if self.skipped:
             logging.warning(f"Canvas {file_id} is already being edited, skipping")
             return
-        locks.append(file_id)
         self.app = app
+        self.slack = get_slack_scheduler(app.client)  # All Slack calls go through the shared rate limiter
         self.file_id = file_id
         self.token = token
+        self.priority = priority
+        self.bot_id = bot_id
         self.canvas_content: Optional[list[CanvasLine]] = None
         self.bot_mention_line: Optional[CanvasLine] = None
         self.tracking_last_updated_line: Optional[CanvasLine] = None
         self.config = {}  # Canvas-specific configuration
-        self.map_data = {}
+        self.map_data: Optional[MapDataStore] = None  # Shared with earlier passes of the canvas
         self.initial_map_update = True
-        self.load_canvas(file_id)
-        if not self.canvas_content:
-            logging.error(f"Failed to load canvas content for file {file_id}")
-            return
-        if not self.find_bot_line():
-            logging.error(f"Bot mention line not found in canvas {file_id}")
-            return
-        self.load_config()
-        if self.map_enabled():
-            self.add_map_data()
-        else:
-            logging.info("Map is not enabled, skipping map data initialization")
-        self.add_flight_info()
+        self.canvas_revision: Optional[tuple] = None
+        self.canvas_from_cache = False
+        self.flight_phases: list[FlightPhase] = []  # Phases of the flights scraped during this pass
+        self.edits = CanvasEditBatch(self.slack, file_id, priority)  # Changes are sent together at the end of the pass
+        started = time.perf_counter()
+        with trace_pass("canvas_pass", file_id=file_id, priority=priority.name) as pass_span:
+            try:
+                with span("load_canvas"):
+                    self.load_canvas(file_id)
+                if pass_span:
+                    pass_span.set("from_cache", self.canvas_from_cache)
+                if not self.canvas_content:
+                    logging.error(f"Failed to load canvas content for file {file_id}")
+                    return
+                with span("find_bot_line"):
+                    found = self.find_bot_line()
+                if not found:
+                    logging.error(f"Bot mention line not found in canvas {file_id}")
+                    return
+                with span("load_config"):
+                    self.load_config()
+                self.cache_canvas()
+                if self.map_enabled():
+                    with span("add_map_data"):
+                        self.add_map_data()
+                else:
+                    logging.info("Map is not enabled, skipping map data initialization")
+                with span("add_flight_info"):
+                    self.add_flight_info()
+                if self.map_data:
+                    self.map_data.end_pass()  # Flights no longer on the canvas leave the map
+            finally:
+                try:
+                    with span("flush_edits", changes=len(self.edits.changes)):
+                        self.flush_edits()
+                finally:
+                    with locks_lock:
+                        locks.discard(file_id)  # Release the lock after editing is done
+                    canvas_pass_seconds.observe(time.perf_counter() - started)
 
-        locks.remove(file_id)  # Release the lock after editing is done
+    def flush_edits(self):
+        """
+        Sends the changes queued during the pass, then remembers the resulting revision,
+        so the file_change event caused by the edit can be recognised.
+        """
+        if not self.edits.changes:
+            return
+        self.edits.flush()
+        file = self.get_canvas_file(self.file_id)
+        if file:
+            bot_revisions[self.file_id] = BotEdit(get_canvas_revision(file), file.get("updated"))
 
-    def get_canvas_url(self, file_id: str) -> Optional[str]:
-        file_info = self.app.client.files_info(file=file_id)
+    def get_canvas_file(self, file_id: str) -> Optional[dict]:
+        """
+        Fetches the file object of a canvas from Slack.
+        :return: The file object if the file is a downloadable canvas, None otherwise.
+        """
+        file_info = self.slack.call("files_info", self.priority, file=file_id)
         if not file_info['ok']:
             logging.error(f"Failed to load canvas {file_id}: {file_info['error']}")
             return None
@@ -77,37 +173,45 @@ class CanvasEditor:
         if 'url_private_download' not in file:
             logging.error(f"File {file_id} does not have a URL")
             return None
-        return file['url_private_download']
+        return file
 
     def update_line(self, content: str, line_id: str, replace: bool):
         """
         Updates the line in the canvas with the given content.
+        The change is queued and sent with the rest of the pass's changes.
         :param content: The markdown content to update the line with.
         :param replace: Whether to replace the existing line or insert a new one below it.
         """
-        self.app.client.canvases_edit(
-            canvas_id=self.file_id,
-            changes=[
-                {
-                    "operation": "replace" if replace else "insert_after",
-                    "section_id": line_id,
-                    "document_content": {
-                        "type": "markdown",
-                        "markdown": content
-                    }
-                }
-            ]
+        self.edits.add(
+            operation="replace" if replace else "insert_after",
+            section_id=line_id,
+            markdown=content
         )
 
     def load_canvas(self, file_id: str):
-        file_url = self.get_canvas_url(file_id)
-        if not file_url:
+        file = self.get_canvas_file(file_id)
+        if not file:
             logging.error(f"Could not load canvas {file_id}")
             return
+        self.canvas_revision = get_canvas_revision(file)
+        with canvas_cache_lock:
+            cached_canvas = canvas_cache.get(file_id)
+        if cached_canvas and self.canvas_revision and cached_canvas.revision == self.canvas_revision:
+            logging.info(f"Canvas {file_id} has not changed, reusing the parsed canvas")
+            self.canvas_content = cached_canvas.lines
+            self.bot_mention_line = cached_canvas.bot_mention_line
+            self.config = cached_canvas.config
+            self.canvas_from_cache = True
+            return
+        file_url = file['url_private_download']
         headers = {
             "Authorization": f"Bearer {self.token}"
         }
-        response = get(file_url, headers=headers)
+        with span("canvas.download") as download_span:
+            response = get(file_url, headers=headers)
+            if download_span:
+                download_span.set("status", response.status_code)
+                download_span.set("bytes", len(response.content))
         if response.status_code != 200:
             logging.error(f"Failed to download canvas {file_id}: {response.status_code}")
             return
@@ -125,14 +229,18 @@ class CanvasEditor:
         if not self.canvas_content:
             logging.error("Canvas content is not loaded")
             return False
-        bot_id_request = self.app.client.auth_test()
-        if not bot_id_request['ok']:
-            logging.error(f"Failed to get bot ID: {bot_id_request['error']}")
-            return False
-        if 'user_id' not in bot_id_request:
-            logging.error("Bot ID not found in auth_test response")
-            return False
-        bot_id = bot_id_request['user_id']
+        if self.canvas_from_cache and self.bot_mention_line:
+            return True
+        bot_id = self.bot_id
+        if not bot_id:
+            bot_id_request = self.slack.auth_test()
+            if not bot_id_request['ok']:
+                logging.error(f"Failed to get bot ID: {bot_id_request['error']}")
+                return False
+            if 'user_id' not in bot_id_request:
+                logging.error("Bot ID not found in auth_test response")
+                return False
+            bot_id = bot_id_request['user_id']
         for line in self.canvas_content:
             if f"@{bot_id}" in line.text:
                 self.bot_mention_line = line
@@ -147,6 +255,8 @@ class CanvasEditor:
         if not self.bot_mention_line:
             logging.error("Bot mention line is not set")
             return
+        if self.canvas_from_cache:
+            return  # The configuration was loaded with the cached canvas
         for line in self.canvas_content:
             if line == self.bot_mention_line:
                 config_json_text = find_json(line.text)
@@ -156,8 +266,9 @@ class CanvasEditor:
                     if config_json_url:
                         logging.info(f"Found JSON URL in bot mention line: {config_json_url}")
                         try:
-                            response = get(config_json_url)
-                            response.raise_for_status()
+                            with span("canvas.config_url"):
+                                response = get(config_json_url)
+                                response.raise_for_status()
                             config_json_text = response.text
                         except Exception as e:
                             logging.error(f"Failed to fetch JSON from URL {config_json_url}: {e}")
@@ -175,6 +286,22 @@ class CanvasEditor:
         if not self.config:
             logging.warning("No configuration found in the canvas")
 
+    def cache_canvas(self):
+        """
+        Stores the parsed canvas, bot mention line and configuration until the canvas revision changes.
+        Canvases without a loaded configuration are not stored, so a failed fetch of a JSON URL is retried on the next
+        pass instead of leaving the canvas unconfigured until it is edited.
+        """
+        if self.canvas_from_cache or not self.canvas_revision or not self.config:
+            return
+        with canvas_cache_lock:
+            canvas_cache[self.file_id] = CachedCanvas(
+                revision=self.canvas_revision,
+                lines=self.canvas_content,
+                bot_mention_line=self.bot_mention_line,
+                config=self.config
+            )
+
     def map_enabled(self) -> bool:
         """
         Checks if the map is enabled in the canvas configuration.
@@ -319,13 +446,15 @@ class CanvasEditor:
         if not self.config or 'tracking' not in self.config or 'map' not in self.config['tracking']:
             logging.error("Map configuration is missing in the tracking settings")
             return
-        self.map_data["pois"] = self.config['tracking']['map'].get('pois', [])
-        self.map_data["themes"] = self.config['tracking']['map'].get('themes', [])
-        self.map_data["tracking"] = {
+        self.map_data = get_map_data_store(self.file_id)
+        self.map_data.begin_pass()
+        self.map_data.set_section("pois", self.config['tracking']['map'].get('pois', []))
+        self.map_data.set_section("themes", self.config['tracking']['map'].get('themes', []))
+        self.map_data.set_section("tracking", {
             "arrivalDates": self.config['tracking'].get('arrival_dates', []),
             "currentlyTracking": self.track_now()
-        }
-        self.map_data["file_id"] = self.file_id
+        })
+        self.map_data.set_section("file_id", self.file_id)
         logging.info("Map data initialized with configured POIs and themes")
 
 
@@ -334,7 +463,7 @@ class CanvasEditor:
         Updates the map data with the flight information.
         :param flight_info: The flight information to update the map with.
         """
-        if not self.map_enabled():
+        if not self.map_enabled() or not self.map_data:
             logging.warning("Map is not enabled, skipping map data update")
             return
         if not flight_info:
@@ -344,23 +473,18 @@ class CanvasEditor:
         if not flight_number:
             logging.error("Flight number is missing in flight info, cannot update map data")
             return
+        origin_coordinates = flight_info.get('origin', {}).get('coordinates', {})
+        destination_coordinates = flight_info.get('destination', {}).get('coordinates', {})
         origin_airport = {
             "name": flight_info.get('origin', {}).get('airport', 'Unknown Origin'),
-            "lat": flight_info.get('origin', {}).get('coordinates', {}).get('lat', 0.0),
-            "lon": flight_info.get('origin', {}).get('coordinates', {}).get('lon', 0.0)
+            "lat": origin_coordinates.get('lat', 0.0),
+            "lon": origin_coordinates.get('lon', origin_coordinates.get('lng', 0.0))  # The scraper uses lng
         }
         destination_airport = {
             "name": flight_info.get('destination', {}).get('airport', 'Unknown Destination'),
-            "lat": flight_info.get('destination', {}).get('coordinates', {}).get('lat', 0.0),
-            "lon": flight_info.get('destination', {}).get('coordinates', {}).get('lon', 0.0)
+            "lat": destination_coordinates.get('lat', 0.0),
+            "lon": destination_coordinates.get('lon', destination_coordinates.get('lng', 0.0))
         }
-        if origin_airport not in self.map_data.get('airports', []):
-            self.map_data.setdefault('airports', []).append(origin_airport)
-        if destination_airport not in self.map_data.get('airports', []):
-            self.map_data.setdefault('airports', []).append(destination_airport)
-        flights_list = self.map_data.setdefault('flights', [])
-        # Check if this flight already exists in the list (by identifier)
-        existing_flight = next((f for f in flights_list if f.get('identifier') == flight_number), None)
         flight_entry = {
             "identifier": flight_number,
             "origin": origin_airport,
@@ -368,11 +492,10 @@ class CanvasEditor:
             "elapsedDistance": flight_info.get('distance', {}).get('elapsed', 0),
             "remainingDistance": flight_info.get('distance', {}).get('remaining', 0),
             "speed": flight_info.get('speed', 0),
-            "lastUpdatedAt": datetime.now().timestamp() * 1000  # Convert to milliseconds
+            # Cached data keeps the time it was scraped at, so the map does not extrapolate from the wrong point
+            "lastUpdatedAt": flight_info.get('scraped_at', datetime.now().timestamp()) * 1000  # Convert to milliseconds
         }
-        if existing_flight:
-            flights_list.remove(existing_flight)
-        flights_list.append(flight_entry)
+        self.map_data.update_flight(flight_entry)  # Also adds its airports
         logging.info(f"Map data updated for flight {flight_number}")
 
     def get_map_data(self) -> dict:
@@ -380,10 +503,31 @@ class CanvasEditor:
         Returns the map data for the canvas.
         :return: A dictionary containing the map data.
         """
-        if not self.map_enabled():
+        if not self.map_enabled() or not self.map_data:
             logging.warning("Map is not enabled, returning empty map data")
             return {}
-        return self.map_data
+        return self.map_data.to_dict()
+
+    def fetch_flight_infos(self, flight_numbers: list[str]) -> dict[str, Optional[dict]]:
+        """
+        Fetches flight information for several flight numbers concurrently.
+        :param flight_numbers: The flight numbers to fetch, duplicates are fetched once.
+        :return: A dictionary mapping each flight number to its flight information (or None).
+        """
+        unique_flight_numbers = list(dict.fromkeys(flight_numbers))
+        if not unique_flight_numbers:
+            return {}
+        max_workers = min(SCRAPE_CONCURRENCY, len(unique_flight_numbers))
+        parent = current_span()  # The pass's span, so each flight's requests show up under it
+
+        def fetch(flight_number: str) -> Optional[dict]:
+            with span("flight", flight_number=flight_number):
+                return flight_data_cache.get(flight_number)
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scrape") as executor:
+            flight_infos = executor.map(lambda flight_number: run_in_span(parent, fetch, flight_number),
+                                        unique_flight_numbers)
+            return dict(zip(unique_flight_numbers, flight_infos))
 
     def add_flight_info(self):
         """
@@ -393,6 +537,7 @@ class CanvasEditor:
             logging.error("Canvas content is not loaded")
             return
 
+        pending_lines = []  # (line, flight numbers, line to replace or None)
         i = 0
         while i < len(self.canvas_content):
             line = self.canvas_content[i]
@@ -405,8 +550,7 @@ class CanvasEditor:
             if not flight_numbers:
                 logging.info(f"No flight numbers found in line: {line.text}")
                 continue
-            replace_existing = False
-            next_line = None
+            replace_line = None
             if i < len(self.canvas_content):
                 next_line = self.canvas_content[i]
                 if FLIGHT_INFO_TITLE in next_line.text:
@@ -415,14 +559,25 @@ class CanvasEditor:
                         continue
                     else:
                         logging.info("Replacing existing flight info in the canvas")
-                        replace_existing = True
+                        replace_line = next_line
+            pending_lines.append((line, flight_numbers, replace_line))
+
+        # Scrape every flight in the canvas at once, then apply the results in canvas order
+        flight_infos = self.fetch_flight_infos(
+            [flight for _, flight_numbers, _ in pending_lines for flight in flight_numbers]
+        )
+        written_lines = 0
+        skipped_lines = 0
+        failed_lines = 0
+        for line, flight_numbers, replace_line in pending_lines:
             info_messages = {}  # Flight number: info message
             for flight in flight_numbers:
-                flight_info = scrape_flightaware(flight)
+                flight_info = flight_infos.get(flight)
                 if not flight_info:
                     logging.warning(
                         f"Failed to scrape flight info for {flight}")  # Not an error because flight numbers may be inaccurate
                     continue
+                self.flight_phases.append(get_flight_phase(flight_info))
                 if self.map_enabled():
                     self.update_map_data(flight_info)
                 flight_number = flight_info.get('identifier', flight)
@@ -431,11 +586,20 @@ class CanvasEditor:
                     continue
                 info_message = format_flight_info_message(flight_info, self.track_now())
                 info_messages[flight_number] = info_message
+            if not info_messages:
+                # E.g. FlightAware is overloaded and the cached data expired: keep the last good info and retry on the
+                # next pass instead of writing an empty line over it
+                failed_lines += 1
+                continue
             flight_message = combine_flight_info_messages(info_messages.values())
-            if replace_existing:
+            if replace_line and canvas_line_matches(replace_line, flight_message):
+                skipped_lines += 1
+                continue
+            written_lines += 1
+            if replace_line:
                 self.update_line(
                     content=flight_message,
-                    line_id=next_line.id,
+                    line_id=replace_line.id,
                     replace=True
                 )
             else:
@@ -444,9 +608,19 @@ class CanvasEditor:
                     line_id=line.id,
                     replace=False
                 )
+        logging.info(
+            f"Flight info lines in canvas {self.file_id}: {written_lines} written, {skipped_lines} unchanged, "
+            f"{failed_lines} not fetched"
+        )
         if not self.initial_map_update:
             self.initial_map_update = False
 
+    def next_refresh_interval(self) -> int:
+        """
+        Returns how many seconds to wait before the next pass, based on the phases of the canvas's flights.
+        """
+        return get_refresh_interval(self.flight_phases)
+
     def get_result(self):
         """
         Returns the result of the canvas edit operation.
@@ -0,0 +1,117 @@
+import logging
+import os
+import random
+import threading
+import time
+
+from slack_sdk.errors import SlackApiError
+
+from slack_scheduler import Priority, SlackScheduler
+
+# Slack does not document a hard limit, so this is lowered automatically if Slack rejects a batch as too large
+max_changes_per_edit = int(os.environ.get("CANVAS_MAX_CHANGES_PER_EDIT", 50))
+max_changes_per_edit_lock = threading.Lock()  # Passes of different canvases flush from different threads
+EDIT_RETRIES = 3
+
+
+class CanvasEditBatch:
+    """
+    Collects the changes made to a canvas during a pass and sends them in as few canvases.edit calls as possible.
+    Changes are sent in the order they were added.
+    """
+
+    def __init__(self, slack: SlackScheduler, canvas_id: str, priority: Priority = Priority.BACKGROUND):
+        self.slack = slack
+        self.canvas_id = canvas_id
+        self.priority = priority
+        self.changes: list[dict] = []
+        self.api_calls = 0
+        self.changes_flushed = 0
+
+    def add(self, operation: str, section_id: str, markdown: str):
+        """
+        Queues a change to the canvas.
+        :param operation: The canvases.edit operation, such as "replace" or "insert_after".
+        :param section_id: The ID of the section the operation applies to.
+        :param markdown: The markdown content of the change.
+        """
+        self.changes.append({
+            "operation": operation,
+            "section_id": section_id,
+            "document_content": {
+                "type": "markdown",
+                "markdown": markdown
+            }
+        })
+
+    def flush(self) -> bool:
+        """
+        Sends all queued changes to Slack.
+        :return: True if every change was applied, False otherwise.
+        """
+        global max_changes_per_edit
+        if not self.changes:
+            return True
+        total_changes = len(self.changes)
+        with max_changes_per_edit_lock:
+            chunk_size = max_changes_per_edit
+        chunks = [self.changes[i:i + chunk_size] for i in range(0, total_changes, chunk_size)]
+        self.changes = []
+        self.changes_flushed += total_changes
+        success = True
+        while chunks:
+            chunk = chunks.pop(0)
+            try:
+                self.send(chunk)
+            except SlackApiError as e:
+                error = e.response.get("error")
+                if len(chunk) > 1 and error in ["invalid_arguments", "too_many_changes"]:
+                    # Split the batch, so the changes that are valid are still applied
+                    half = len(chunk) // 2
+                    if error == "too_many_changes":
+                        # Only a size error says anything about other batches, so only then is the limit lowered
+                        with max_changes_per_edit_lock:
+                            max_changes_per_edit = max(1, min(max_changes_per_edit, half))
+                    logging.warning(f"Canvas edit batch of {len(chunk)} changes rejected ({error}), retrying in halves")
+                    chunks[0:0] = [chunk[:half], chunk[half:]]
+                    continue
+                logging.error(f"Failed to edit canvas {self.canvas_id}: {e.response.get('error')}")
+                success = False
+            except Exception as e:
+                logging.error(f"Failed to edit canvas {self.canvas_id}: {e}")
+                success = False
+        logging.info(
+            f"Applied {total_changes} canvas changes with {self.api_calls} API calls "
+            f"({self.calls_saved()} saved this pass)"
+        )
+        return success
+
+    def calls_saved(self) -> int:
+        """
+        Returns how many API calls were saved compared to sending one call per change.
+        """
+        return max(0, self.changes_flushed - self.api_calls)
+
+    def send(self, chunk: list[dict]):
+        """
+        Sends a single canvases.edit call, retrying the whole batch on transient errors.
+        Rate limits are handled by the scheduler.
+        """
+        for attempt in range(EDIT_RETRIES):
+            self.api_calls += 1
+            try:
+                self.slack.call("canvases_edit", self.priority, canvas_id=self.canvas_id, changes=chunk)
+                return
+            except SlackApiError as e:
+                if attempt == EDIT_RETRIES - 1:
+                    raise
+                if e.response.status_code >= 500:
+                    delay = 2 ** attempt + random.random()
+                else:
+                    raise
+            except OSError:
+                if attempt == EDIT_RETRIES - 1:
+                    raise
+                delay = 2 ** attempt + random.random()
+            logging.warning(f"Retrying canvas edit for {self.canvas_id} in {delay:.1f}s")
+            time.sleep(delay)
@@ -0,0 +1,106 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable
+
+
+class CanvasScheduler:
+    """
+    Runs canvas refreshes when they are due.
+    Canvases are kept in a priority queue ordered by due time, and a pool of workers takes the earliest due canvas,
+    so a slow canvas only delays the worker running it.
+    """
+
+    def __init__(self, run: Callable[[str], None], workers: int, retry_interval: float):
+        """
+        :param run: Refreshes a canvas. It is expected to schedule the canvas again if it should keep refreshing.
+        :param workers: The number of canvases refreshed at the same time.
+        :param retry_interval: Seconds to wait before retrying a canvas whose refresh raised an error.
+        """
+        self.run = run
+        self.workers = workers
+        self.retry_interval = retry_interval
+        self.condition = threading.Condition(threading.RLock())  # schedule() is called while holding it
+        self.queue: list[tuple[float, int, str]] = []  # (due time, sequence, file ID)
+        self.scheduled: dict[str, tuple[float, int]] = {}  # File ID: the queue entry that is still valid
+        self.running: set[str] = set()
+        self.deferred: set[str] = set()  # File IDs that became due while they were being refreshed
+        self.lateness: dict[str, float] = {}  # File ID: seconds between the due time and the start of the last run
+        self.sequence = itertools.count()
+
+    def schedule(self, file_id: str, delay: float = 0):
+        """
+        Schedules a canvas to be refreshed after the given delay, replacing any earlier schedule for it.
+        """
+        due = time.time() + delay
+        with self.condition:
+            entry = (due, next(self.sequence))
+            self.scheduled[file_id] = entry
+            heapq.heappush(self.queue, (*entry, file_id))
+            self.condition.notify()
+
+    def unschedule(self, file_id: str):
+        """
+        Stops refreshing a canvas. Its queue entry is discarded when it reaches the front.
+        """
+        with self.condition:
+            self.scheduled.pop(file_id, None)
+            self.deferred.discard(file_id)
+            self.lateness.pop(file_id, None)
+
+    def start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def next_due(self) -> tuple[str, float]:
+        """
+        Blocks until a canvas is due, then removes it from the queue.
+        :return: The file ID and its due time.
+        """
+        with self.condition:
+            while True:
+                while self.queue and self.scheduled.get(self.queue[0][2]) != self.queue[0][:2]:
+                    heapq.heappop(self.queue)  # Replaced or unscheduled
+                if self.queue and self.queue[0][0] <= time.time():
+                    due, _, file_id = heapq.heappop(self.queue)
+                    del self.scheduled[file_id]
+                    if file_id in self.running:
+                        self.deferred.add(file_id)  # Run it again once the current refresh is done
+                        continue
+                    self.running.add(file_id)
+                    return file_id, due
+                self.condition.wait(self.queue[0][0] - time.time() if self.queue else None)
+
+    def worker(self):
+        while True:
+            file_id, due = self.next_due()
+            lateness = max(0.0, time.time() - due)
+            with self.condition:
+                self.lateness[file_id] = lateness
+            logging.info(f"Refreshing canvas {file_id}, {lateness:.1f}s after it was due")
+            try:
+                self.run(file_id)
+            except Exception as e:
+                logging.error(f"Error updating file {file_id}: {e}")
+                self.schedule(file_id, self.retry_interval)
+            finally:
+                with self.condition:
+                    self.running.discard(file_id)
+                    if file_id in self.deferred:
+                        self.deferred.discard(file_id)
+                        self.schedule(file_id)
+                    self.condition.notify()
+
+    def stats(self) -> dict:
+        """
+        Returns the number of scheduled and running canvases and how late each canvas last ran.
+        """
+        with self.condition:
+            return {
+                "scheduled": len(self.scheduled),
+                "running": len(self.running),
+                "max_lateness": max(self.lateness.values(), default=0.0),
+                "lateness": dict(self.lateness)
+            }
@@ -0,0 +1,107 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Callable, Optional
+
+BOT_EVENT_DELAY = 10  # Seconds after an edit in which Slack sends its file_change event, by Slack's clock
+
+
+class BotEdit:
+    """
+    The bot's last edit of a canvas: the revision it created, and when Slack says that revision was made.
+    Only file_change events Slack sent from then until BOT_EVENT_DELAY later can have been caused by the edit.
+    Both times come from Slack, so the bot host's clock does not matter.
+    """
+
+    def __init__(self, revision: Optional[tuple], updated: Optional[float]):
+        """
+        :param updated: The "updated" time of the revision, in whole seconds.
+        """
+        self.revision = revision
+        self.updated = updated
+
+    def covers(self, first_event_at: float, last_event_at: float) -> bool:
+        """
+        Whether events Slack sent at these times may have been caused by the edit. Events of a user's edit made in
+        an earlier second, e.g. while the bot's pass was running, fall before the revision and are kept.
+        """
+        if not self.updated:
+            return False
+        return self.updated <= first_event_at and last_event_at <= self.updated + BOT_EVENT_DELAY
+
+
+class EventOutcome(Enum):
+    DROPPED = "dropped"  # Caused by the bot's own edit
+    MERGED = "merged"  # Folded into a pass that is already pending
+    PROCESSED = "processed"  # Started a pass
+
+
+class FileChangeCoalescer:
+    """
+    Debounces file_change events: a burst of events for the same file results in a single pass,
+    and events caused by the bot's own edits are dropped.
+    """
+
+    def __init__(self, process: Callable[[str], None], is_own_change: Callable[[str, float, float], bool],
+                 is_busy: Callable[[str], bool], debounce: float, workers: int):
+        """
+        :param process: Runs a pass for a file.
+        :param is_own_change: Whether events for a file, from the first to the last event time given, were all
+            caused by the bot's own edit.
+        :param is_busy: Whether a pass is already running for a file. Events then wait for it to finish.
+        :param debounce: Seconds to wait for more events before starting a pass.
+        :param workers: The number of passes run at the same time.
+        """
+        self.process = process
+        self.is_own_change = is_own_change
+        self.is_busy = is_busy
+        self.debounce = debounce
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="file-change")
+        self.lock = threading.Lock()
+        self.pending: dict[str, tuple[float, float]] = {}  # File ID: times of the first and last waiting event
+        self.counters = {outcome.value: 0 for outcome in EventOutcome}
+
+    def submit(self, file_id: str, event_at: float = 0):
+        """
+        Records a file_change event for the file.
+        :param event_at: When Slack sent the event, by Slack's clock. 0 if unknown, so it is never taken for the
+            bot's own.
+        """
+        with self.lock:
+            if file_id in self.pending:
+                first_event_at, last_event_at = self.pending[file_id]
+                self.pending[file_id] = (min(first_event_at, event_at), max(last_event_at, event_at))
+                self.counters[EventOutcome.MERGED.value] += 1
+                logging.info(f"File change for {file_id}: {EventOutcome.MERGED.value}")
+                return
+            self.pending[file_id] = (event_at, event_at)
+        self.start_timer(file_id)
+
+    def start_timer(self, file_id: str):
+        timer = threading.Timer(self.debounce, self.executor.submit, args=(self.run, file_id))
+        timer.daemon = True
+        timer.start()
+
+    def run(self, file_id: str):
+        if self.is_busy(file_id):
+            self.start_timer(file_id)  # Wait for the running pass, which may not include this change
+            return
+        with self.lock:
+            first_event_at, last_event_at = self.pending.pop(file_id)
+        try:
+            # Events that arrived while a pass ran are only dropped if they fall within the bot's own edit
+            own_change = self.is_own_change(file_id, first_event_at, last_event_at)
+        except Exception as e:
+            logging.error(f"Failed to check the revision of {file_id}: {e}")
+            own_change = False
+        outcome = EventOutcome.DROPPED if own_change else EventOutcome.PROCESSED
+        with self.lock:
+            self.counters[outcome.value] += 1
+        logging.info(f"File change for {file_id}: {outcome.value}")
+        if not own_change:
+            self.process(file_id)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {**self.counters, "pending": len(self.pending)}
@@ -0,0 +1,118 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from cachetools import TTLCache
+
+from refresh_coordinator import RefreshCoordinator
+from scrape_flightaware import scrape_flightaware
+
+FLIGHT_CACHE_SIZE = int(os.environ.get("FLIGHT_CACHE_SIZE", 2048))
+FLIGHT_CACHE_TTL = int(os.environ.get("FLIGHT_CACHE_TTL", 60))  # Data is fresh for one minute
+FLIGHT_CACHE_STALE_TTL = int(os.environ.get("FLIGHT_CACHE_STALE_TTL", 60 * 15))  # Stale data is served for 15 minutes
+FLIGHT_REFRESH_WORKERS = int(os.environ.get("FLIGHT_REFRESH_WORKERS", 4))  # Stale flights refreshed at the same time
+FLIGHT_REFRESH_QUEUE_SIZE = int(os.environ.get("FLIGHT_REFRESH_QUEUE_SIZE", 256))  # Stale flights waiting for a refresh
+
+
+class FlightDataCache:
+    """
+    A bounded TTL cache for scraped flight data with stale-while-revalidate and single-flight fetching.
+
+    Fresh entries are returned directly. Stale entries are returned while a bounded pool of workers refreshes them,
+    most requested flight first. Fetches go through a refresh coordinator, so concurrent misses for the same key
+    share a single fetch, and a miss takes over a queued refresh of its key.
+    """
+    events = ("hits", "stale_hits", "misses", "coalesced", "refreshes", "refreshes_dropped", "fetch_failures")
+
+    def __init__(self, fetch: Callable[[str], Optional[dict]], maxsize: int, ttl: float, stale_ttl: float,
+                 refresh_workers: int, refresh_queue_size: int):
+        """
+        :param refresh_workers: The number of stale entries refreshed in the background at the same time.
+        :param refresh_queue_size: The number of stale entries waiting for a background refresh.
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.cache = TTLCache(maxsize=maxsize, ttl=stale_ttl)
+        self.lock = threading.Lock()
+        self.coordinator = RefreshCoordinator(self.refresh, workers=refresh_workers, max_queued=refresh_queue_size)
+        self.counters = {
+            "hits": 0,
+            "stale_hits": 0,
+            "fetch_failures": 0
+        }
+
+    def start(self):
+        """
+        Starts the background refresh workers. Until then, stale data is served until it expires.
+        """
+        self.coordinator.start()
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Returns the flight data for the given key, fetching it if it is not cached.
+        :param key: The flight number to get data for.
+        :return: The flight data, or None if it could not be fetched.
+        """
+        now = time.time()
+        with self.lock:
+            cached_item = self.cache.get(key)
+            if cached_item:
+                data, fetch_time = cached_item
+                stale = now - fetch_time > self.ttl
+                self.counters["stale_hits" if stale else "hits"] += 1
+        if not cached_item:
+            return self.coordinator.get(key)
+        if stale:
+            self.coordinator.request_refresh(key)
+        return data
+
+    def refresh(self, key: str) -> Optional[dict]:
+        """
+        Fetches and stores the data for a key. Run by the coordinator, which runs at most one refresh per key at a time.
+        :return: The fetched data, or the cached data if the fetch failed.
+        """
+        result = None
+        try:
+            result = self.fetch(key)
+        except Exception as e:
+            logging.error(f"Failed to fetch flight data for {key}: {e}")
+        with self.lock:
+            if result:
+                # Keep the scrape time so consumers do not mistake cached data for live data
+                result = {**result, "scraped_at": time.time()}
+                self.cache[key] = (result, result["scraped_at"])
+                return result
+            self.counters["fetch_failures"] += 1
+            # A failed refresh keeps serving the old data until it expires
+            cached_item = self.cache.get(key)
+            return cached_item[0] if cached_item else None
+
+    def stats(self) -> dict:
+        """
+        Returns a snapshot of the cache counters.
+        """
+        coordinator_stats = self.coordinator.stats()
+        with self.lock:
+            return {
+                **self.counters,
+                "misses": coordinator_stats["fetches"],
+                "coalesced": coordinator_stats["coalesced"],
+                "refreshes": coordinator_stats["refreshes"],
+                "refreshes_dropped": coordinator_stats["refreshes_dropped"],
+                "size": len(self.cache),
+                "in_flight": coordinator_stats["in_flight"],
+                "queued": coordinator_stats["queued"]
+            }
+
+
+flight_data_cache = FlightDataCache(
+    fetch=scrape_flightaware,
+    maxsize=FLIGHT_CACHE_SIZE,
+    ttl=FLIGHT_CACHE_TTL,
+    stale_ttl=FLIGHT_CACHE_STALE_TTL,
+    refresh_workers=FLIGHT_REFRESH_WORKERS,
+    refresh_queue_size=FLIGHT_REFRESH_QUEUE_SIZE
+)
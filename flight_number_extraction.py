@@ -1,14 +1,47 @@
-from re import compile
+from re import Match, compile
 
+from airline_codes import airline_codes
+
+# An IATA code (two characters, at least one a letter) or an ICAO code (three letters), then the flight's number
 flight_number_pattern = compile(
-    r"\b[A-Za-z]{2,3}[\s-]?\d{1,4}\b|\b\d{3,4}\b"
+    r"\b(?P<airline>[A-Za-z]{3}|[A-Za-z][A-Za-z0-9]|[0-9][A-Za-z])(?P<separator>[\s-]?)(?P<number>\d{1,4})\b"
 )
 
 
+# Letters and digits, optionally separated by spaces or dashes, with at least one letter: flight numbers (UAL123),
+# tail numbers (N123AB, G-ABCD) and anything else omnisearch may know
+ident_pattern = compile(r"(?=.*[A-Za-z])[A-Za-z0-9]+(?:[\s-]+[A-Za-z0-9]+)*")
+
+
+def has_known_airline(match: Match) -> bool:
+    return airline_codes.is_airline_code(match["airline"])
+
+
 def extract_flight_numbers(text: str) -> list[str]:
     """
     Extracts flight numbers from the given text.
+    Candidates are only kept if they start with a known airline code, so numbers such as years or room numbers
+    are not looked up on FlightAware. Lowercase words followed by a number (e.g. "at 1200") are skipped too.
     :param text: The text to extract flight numbers from.
     :return: A list of flight numbers found in the text.
     """
-    return flight_number_pattern.findall(text)
+    return [
+        match[0] for match in flight_number_pattern.finditer(text)
+        if has_known_airline(match) and not (match["airline"].islower() and match["separator"].isspace())
+    ]
+
+
+def is_known_flight_number(flight_number: str) -> bool:
+    """
+    Returns whether a flight number is an airline code known to the bundled index followed by a number.
+    """
+    match = flight_number_pattern.fullmatch(flight_number.strip())
+    return bool(match) and has_known_airline(match)
+
+
+def could_be_ident(text: str) -> bool:
+    """
+    Returns whether text could be looked up on FlightAware. Only text that cannot be a flight or tail number, such
+    as a bare number or one with punctuation, is ruled out. Use is_known_flight_number to tell likely flight numbers.
+    """
+    return bool(ident_pattern.fullmatch(text.strip()))
@@ -0,0 +1,58 @@
+import os
+from datetime import datetime
+from enum import Enum
+from typing import Optional
+
+
+class FlightPhase(Enum):
+    SCHEDULED = "scheduled"  # Departs later than the boarding window
+    BOARDING = "boarding"  # Departs soon
+    AIRBORNE = "airborne"
+    LANDED = "landed"
+    UNKNOWN = "unknown"  # Flight times are not available
+
+
+BOARDING_WINDOW = 60 * 60 * 2  # Seconds before departure when a flight counts as boarding soon
+
+# Seconds between canvas refreshes for a flight in each phase
+PHASE_INTERVALS = {
+    FlightPhase.SCHEDULED: int(os.environ.get("REFRESH_INTERVAL_SCHEDULED", 60 * 15)),
+    FlightPhase.BOARDING: int(os.environ.get("REFRESH_INTERVAL_BOARDING", 60 * 2)),
+    FlightPhase.AIRBORNE: int(os.environ.get("REFRESH_INTERVAL_AIRBORNE", 60 * 2)),
+    FlightPhase.LANDED: int(os.environ.get("REFRESH_INTERVAL_LANDED", 60 * 30)),
+    FlightPhase.UNKNOWN: int(os.environ.get("REFRESH_INTERVAL_UNKNOWN", 60 * 5))
+}
+DEFAULT_REFRESH_INTERVAL = PHASE_INTERVALS[FlightPhase.UNKNOWN]  # Used for canvases without any flights
+
+
+def get_flight_phase(flight_info: dict, now: Optional[datetime] = None) -> FlightPhase:
+    """
+    Determines the phase of a flight from its departure and arrival times.
+    :param flight_info: The flight information returned by the scraper.
+    :param now: The time to compare against, defaults to the current time.
+    :return: The phase of the flight.
+    """
+    now = (now or datetime.now()).timestamp()
+    origin = flight_info.get("origin", {})
+    destination = flight_info.get("destination", {})
+    departure_time = origin.get("actual_departure_time") or origin.get("departure_time")
+    arrival_time = destination.get("actual_arrival_time") or destination.get("arrival_time")
+    if departure_time is None or arrival_time is None:
+        return FlightPhase.UNKNOWN
+    if now >= arrival_time:
+        return FlightPhase.LANDED
+    if now >= departure_time:
+        return FlightPhase.AIRBORNE
+    if departure_time - now <= BOARDING_WINDOW:
+        return FlightPhase.BOARDING
+    return FlightPhase.SCHEDULED
+
+
+def get_refresh_interval(phases: list[FlightPhase]) -> int:
+    """
+    Returns how long to wait before refreshing a canvas whose flights are in the given phases.
+    The most urgent flight decides.
+    """
+    if not phases:
+        return DEFAULT_REFRESH_INTERVAL
+    return min(PHASE_INTERVALS[phase] for phase in phases)
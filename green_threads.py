@@ -0,0 +1,38 @@
+import threading
+from functools import wraps
+
+
+def threads_are_green() -> bool:
+    """
+    Returns whether gevent has patched threading, as gunicorn's gevent worker does, so threads are greenlets.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+def outside_hub(function):
+    """
+    Runs a function that blocks without yielding to gevent, such as SQLite waiting for another process's write lock,
+    in a native thread of gevent's pool when threads are green, so the other greenlets (e.g. map event streams) keep
+    running meanwhile. Otherwise, the function is called directly.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if not threads_are_green():
+            return function(*args, **kwargs)
+        from gevent import get_hub
+        return get_hub().threadpool.apply(function, args, kwargs)
+    return wrapper
+
+
+def native_lock() -> threading.Lock:
+    """
+    Returns a lock for functions that run outside_hub: waiting for it blocks a native thread rather than the hub.
+    """
+    if not threads_are_green():
+        return threading.Lock()
+    from gevent.monkey import get_original
+    return get_original("_thread", "allocate_lock")()
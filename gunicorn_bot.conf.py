@@ -0,0 +1,17 @@
+# Configuration for running the Slack bot (main:flask_app) with gunicorn. gunicorn.conf.py is the scraping API's and
+# is loaded by default, so pass this file with -c
+from importlib.util import find_spec
+
+workers = 1
+
+bind = "0.0.0.0:5000"
+
+if find_spec("gevent"):
+    # The supported way to serve map event streams: each one is a greenlet (map_events.GREEN_MAX_CLIENTS)
+    worker_class = "gevent"
+    worker_connections = 2000
+else:
+    worker_class = "gthread"
+    threads = 16 # Up to 8 of them serve map event streams (map_events.THREAD_MAX_CLIENTS)
+
+timeout = 480 # Canvas passes triggered by Slack events can take a while
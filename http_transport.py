@@ -0,0 +1,101 @@
+import logging
+import os
+import random
+import threading
+import time
+from typing import Optional
+
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+from rate_governor import RateGovernor
+
+# Kept-alive connections per host. By default, the pool grows to the number of threads the process sends requests
+# from, as declared with size_pool
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 0))
+DEFAULT_POOL_SIZE = 10  # requests' default, until the process declares its threads
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 20))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 2))
+RETRY_BACKOFF = 0.5  # Seconds, doubled after each attempt
+MAX_RETRY_DELAY = 30
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+session = Session()
+session.headers["Accept-Encoding"] = "gzip, deflate"
+pool_size = 0
+pool_lock = threading.Lock()
+
+
+def size_pool(threads: int):
+    """
+    Makes the connection pool of each host large enough for the given number of threads sending requests at the same
+    time, so none of their connections are discarded after use. Call it when the thread pools are set up: connections
+    already in the pool are closed if it grows.
+    """
+    global pool_size
+    size = HTTP_POOL_SIZE or max(threads, DEFAULT_POOL_SIZE)
+    with pool_lock:
+        if size <= pool_size:
+            return
+        pool_size = size
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+    logging.info(f"HTTP connection pool sized for {size} connections per host")
+
+
+size_pool(0)
+
+
+def retry_delay(attempt: int, response: Optional[Response] = None) -> float:
+    """
+    Returns how long to wait before the next attempt, using Retry-After when the server sends it.
+    Otherwise, exponential backoff with full jitter is used so that threads do not retry in lockstep.
+    """
+    if response is not None and retry_after(response) is not None:
+        return min(MAX_RETRY_DELAY, retry_after(response))
+    return random.uniform(0, min(MAX_RETRY_DELAY, RETRY_BACKOFF * 2 ** attempt))
+
+
+def retry_after(response) -> Optional[float]:
+    """
+    Returns the seconds in the Retry-After header of a response, if it has one.
+    """
+    value = response.headers.get("Retry-After", "")
+    return float(value) if value.isdigit() else None
+
+
+def get(url: str, governor: Optional[RateGovernor] = None, **kwargs) -> Response:
+    """
+    Sends a GET request over the shared keep-alive session.
+    Connection errors, timeouts and retryable status codes are retried with jittered backoff.
+    :param url: The URL to request.
+    :param governor: Limits the rate of requests to the host. Every attempt waits for its turn, and responses
+        adapt the rate. Raises GovernorOverloaded if the wait would be too long.
+    :param kwargs: Passed to requests, a default timeout is added if none is given.
+    :return: The response of the last attempt.
+    """
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    attempt = 0
+    while True:
+        if governor:
+            governor.wait()
+        try:
+            response = session.get(url, **kwargs)
+        except (ConnectionError, Timeout) as e:
+            if attempt >= HTTP_RETRIES:
+                raise
+            delay = retry_delay(attempt)
+            logging.warning(f"Request to {url} failed ({e}), retrying in {delay:.1f}s")
+        else:
+            if governor:
+                governor.record(response.status_code, retry_after(response))
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= HTTP_RETRIES:
+                return response
+            delay = retry_delay(attempt, response)
+            response.close()
+            logging.warning(f"Request to {url} returned {response.status_code}, retrying in {delay:.1f}s")
+        attempt += 1
+        time.sleep(delay)
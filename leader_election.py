@@ -0,0 +1,44 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+
+class LeaderElection:
+    """
+    Elects one leader among the processes sharing a lock file, using an exclusive file lock.
+    The operating system releases the lock when the leader exits, and another process then takes over.
+    """
+
+    def __init__(self, lock_path: str, on_elected: Callable[[], None], retry_interval: float = 5):
+        """
+        :param lock_path: The lock file, shared by every process of the deployment.
+        :param on_elected: Called once, when this process becomes the leader.
+        :param retry_interval: Seconds between attempts to take the lock.
+        """
+        self.lock_path = lock_path
+        self.on_elected = on_elected
+        self.retry_interval = retry_interval
+        self.lock_file = None
+        self.is_leader = False
+
+    def try_acquire(self) -> bool:
+        if self.lock_file is None:
+            self.lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def run(self):
+        while not self.try_acquire():
+            time.sleep(self.retry_interval)
+        self.is_leader = True
+        logging.info(f"Process {os.getpid()} was elected leader")
+        self.on_elected()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
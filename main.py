@@ -1,17 +1,35 @@
+import gzip
 import logging
 import os
 import threading
 import time
-from json import load
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from json import dumps, load
+from typing import Optional
+from uuid import uuid4
 
 from dotenv import load_dotenv
-from flask import Flask, request, render_template, url_for, redirect
+from flask import Flask, Response, request, render_template, url_for, redirect
 from slack_bolt import App
 from slack_bolt.adapter.flask import SlackRequestHandler
 
 from traceback import print_exc
 
-from canvas_editor import CanvasEditor, CanvasEditResult
+from canvas_editor import SCRAPE_CONCURRENCY, CanvasEditor, CanvasEditResult, get_canvas_revision, bot_revisions, locks
+from canvas_scheduler import CanvasScheduler
+from event_coalescer import FileChangeCoalescer
+from flight_cache import FLIGHT_REFRESH_WORKERS, flight_data_cache
+from http_transport import size_pool
+from leader_election import LeaderElection
+from map_data_store import MapDataStore
+from map_events import MapEventHub, default_max_clients
+from map_state import MapState, MIN_COMPRESSED_SIZE
+from metrics import CONTENT_TYPE, CallbackMetric, metrics_registry
+from scrape_flightaware import flightaware_governor, unknown_flight_numbers
+from slack_scheduler import Priority, get_slack_scheduler
+from state_store import StateStore, STATE_DB_PATH
+from tracing import slow_pass_recorder
 
 load_dotenv()
 
@@ -24,66 +42,210 @@ app = App(
     signing_secret=os.environ.get("SLACK_SIGNING_SECRET")
 )
 
-auth_test_result = app.client.auth_test()
+slack = get_slack_scheduler(app.client)
+
+auth_test_result = slack.auth_test()
 bot_id = auth_test_result["user_id"]
 
-tracked_files = []
-tracking_map_data = {}  # {file_id: {elapsed_dist: int, remaining_dist: int, eta: int, updated_at: datetime}}
+state_store = StateStore(STATE_DB_PATH)
+
+MAP_EVENTS_HEARTBEAT = 15  # Seconds between comments that keep idle event streams open through proxies
+MAP_EVENTS_RETRY = 5000  # Milliseconds browsers wait before reconnecting a dropped event stream
+MAP_EVENTS_POLL_INTERVAL = 2  # Seconds between state database checks for streamed maps in non-leader processes
+map_event_hub = MapEventHub(max_clients=int(os.environ.get("MAP_EVENTS_MAX_CLIENTS", default_max_clients())))
+
+# Restore the last known state so maps are served and tracking resumes right after a restart
+tracked_files = state_store.load_tracked_files()
+map_states: dict[str, MapState] = {}  # {file_id: MapState}
+map_states_lock = threading.Lock()
+for restored_file_id, (updated_at, restored_map_data) in state_store.load_map_data().items():
+    map_states[restored_file_id] = MapState()
+    map_states[restored_file_id].update(restored_map_data, round(updated_at * 1000))
+    map_event_hub.publish(restored_file_id, map_states[restored_file_id].version)
+logging.info(f"Restored {len(tracked_files)} tracked files and {len(map_states)} maps")
+
+RETRY_INTERVAL = 60 * 2  # Seconds before a canvas that failed to update is tried again
 
-def update_file(file_id: str):
+# In multi-process mode (e.g. several gunicorn workers), one elected leader runs the background loops
+# and every process serves maps from the state database
+MULTIPROCESS = os.environ.get("DEPLOYMENT_MODE", "single").lower() == "multiprocess"
+LEADER_LOCK_PATH = os.environ.get("LEADER_LOCK_PATH", f"{STATE_DB_PATH}.leader")
+LEASE_TTL = 60 * 10  # Seconds, longer than any canvas pass
+process_id = str(uuid4())
+
+DISCOVERY_PAGE_SIZE = 100  # Files per files.list page
+DISCOVERY_WORKERS = int(os.environ.get("DISCOVERY_WORKERS", 4))  # Canvases opened at the same time by the file check
+CANVAS_WORKERS = int(os.environ.get("CANVAS_WORKERS", 4))  # Canvases refreshed, and file changes handled, at the same time
+file_fingerprints = state_store.load_fingerprints()  # {file_id: fingerprint} as of the last file check
+
+
+def update_file(file_id: str, priority: Priority = Priority.BACKGROUND) -> bool:
+    """
+    Runs a pass for a canvas unless one is already running, here or in another process.
+    :return: Whether the pass ran.
+    """
+    if not MULTIPROCESS:
+        return update_canvas(file_id, priority)
+    # The lease keeps a pass from overlapping with one in another process, for example during a leader handover
+    if not state_store.acquire_lease(file_id, process_id, LEASE_TTL):
+        logging.warning(f"Canvas {file_id} is leased by another process, skipping")
+        return False
+    try:
+        return update_canvas(file_id, priority)
+    finally:
+        state_store.release_lease(file_id, process_id)
+
+
+def update_canvas(file_id: str, priority: Priority) -> bool:
     editor = CanvasEditor(
         app=app,
         file_id=file_id,
-        token=os.environ.get("SLACK_BOT_TOKEN")
+        token=os.environ.get("SLACK_BOT_TOKEN"),
+        priority=priority,
+        bot_id=bot_id
     )
+    if editor.skipped:
+        return False  # The pass that is already running schedules the next one
     if editor.get_result() == CanvasEditResult.CURRENTLY_TRACKING:
         if file_id not in tracked_files:
             tracked_files.append(file_id)
+            state_store.set_tracked(file_id, True)
             logging.info(f"Started tracking file: {file_id}")
         if editor.map_enabled():
-            tracking_map_data[file_id] = editor.get_map_data()
+            publish_map_data(file_id, editor.map_data)
+        canvas_scheduler.schedule(file_id, editor.next_refresh_interval())
     else:
         if file_id in tracked_files:
             tracked_files.remove(file_id)
+            state_store.set_tracked(file_id, False)
             logging.info(f"Stopped tracking file: {file_id}")
         if editor.map_enabled():
-            tracking_map_data[file_id] = editor.get_map_data()
+            publish_map_data(file_id, editor.map_data)
+        canvas_scheduler.unschedule(file_id)
+    return True
+
+
+def publish_map_data(file_id: str, map_data: Optional[MapDataStore]):
+    """
+    Makes the map data of a pass available to map clients, if its version is new.
+    """
+    if map_data is None:
+        return
+    data, version, payload = map_data.to_dict(), map_data.version, map_data.payload()
+    with map_states_lock:
+        map_state = map_states.setdefault(file_id, MapState())
+        changed = map_state.update(data, version, payload)
+    if changed:
+        state_store.save_map_data(file_id, data, version / 1000)
+        map_event_hub.publish(file_id, version)
 
 
+def refresh_tracked_file(file_id: str):
+    if file_id not in tracked_files:
+        return
+    try:
+        update_file(file_id)
+    except Exception as e:
+        logging.error(f"Error updating file {file_id}: {e}")
+        if os.environ.get("DEBUG", "false").lower() == "true":
+            print_exc()
+        canvas_scheduler.schedule(file_id, RETRY_INTERVAL)
 
-def update_tracked_files():
+
+canvas_scheduler = CanvasScheduler(
+    run=refresh_tracked_file,
+    workers=CANVAS_WORKERS,
+    retry_interval=RETRY_INTERVAL
+)
+
+
+def flight_cache_events():
+    stats = flight_data_cache.stats()
+    return {(event,): stats[event] for event in flight_data_cache.events}
+
+
+# Read when /metrics is requested
+CallbackMetric("tracked_files", "Canvases whose flights are being tracked", lambda: len(tracked_files))
+CallbackMetric(
+    "flight_cache_events_total", "Flight data cache events such as hits, misses and refreshes", flight_cache_events,
+    metric_type="counter", labels=("event",)
+)
+CallbackMetric("flight_cache_size", "Flights in the flight data cache", lambda: flight_data_cache.stats()["size"])
+
+
+def log_statistics():
     while True:
-        for file in tracked_files:
-            try:
-                update_file(file)
-            except Exception as e:
-                logging.error(f"Error updating file {file}: {e}")
-                if os.environ.get("DEBUG", "false").lower() == "true":
-                    print_exc()
+        time.sleep(60 * 5)
+        logging.info(f"Flight data cache: {flight_data_cache.stats()}")
+        logging.info(f"FlightAware rate governor: {flightaware_governor.stats()}")
+        logging.info(f"Unknown flight numbers: {len(unknown_flight_numbers)} cached")
+        logging.info(f"Slack API queues: {slack.stats()}")
+        logging.info(f"Canvas scheduler: {canvas_scheduler.stats()}")
+        logging.info(f"File change events: {file_change_coalescer.stats()}")
+        logging.info(f"Map event streams: {map_event_hub.stats()}")
 
-        time.sleep(60 * 2)  # Update every two minutes
+
+def list_canvas_files():
+    """
+    Yields every canvas file in the workspace, page by page.
+    """
+    page = 1
+    while True:
+        files_response = slack.call(
+            "files_list", Priority.BACKGROUND, types="canvas", count=DISCOVERY_PAGE_SIZE, page=page
+        )
+        if not files_response.get("ok", False):
+            logging.error("Failed to fetch files from Slack.")
+            return
+        yield from files_response.get("files", [])
+        if page >= files_response.get("paging", {}).get("pages", 1):
+            return
+        page += 1
+
+
+def discover_file(file_id: str, fingerprint: Optional[str]):
+    try:
+        ran = update_file(file_id)
+    except Exception as e:
+        logging.error(f"Error updating file {file_id}: {e}")
+        if os.environ.get("DEBUG", "false").lower() == "true":
+            print_exc()
+        return
+    if ran and fingerprint:  # A skipped pass has not seen the canvas, so it is checked again next time
+        file_fingerprints[file_id] = fingerprint
+        state_store.save_fingerprint(file_id, fingerprint)
 
 
 def check_all_files():
-    files_response = app.client.files_list(types="canvas")
-    if not files_response.get("ok", False):
-        logging.error("Failed to fetch files from Slack.")
-        return
-    files = files_response.get("files", [])
-    if not files:
-        logging.info("No canvas files found.")
-        return
-    for file in files:
+    """
+    Opens every canvas that is new or changed since the last check, and every canvas once a day.
+    Tracked canvases are skipped, as the scheduler already refreshes them.
+    Whether a canvas is tracked depends on the date as well as its content: a canvas set up ahead of its arrival
+    dates has to be opened again when they come, even if nobody edits it.
+    """
+    today = date.today().isoformat()
+    changed_files = []
+    files_seen = 0
+    for file in list_canvas_files():
         file_id = file.get("id")
         if not file_id:
             logging.warning("File without ID found, skipping.")
             continue
-        try:
-            update_file(file_id)
-        except Exception as e:
-            logging.error(f"Error updating file {file_id}: {e}")
-            if os.environ.get("DEBUG", "false").lower() == "true":
-                print_exc()
+        files_seen += 1
+        if file_id in tracked_files:
+            continue
+        revision = get_canvas_revision(file)
+        fingerprint = dumps([revision, today]) if revision else None
+        if fingerprint and file_fingerprints.get(file_id) == fingerprint:
+            continue
+        changed_files.append((file_id, fingerprint))
+    if not files_seen:
+        logging.info("No canvas files found.")
+        return
+    logging.info(f"Found {files_seen} canvas files, {len(changed_files)} new or changed")
+    with ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS) as executor:
+        for file_id, fingerprint in changed_files:
+            executor.submit(discover_file, file_id, fingerprint)
 
 
 def periodic_file_check():
@@ -100,8 +262,147 @@ def periodic_file_check():
         time.sleep(60 * 60 * 1)  # Check every hour
 
 
-threading.Thread(target=update_tracked_files, daemon=True).start()
-threading.Thread(target=periodic_file_check, daemon=True).start()
+def process_pending_updates():
+    """
+    Runs the canvas updates that file_change events asked for in any process.
+    """
+    while True:
+        try:
+            for file_id, event_at in state_store.take_pending_updates():
+                file_change_coalescer.submit(file_id, event_at)
+        except Exception as e:
+            logging.error(f"Error reading pending updates: {e}")
+        time.sleep(1)
+
+
+def handle_update_request(file_id: str):
+    try:
+        update_file(file_id, Priority.INTERACTIVE)
+    except Exception as e:
+        logging.error(f"Error handling file change for {file_id}: {e}")
+        if os.environ.get("DEBUG", "false").lower() == "true":
+            print_exc()
+
+
+def is_own_change(file_id: str, first_event_at: float, last_event_at: float) -> bool:
+    """
+    Checks whether file_change events were caused by the bot's last edit: Slack sent them just after the revision
+    the edit created, and that revision is still the current one.
+    Events from before the edit are the user's, even if the revision read after the edit includes them.
+    """
+    bot_edit = bot_revisions.get(file_id)
+    if not bot_edit or not bot_edit.covers(first_event_at, last_event_at):
+        return False
+    files_response = slack.call("files_info", Priority.INTERACTIVE, file=file_id)
+    return get_canvas_revision(files_response.get("file", {})) == bot_edit.revision
+
+
+file_change_coalescer = FileChangeCoalescer(
+    process=handle_update_request,
+    is_own_change=is_own_change,
+    is_busy=lambda file_id: file_id in locks,
+    debounce=float(os.environ.get("FILE_CHANGE_DEBOUNCE", 3)),
+    workers=CANVAS_WORKERS
+)
+
+
+def start_background_work():
+    # Passes from the scheduler, file change events and the file check each scrape with up to SCRAPE_CONCURRENCY
+    # threads, and stale flights are refreshed beside them
+    size_pool((CANVAS_WORKERS * 2 + DISCOVERY_WORKERS) * SCRAPE_CONCURRENCY + FLIGHT_REFRESH_WORKERS)
+    if MULTIPROCESS:
+        # The previous leader may have changed the tracked files since this process started
+        tracked_files[:] = state_store.load_tracked_files()
+        file_fingerprints.update(state_store.load_fingerprints())
+        threading.Thread(target=process_pending_updates, daemon=True).start()
+    for restored_file_id in tracked_files:
+        canvas_scheduler.schedule(restored_file_id)
+    flight_data_cache.start()
+    canvas_scheduler.start()
+    threading.Thread(target=log_statistics, daemon=True).start()
+    threading.Thread(target=periodic_file_check, daemon=True).start()
+
+
+def get_map_state(file_id: str) -> Optional[MapState]:
+    """
+    Returns the published map of a canvas, or None if it has no map.
+    Processes that do not update canvases load new versions from the state database.
+    """
+    if not MULTIPROCESS or leader_election.is_leader:
+        return map_states.get(file_id)
+    map_state = map_states.get(file_id)
+    stored = state_store.load_map(file_id, map_state.version / 1000 if map_state else None)
+    if not stored:
+        return None
+    updated_at, map_data = stored
+    if map_data is not None:
+        with map_states_lock:
+            map_state = map_states.setdefault(file_id, MapState())
+            map_state.update(map_data, round(updated_at * 1000))
+        map_event_hub.publish(file_id, map_state.version)
+    return map_state
+
+
+def watch_stored_maps():
+    """
+    Loads new versions of the maps that have connected event streams, so non-leader processes can push them.
+    """
+    while True:
+        time.sleep(MAP_EVENTS_POLL_INTERVAL)
+        for file_id in map_event_hub.watched_files():
+            try:
+                get_map_state(file_id)
+            except Exception as e:
+                logging.error(f"Error loading map data for {file_id}: {e}")
+
+
+def map_event_stream(file_id: str, version: Optional[int]):
+    """
+    Yields server-sent events for a map: the changes since the client's version whenever a new version is published,
+    or the full map data if the changes are unknown. Comments are sent while nothing changes.
+    """
+    yield f"retry: {MAP_EVENTS_RETRY}\n\n"
+    while True:
+        if version is not None and map_event_hub.wait(file_id, version, MAP_EVENTS_HEARTBEAT) <= version:
+            yield ": heartbeat\n\n"
+            continue
+        map_state = map_states.get(file_id)
+        if map_state is None:
+            return
+        with map_states_lock:
+            delta_body = map_state.delta_body(version) if version is not None else None
+            event = "changes" if delta_body is not None else "map"
+            data = delta_body if delta_body is not None else map_state.body
+            version = map_state.version
+        map_event_hub.count_event()
+        yield f"id: {version}\nevent: {event}\ndata: {data.decode()}\n\n"
+
+
+def json_response(body: bytes, compressed_body: bytes = b"", etag: Optional[str] = None) -> Response:
+    """
+    Builds a JSON response, compressed when the client accepts gzip, and answers conditional requests.
+    """
+    if "gzip" in request.accept_encodings and len(body) >= MIN_COMPRESSED_SIZE:
+        response = Response(compressed_body or gzip.compress(body), mimetype="application/json")
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(body, mimetype="application/json")
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "no-cache"
+    if etag:
+        response.set_etag(etag)
+        response.make_conditional(request)
+    return response
+
+
+if MULTIPROCESS:
+    leader_election = LeaderElection(LEADER_LOCK_PATH, on_elected=start_background_work)
+    leader_election.start()
+    threading.Thread(target=watch_stored_maps, daemon=True).start()
+else:
+    leader_election = None
+    start_background_work()
+
 
 def get_parcel_asset(file_name: str):
     with open("static/dist/parcel-manifest.json", "r") as f:
@@ -114,7 +415,7 @@ def get_parcel_asset(file_name: str):
 
 
 @app.event("file_change")
-def handle_file_change(event, say):
+def handle_file_change(event, body, say):
     """
     Handle file change events.
     """
@@ -122,12 +423,12 @@ def handle_file_change(event, say):
     if not file_id:
         logging.warning("No file_id found in the event.")
         return
-    try:
-        update_file(file_id)
-    except Exception as e:
-        logging.error(f"Error handling file change for {file_id}: {e}")
-        if os.environ.get("DEBUG", "false").lower() == "true":
-            print_exc()
+    # When Slack sent the event, by Slack's clock, which tells the user's edits from the bot's own
+    event_at = float(event.get("event_ts") or body.get("event_time") or 0)
+    if MULTIPROCESS:
+        state_store.request_update(file_id, event_at)  # The leader picks it up
+        return
+    file_change_coalescer.submit(file_id, event_at)
 
 
 @flask_app.route("/")
@@ -143,10 +444,11 @@ def map_view(file_id):
     """
     Serve the map view for a specific file.
     """
-    if file_id not in tracking_map_data:
+    map_state = get_map_state(file_id)
+    if map_state is None:
         logging.warning(f"File {file_id} is not being tracked.")
         return render_template("map_404.html"), 404
-    map_data = tracking_map_data[file_id]
+    map_data = {**map_state.data, "version": map_state.version}
 
     return render_template("map.html", server_data=map_data,
                            index_file=get_parcel_asset("index.ts"))
@@ -156,14 +458,67 @@ def map_view(file_id):
 def map_api(file_id):
     """
     API endpoint to get the map data for a specific file.
+    Supports ETag/If-None-Match, and `?since=<version>` to get only the flights that changed after a version.
+    """
+    if file_id == "default" and "DEFAULT_FILE_ID" in os.environ:
+        file_id = os.environ["DEFAULT_FILE_ID"]
+    map_state = get_map_state(file_id)
+    if map_state is None:
+        logging.warning(f"File {file_id} is not being tracked.")
+        return {"error": "File not found"}, 404
+    since = request.args.get("since", type=int)
+    with map_states_lock:
+        delta_body = map_state.delta_body(since) if since is not None else None
+        version = map_state.version
+        body = map_state.body
+        compressed_body = map_state.compressed_body
+    if delta_body is not None:
+        return json_response(delta_body, etag=f"{version}-{since}")
+    return json_response(body, compressed_body, etag=str(version))
+
+
+@flask_app.route("/api/map/<file_id>/events")
+def map_events(file_id):
+    """
+    Server-sent events with the flights that changed whenever the map data of a file changes.
+    Resumes from `Last-Event-ID` or `?since=<version>`; without either, the full map data is sent first.
     """
     if file_id == "default" and "DEFAULT_FILE_ID" in os.environ:
         file_id = os.environ["DEFAULT_FILE_ID"]
-    if file_id not in tracking_map_data:
+    if get_map_state(file_id) is None:
         logging.warning(f"File {file_id} is not being tracked.")
         return {"error": "File not found"}, 404
-    map_data = tracking_map_data[file_id]
-    return map_data, 200
+    version = request.headers.get("Last-Event-ID", type=int) or request.args.get("since", type=int)
+    if not map_event_hub.try_connect(file_id):
+        return {"error": "Too many clients, poll /api/map instead"}, 503, {"Retry-After": "60"}
+    response = Response(map_event_stream(file_id, version), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # Stops nginx from buffering the stream
+    response.call_on_close(lambda: map_event_hub.disconnect(file_id))
+    return response
+
+
+@flask_app.route("/metrics")
+def metrics():
+    """
+    Returns the metrics of this process in the Prometheus text format.
+    """
+    return Response(metrics_registry.render(), content_type=CONTENT_TYPE)
+
+
+@flask_app.route("/debug/passes")
+def debug_passes():
+    """
+    Returns the slowest recent canvas passes of this process with their span trees.
+    Only available when DEBUG_TOKEN is set, with ?token=<DEBUG_TOKEN>. `?limit=` sets how many passes are returned.
+    """
+    debug_token = os.environ.get("DEBUG_TOKEN")
+    if not debug_token:
+        return "Not found", 404
+    if request.args.get("token") != debug_token:
+        return "Invalid token", 403
+    limit = request.args.get("limit", 10, type=int)
+    return {**slow_pass_recorder.stats(), "passes": slow_pass_recorder.slowest(limit)}
 
 
 @flask_app.route("/slack/events", methods=["POST"])
@@ -0,0 +1,125 @@
+import threading
+from json import dumps
+from typing import Any
+
+from map_state import new_version
+
+
+class MapDataStore:
+    """
+    The map data of a canvas, kept between passes.
+    Flights are indexed by identifier and airports by coordinates, so updating a flight does not scan the map,
+    and entries keep their position when they are updated.
+    The version changes only when the data does, and the serialised payload is rebuilt only for new versions.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.sections: dict[str, Any] = {}  # Top-level keys other than flights and airports
+        self.flights: dict[str, dict] = {}  # Flight identifier: flight entry
+        self.airports: dict[tuple[float, float], dict] = {}  # (lat, lon): airport entry
+        self.airport_references: dict[tuple[float, float], int] = {}  # (lat, lon): number of flights using it
+        self.seen_flights: set[str] = set()  # Flights updated during the current pass
+        self.cached_version = -1
+        self.cached_data: dict = {}
+        self.cached_payload = b""
+
+    def changed(self):
+        self.version = new_version(self.version)
+
+    def set_section(self, key: str, value: Any):
+        if key not in self.sections or self.sections[key] != value:
+            self.sections[key] = value
+            self.changed()
+
+    def begin_pass(self):
+        """
+        Starts collecting the flights of a pass. Flights that are not updated before end_pass are removed.
+        """
+        self.seen_flights = set()
+
+    def end_pass(self):
+        for identifier in self.flights.keys() - self.seen_flights:
+            self.remove_flight(identifier)
+
+    def add_airport_reference(self, airport: dict):
+        key = (airport["lat"], airport["lon"])
+        if self.airports.get(key) != airport:
+            self.airports[key] = airport
+            self.changed()
+        self.airport_references[key] = self.airport_references.get(key, 0) + 1
+
+    def remove_airport_reference(self, airport: dict):
+        key = (airport["lat"], airport["lon"])
+        self.airport_references[key] -= 1
+        if not self.airport_references[key]:
+            del self.airport_references[key]
+            del self.airports[key]
+            self.changed()
+
+    def update_flight(self, flight: dict):
+        """
+        Adds a flight entry, or replaces the entry with the same identifier in place.
+        The airports of the flight are added to the map, and airports no flight uses any more are removed.
+        """
+        identifier = flight["identifier"]
+        self.seen_flights.add(identifier)
+        existing_flight = self.flights.get(identifier)
+        if existing_flight == flight:
+            return
+        self.add_airport_reference(flight["origin"])
+        self.add_airport_reference(flight["destination"])
+        if existing_flight:
+            self.remove_airport_reference(existing_flight["origin"])
+            self.remove_airport_reference(existing_flight["destination"])
+        self.flights[identifier] = flight
+        self.changed()
+
+    def remove_flight(self, identifier: str):
+        flight = self.flights.pop(identifier, None)
+        if flight:
+            self.remove_airport_reference(flight["origin"])
+            self.remove_airport_reference(flight["destination"])
+            self.changed()
+
+    def refresh_cache(self):
+        if self.cached_version == self.version:
+            return
+        self.cached_data = {
+            **self.sections,
+            "airports": list(self.airports.values()),
+            "flights": list(self.flights.values())
+        }
+        self.cached_payload = dumps({**self.cached_data, "version": self.version}).encode()
+        self.cached_version = self.version
+
+    def to_dict(self) -> dict:
+        """
+        Returns the map data in the format served to map clients. The dictionary must not be modified.
+        """
+        self.refresh_cache()
+        return self.cached_data
+
+    def payload(self) -> bytes:
+        """
+        Returns the map data and its version as JSON.
+        """
+        self.refresh_cache()
+        return self.cached_payload
+
+
+map_data_stores: dict[str, MapDataStore] = {}  # {file_id: MapDataStore}
+map_data_stores_lock = threading.Lock()
+
+
+def get_map_data_store(file_id: str) -> MapDataStore:
+    """
+    Returns the map data store of a canvas, creating it on first use.
+    Only the pass that holds the canvas lock modifies a store.
+    """
+    with map_data_stores_lock:
+        store = map_data_stores.get(file_id)
+        if store is None:
+            store = map_data_stores[file_id] = MapDataStore()
+        return store
+
@@ -0,0 +1,94 @@
+import threading
+
+from green_threads import threads_are_green
+
+GREEN_MAX_CLIENTS = 1000  # Streams per process when each is a greenlet
+THREAD_MAX_CLIENTS = 8  # Streams per process when each holds a server thread, see gunicorn_bot.conf.py
+
+
+def default_max_clients() -> int:
+    """
+    Returns how many streams a process serves by default. Under a threaded server (the Flask development server,
+    gunicorn's sync and gthread workers) each stream holds a thread until it closes, so only a few are served,
+    leaving the rest of the threads to Slack events and map requests. Other clients poll.
+    """
+    return GREEN_MAX_CLIENTS if threads_are_green() else THREAD_MAX_CLIENTS
+
+
+class MapEventHub:
+    """
+    Wakes the map event streams of a canvas when its map gets a new version.
+    Streams only wait on a condition, so with a cooperative server (e.g. gunicorn's gevent worker)
+    each connected client costs a greenlet rather than a thread.
+    """
+
+    def __init__(self, max_clients: int):
+        """
+        :param max_clients: The number of streams served at the same time. Further clients are turned away
+            and keep polling instead.
+        """
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        self.conditions: dict[str, threading.Condition] = {}  # File ID: condition notified on new versions
+        self.versions: dict[str, int] = {}  # File ID: latest published version
+        self.clients: dict[str, int] = {}  # File ID: number of connected streams
+        self.events_sent = 0
+
+    def publish(self, file_id: str, version: int):
+        """
+        Records a new map version and wakes the streams of the canvas.
+        """
+        with self.lock:
+            if version <= self.versions.get(file_id, 0):
+                return
+            self.versions[file_id] = version
+            condition = self.conditions.get(file_id)
+            if condition:
+                condition.notify_all()
+
+    def wait(self, file_id: str, version: int, timeout: float) -> int:
+        """
+        Blocks until the map of the canvas is newer than the given version, or the timeout expires.
+        :return: The latest published version.
+        """
+        with self.lock:
+            condition = self.conditions.setdefault(file_id, threading.Condition(self.lock))
+            condition.wait_for(lambda: self.versions.get(file_id, 0) > version, timeout)
+            return self.versions.get(file_id, 0)
+
+    def try_connect(self, file_id: str) -> bool:
+        """
+        Registers a stream for the canvas. It must be disconnected once the response is closed.
+        :return: True if the stream may be served, False if there are too many clients.
+        """
+        with self.lock:
+            if sum(self.clients.values()) >= self.max_clients:
+                return False
+            self.clients[file_id] = self.clients.get(file_id, 0) + 1
+            return True
+
+    def disconnect(self, file_id: str):
+        with self.lock:
+            self.clients[file_id] -= 1
+            if not self.clients[file_id]:
+                del self.clients[file_id]
+                self.conditions.pop(file_id, None)
+
+    def watched_files(self) -> list[str]:
+        """
+        Returns the canvases that have at least one connected stream.
+        """
+        with self.lock:
+            return list(self.clients)
+
+    def count_event(self):
+        with self.lock:
+            self.events_sent += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "clients": sum(self.clients.values()),
+                "canvases": len(self.clients),
+                "events_sent": self.events_sent
+            }
@@ -0,0 +1,108 @@
+import gzip
+import time
+from json import dumps
+from typing import Optional
+
+MIN_COMPRESSED_SIZE = 1024  # Bytes, smaller responses are sent uncompressed
+MAX_CACHED_DELTAS = 16  # Serialised deltas kept per version
+
+
+def new_version(previous: int = 0) -> int:
+    """
+    Returns a version number greater than the previous one.
+    Versions are millisecond timestamps, so they keep increasing across restarts and processes.
+    """
+    return max(previous + 1, int(time.time() * 1000))
+
+
+class MapState:
+    """
+    The published map data of a canvas, with a version that changes whenever the data does.
+    Remembers the version in which each flight last changed, so clients can ask only for what changed since their copy.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.data: dict = {}
+        self.first_version = 0  # Changes since versions older than this are unknown
+        self.section_versions: dict[str, int] = {}  # Top-level key: version it last changed in (except flights)
+        self.flight_versions: dict[str, int] = {}  # Flight identifier: version it last changed in
+        self.removed_flights: dict[str, int] = {}  # Flight identifier: version it was removed in
+        self.body = b""
+        self.compressed_body = b""
+        self.delta_bodies: dict[int, bytes] = {}  # Since version: serialised delta to the current version
+
+    def update(self, data: dict, version: Optional[int] = None, body: Optional[bytes] = None) -> bool:
+        """
+        Publishes new map data.
+        :param data: The map data of the canvas.
+        :param version: The version to use, for data that was versioned elsewhere (e.g. by another process).
+            Data with the current version is assumed to be unchanged.
+        :param body: The data and its version as JSON, if it was already serialised.
+        :return: True if the data changed and a new version was created, False otherwise.
+        """
+        if version is not None and version == self.version:
+            return False
+        if version is None and data == self.data and self.version:
+            return False
+        version = version or new_version(self.version)
+        if not self.version:
+            self.first_version = version
+        old_flights = {flight["identifier"]: flight for flight in self.data.get("flights", [])}
+        new_flights = {flight["identifier"]: flight for flight in data.get("flights", [])}
+        for identifier, flight in new_flights.items():
+            if old_flights.get(identifier) != flight:
+                self.flight_versions[identifier] = version
+            self.removed_flights.pop(identifier, None)
+        for identifier in old_flights.keys() - new_flights.keys():
+            self.flight_versions.pop(identifier, None)
+            self.removed_flights[identifier] = version
+        for key in data.keys() | self.data.keys():
+            if key != "flights" and data.get(key) != self.data.get(key):
+                self.section_versions[key] = version
+        self.version = version
+        self.data = data
+        self.body = body or dumps({**data, "version": version}).encode()
+        self.compressed_body = gzip.compress(self.body) if len(self.body) >= MIN_COMPRESSED_SIZE else b""
+        self.delta_bodies = {}
+        return True
+
+    def delta(self, since: int) -> Optional[dict]:
+        """
+        Returns the flights that changed after the given version, along with any other sections that changed.
+        :param since: The version the client has.
+        :return: The changes, or None if they are unknown and the client needs the full data.
+        """
+        if since < self.first_version or since > self.version:
+            return None
+        changes = {
+            key: self.data.get(key)
+            for key, version in self.section_versions.items()
+            if version > since and key in self.data
+        }
+        changes["version"] = self.version
+        changes["since"] = since
+        changes["flights"] = [
+            flight for flight in self.data.get("flights", [])
+            if self.flight_versions.get(flight["identifier"], 0) > since
+        ]
+        changes["removedFlights"] = [
+            identifier for identifier, version in self.removed_flights.items() if version > since
+        ]
+        return changes
+
+    def delta_body(self, since: int) -> Optional[bytes]:
+        """
+        Returns the serialised delta since the given version. Clients usually have the same version,
+        so each delta is only serialised once.
+        :return: The JSON of the changes, or None if the client needs the full data.
+        """
+        if since in self.delta_bodies:
+            return self.delta_bodies[since]
+        changes = self.delta(since)
+        if changes is None:
+            return None
+        body = dumps(changes).encode()
+        if len(self.delta_bodies) < MAX_CACHED_DELTAS:
+            self.delta_bodies[since] = body
+        return body
@@ -0,0 +1,163 @@
+import threading
+from bisect import bisect_left
+from typing import Callable, Iterator, Optional, Union
+
+# Seconds, from a cached lookup to a slow page behind a rate limit
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in values
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A metric in the Prometheus text format. Values are kept per combination of label values.
+    Recording takes a lock and a dictionary lookup, so metrics can stay on in hot loops.
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (),
+                 registry: Optional["MetricsRegistry"] = None):
+        """
+        :param name: The metric name, e.g. "flightaware_requests_total".
+        :param documentation: The help text.
+        :param labels: The label names. Every recording must give a value for each.
+        :param registry: The registry the metric is exported by, the process-wide one by default.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        (registry or metrics_registry).register(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self) -> Iterator[tuple[str, tuple, tuple, float]]:
+        """
+        Yields the samples of the metric as (name, label names, label values, value).
+        """
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, label_names, label_values, value in self.samples():
+            lines.append(f"{name}{format_labels(label_names, label_values)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield self.name, self.labels, key, value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: tuple = DEFAULT_BUCKETS, **kwargs):
+        """
+        :param buckets: The upper bounds of the buckets, in increasing order. +Inf is added.
+        """
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        self.values: dict[tuple, list] = {}  # Label values: [count per bucket (not cumulative), +Inf count, sum]
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+        bucket_labels = self.labels + ("le",)
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", bucket_labels, key + (format_value(bound),), cumulative
+            yield f"{self.name}_count", self.labels, key, cumulative
+            yield f"{self.name}_sum", self.labels, key, counts[-1]
+
+
+class CallbackMetric(Metric):
+    """
+    A metric read from existing state when the metrics are collected, such as a queue's length or a cache's counters.
+    Nothing is recorded in the code paths being measured.
+    """
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], Union[float, dict[tuple, float]]],
+                 metric_type: str = "gauge", **kwargs):
+        """
+        :param function: Returns the value, or a dictionary from label values to values if the metric has labels.
+        :param metric_type: "gauge", or "counter" for totals that only increase.
+        """
+        self.function = function
+        self.type = metric_type
+        super().__init__(name, documentation, **kwargs)
+
+    def samples(self):
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            yield self.name, self.labels, key, value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics_registry = MetricsRegistry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -1,5 +1,11 @@
+from re import compile
+
 from bs4 import BeautifulSoup, PageElement
 
+markdown_link_pattern = compile(r'\[([^\]]*)\]\([^)]*\)')
+markdown_formatting_pattern = compile(r'\*\*|__|~~|`')
+whitespace_pattern = compile(r'\s+')
+
 
 # TODO: Add documentation
 
@@ -28,3 +34,35 @@ def parse_canvas(content: str) -> list[CanvasLine]:
         if canvas_line.text:  # Only add non-empty lines
             canvas_lines.append(canvas_line)
     return canvas_lines
+
+
+def normalize_canvas_text(text: str) -> str:
+    """
+    Normalizes rendered canvas text for comparison.
+    Slack splits formatted text into separate elements, so whitespace is not reliable and is removed entirely.
+    :param text: The rendered text of a canvas line.
+    :return: The normalized text.
+    """
+    return whitespace_pattern.sub('', text.replace('\xa0', ' '))
+
+
+def markdown_to_canvas_text(markdown: str) -> str:
+    """
+    Converts markdown to the text Slack shows once the markdown is rendered in a canvas.
+    Only the formatting used in flight info messages (links, bold, strikethrough and code) is handled.
+    :param markdown: The markdown to convert.
+    :return: The normalized visible text.
+    """
+    text = markdown_link_pattern.sub(r'\1', markdown)
+    text = markdown_formatting_pattern.sub('', text)
+    return normalize_canvas_text(text)
+
+
+def canvas_line_matches(line: CanvasLine, markdown: str) -> bool:
+    """
+    Checks whether writing the markdown to the line would change what the canvas shows.
+    :param line: The existing canvas line.
+    :param markdown: The markdown that would replace the line.
+    :return: True if the visible text is the same, False otherwise.
+    """
+    return normalize_canvas_text(line.text) == markdown_to_canvas_text(markdown)
@@ -0,0 +1,122 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+
+class GovernorOverloaded(Exception):
+    """
+    Raised instead of queueing a request that would wait longer than the governor allows.
+    """
+
+
+class RateGovernor:
+    """
+    Limits the rate of requests to a host with a token bucket shared by every caller in the process.
+
+    Callers reserve a token and sleep until it is due, so the governor works for threads and coroutines alike.
+    The rate adapts to the host: it is halved on 429 and 5xx responses and grows back slowly with each success,
+    and Retry-After pauses all requests. Requests that would wait longer than max_delay are refused.
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, min_rate: float, max_delay: float,
+                 rate_increase: float = 0.05):
+        """
+        :param name: The name used in logs.
+        :param rate: The highest rate, in requests per second. The governor starts at this rate.
+        :param burst: The number of requests that may be sent at once after a quiet period.
+        :param min_rate: The rate is not lowered below this.
+        :param max_delay: Seconds a request may wait for its turn before it is refused.
+        :param rate_increase: Requests per second added to the rate after each successful response.
+        """
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_delay = max_delay
+        self.rate_increase = rate_increase
+        self.lock = threading.Lock()
+        self.tokens = float(burst)  # Negative when requests are waiting for their turn
+        self.updated_at = time.monotonic()  # Tokens accrue from this time, which is in the future during a pause
+        self.counters = {"requests": 0, "throttled": 0, "shed": 0}
+
+    def refill(self, now: float):
+        if now > self.updated_at:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def delay(self, now: float) -> float:
+        """
+        Returns how long a request reserved now would wait. Called with the lock held.
+        """
+        self.refill(now)
+        return max(0.0, self.updated_at - now) + max(0.0, 1 - self.tokens) / self.rate
+
+    def reserve(self) -> float:
+        """
+        Reserves a request.
+        :return: Seconds the caller must wait before sending it.
+        :raises GovernorOverloaded: If the request would wait longer than max_delay.
+        """
+        with self.lock:
+            delay = self.delay(time.monotonic())
+            if delay > self.max_delay:
+                self.counters["shed"] += 1
+                raise GovernorOverloaded(f"Too many requests queued for {self.name}, try again later")
+            self.tokens -= 1
+            self.counters["requests"] += 1
+            return delay
+
+    def cancel(self):
+        """
+        Gives back a reservation whose request will not be sent.
+        """
+        with self.lock:
+            self.tokens += 1
+            self.counters["requests"] -= 1
+
+    def wait(self):
+        """
+        Blocks until a request may be sent.
+        :raises GovernorOverloaded: If the request would wait longer than max_delay.
+        """
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def record(self, status_code: int, retry_after: Optional[float] = None):
+        """
+        Adapts the rate to a response from the host.
+        """
+        with self.lock:
+            if status_code == 429 or status_code >= 500:
+                self.counters["throttled"] += 1
+                self.rate = max(self.min_rate, self.rate / 2)
+                if retry_after:
+                    now = time.monotonic()
+                    self.refill(now)
+                    self.updated_at = max(self.updated_at, now + retry_after)
+                    self.tokens = min(self.tokens, 0.0)
+                logging.warning(f"{self.name} returned {status_code}, lowering the request rate to {self.rate:.2f}/s")
+            elif status_code < 400:
+                self.rate = min(self.max_rate, self.rate + self.rate_increase)
+
+    def overloaded(self) -> bool:
+        """
+        Whether requests are queued for more than half of max_delay. Optional work should then be skipped.
+        """
+        with self.lock:
+            return self.delay(time.monotonic()) > self.max_delay / 2
+
+    def stats(self) -> dict:
+        with self.lock:
+            now = time.monotonic()
+            delay = self.delay(now)
+            return {
+                **self.counters,
+                "rate": self.rate,
+                "queue_depth": max(0, -int(self.tokens)),
+                "queue_delay": delay,
+                "paused_for": max(0.0, self.updated_at - now)
+            }
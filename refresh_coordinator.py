@@ -0,0 +1,130 @@
+import heapq
+import itertools
+import logging
+import threading
+from typing import Callable, Optional
+
+
+class _InFlight:
+    """
+    A fetch that is currently running. Other callers for the same key wait on it instead of fetching again.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Optional[dict] = None
+        self.error: Optional[Exception] = None
+
+
+class RefreshCoordinator:
+    """
+    Runs fetches so that at most one is in flight per key.
+
+    Foreground fetches run in the caller's thread, and concurrent callers for the same key wait for that result.
+    Background refreshes of stale data are queued and run by a fixed number of workers, most requested key first.
+    """
+
+    def __init__(self, fetch: Callable[[str], Optional[dict]], workers: int, max_queued: int):
+        """
+        :param fetch: Fetches and stores the data for a key.
+        :param workers: The number of background refreshes run at the same time.
+        :param max_queued: The number of keys waiting for a background refresh. Further requests are dropped
+            until the queue drains, and are made again by the next request that finds the data stale.
+        """
+        self.fetch = fetch
+        self.workers = workers
+        self.max_queued = max_queued
+        self.condition = threading.Condition()
+        self.in_flight: dict[str, _InFlight] = {}
+        self.queued: dict[str, int] = {}  # Key: number of requests that asked for its refresh
+        self.queue: list[tuple[int, int, str]] = []  # (-requests, sequence, key), outdated entries are skipped
+        self.sequence = itertools.count()
+        self.counters = {
+            "fetches": 0,
+            "coalesced": 0,
+            "refreshes": 0,
+            "refreshes_dropped": 0
+        }
+
+    def start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Fetches the data for a key now, or waits for the fetch that is already running for it.
+        A queued background refresh of the key is taken over by this fetch.
+        """
+        with self.condition:
+            pending = self.in_flight.get(key)
+            if pending:
+                self.counters["coalesced"] += 1
+                owner = False
+            else:
+                self.counters["fetches"] += 1
+                pending = self.in_flight[key] = _InFlight()
+                self.queued.pop(key, None)
+                owner = True
+        if owner:
+            self.run(key, pending)
+        else:
+            pending.event.wait()
+        if pending.error:
+            raise pending.error
+        return pending.result
+
+    def request_refresh(self, key: str):
+        """
+        Queues a background refresh of a key. Each request for a queued key moves it up the queue.
+        """
+        with self.condition:
+            if key in self.in_flight:
+                return
+            if key not in self.queued and len(self.queued) >= self.max_queued:
+                self.counters["refreshes_dropped"] += 1
+                return
+            self.queued[key] = self.queued.get(key, 0) + 1
+            heapq.heappush(self.queue, (-self.queued[key], next(self.sequence), key))
+            self.condition.notify()
+
+    def next_refresh(self) -> tuple[str, _InFlight]:
+        """
+        Blocks until a key is queued, then marks the most requested one as in flight.
+        """
+        with self.condition:
+            while True:
+                while self.queue:
+                    requests, _, key = heapq.heappop(self.queue)
+                    if self.queued.get(key) != -requests:
+                        continue  # Requested again since, or taken over by a foreground fetch
+                    del self.queued[key]
+                    self.counters["refreshes"] += 1
+                    pending = self.in_flight[key] = _InFlight()
+                    return key, pending
+                self.condition.wait()
+
+    def worker(self):
+        while True:
+            key, pending = self.next_refresh()
+            self.run(key, pending)
+            if pending.error:
+                # The stale data keeps being served, and the next request queues another refresh
+                logging.error(f"Background refresh for {key} failed: {pending.error}")
+
+    def run(self, key: str, pending: _InFlight):
+        try:
+            pending.result = self.fetch(key)
+        except Exception as e:
+            pending.error = e
+        finally:
+            with self.condition:
+                self.in_flight.pop(key, None)
+            pending.event.set()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                **self.counters,
+                "in_flight": len(self.in_flight),
+                "queued": len(self.queued)
+            }
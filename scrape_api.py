@@ -1,19 +1,30 @@
+import asyncio
+import math
 import os
 import threading
 import time
+from collections import Counter
+from contextlib import nullcontext
 from json import dumps
 from os import environ
-from queue import Queue
+from queue import Empty, Queue
 from uuid import uuid4
 
-from cachetools import TTLCache, cached
 from dotenv import load_dotenv
 from flask import Flask, request, Response
 
-from scrape_flightaware import get_flight_ident, get_flight_data
+from http_transport import size_pool
+from metrics import CONTENT_TYPE, CallbackMetric, metrics_registry
+from refresh_coordinator import RefreshCoordinator
+from shared_cache import SharedTTLCache
+from scrape_flightaware import UNKNOWN_FLIGHT_NUMBER_TTL, flightaware_governor, get_flight_ident, get_flight_data
 
 load_dotenv()
 
+SCRAPE_ENGINE = environ.get("SCRAPE_ENGINE", "threads").lower()  # "threads" or "async"
+if SCRAPE_ENGINE == "async":
+    from async_scrape import AsyncScrapeEngine  # Needs the async extra
+
 app = Flask(__name__)
 
 secret_tokens = environ.get("SECRET_TOKENS", "").split(",")
@@ -29,107 +40,349 @@ def validate_token(token):
 
 FLIGHT_DATA_TTL = 60 * 5
 STALE_DATA_TTL = 60 * 15
+REFRESH_WORKERS = int(environ.get("REFRESH_WORKERS", 4))  # Stale flights refreshed in the background at the same time
+REFRESH_QUEUE_SIZE = int(environ.get("REFRESH_QUEUE_SIZE", 256))  # Stale flights waiting for a background refresh
+
+MAX_QUEUED_TASKS = int(environ.get("MAX_QUEUED_TASKS", 1000))  # Flights waiting to be scraped before requests are refused
+REQUEST_TIMEOUT = int(environ.get("REQUEST_TIMEOUT", 480))  # Seconds a scrape request may take at most
+FETCH_CLAIM_TTL = 30  # Seconds other worker processes wait for a fetch before making their own
 
-ident_cache = TTLCache(maxsize=2048, ttl=60 * 60 * 24 * 7)
-ident_cache_lock = threading.Lock()
+# Shared by the gunicorn workers, so each flight is fetched once rather than once per worker
+SCRAPE_CACHE_PATH = environ.get("SCRAPE_CACHE_PATH", "scrape_cache.db")
 
-flight_data_cache = TTLCache(maxsize=1024, ttl=STALE_DATA_TTL)
-flight_data_cache_lock = threading.Lock()
+ident_cache = SharedTTLCache(SCRAPE_CACHE_PATH, "ident", maxsize=2048, ttl=60 * 60 * 24 * 7)
+# Flight numbers omnisearch found no flight for, kept for less time as the flight may be scheduled later
+unknown_ident_cache = SharedTTLCache(SCRAPE_CACHE_PATH, "unknown_ident", maxsize=4096, ttl=UNKNOWN_FLIGHT_NUMBER_TTL)
+
+flight_data_cache = SharedTTLCache(SCRAPE_CACHE_PATH, "flight_data", maxsize=1024, ttl=STALE_DATA_TTL)
 
 task_queue = Queue()
-results = {}
 
 
-@cached(ident_cache, lock=ident_cache_lock)
+class ScrapeRequest:
+    """
+    The state of a streaming scrape request. Its tasks are dropped by the workers once it is cancelled or past its
+    deadline, before they make any network request.
+    """
+
+    def __init__(self, request_id, total, timeout):
+        self.request_id = request_id
+        self.results = Queue()
+        self.created_at = time.time()
+        self.deadline = self.created_at + timeout
+        self.cancelled = threading.Event()  # Set when the stream closes
+        self.lock = threading.Lock()
+        self.counts = {"queued": total, "running": 0, "completed": 0, "dropped": 0}
+        self.futures = []  # Tasks on the async engine, cancelled when the stream closes
+
+    def is_abandoned(self):
+        return self.cancelled.is_set() or time.time() > self.deadline
+
+    def move(self, from_state, to_state):
+        with self.lock:
+            self.counts[from_state] -= 1
+            self.counts[to_state] += 1
+
+    def status(self):
+        with self.lock:
+            return {
+                **self.counts,
+                "age": time.time() - self.created_at,
+                "remaining_time": max(0.0, self.deadline - time.time())
+            }
+
+
+scrape_requests = {}  # {request_id: ScrapeRequest}
+dropped_tasks = Counter()  # Reason: tasks dropped without being run
+dropped_tasks_lock = threading.Lock()
+
+
+def queued_tasks():
+    """
+    Returns the number of flights of open requests that are waiting to be scraped.
+    """
+    return sum(scrape_request.status()["queued"] for scrape_request in list(scrape_requests.values()))
+
+
+def cache_event_counts():
+    """
+    Returns the hits, misses and other events of the shared caches, added up across worker processes.
+    """
+    caches = {"ident": ident_cache, "unknown_ident": unknown_ident_cache, "flight_data": flight_data_cache}
+    return {
+        (name, event): count
+        for name, cache in caches.items()
+        for event, count in sum(cache.process_counts().values(), Counter()).items()
+    }
+
+
+# Read when /metrics is requested, so the request path records nothing extra
+CallbackMetric(
+    "scrape_cache_events_total", "Shared cache events such as hits and misses, across worker processes",
+    cache_event_counts, metric_type="counter", labels=("cache", "event")
+)
+CallbackMetric("scrape_task_queue_depth", "Scrape tasks waiting for a worker thread", lambda: task_queue.qsize())
+CallbackMetric("scrape_queued_tasks", "Flights of open requests waiting to be scraped", queued_tasks)
+CallbackMetric("scrape_open_requests", "Scrape requests that are still streaming", lambda: len(scrape_requests))
+CallbackMetric(
+    "scrape_dropped_tasks_total", "Scrape tasks dropped without being run, by reason",
+    lambda: {(reason,): count for reason, count in dropped_tasks.items()}, metric_type="counter", labels=("reason",)
+)
+
+
+
+
 def cached_get_flight_ident(flight_number):
-    return get_flight_ident(flight_number)
+    ident = ident_cache.get(flight_number)
+    if not ident:
+        ident = get_flight_ident(flight_number, unknown_ident_cache, nullcontext())  # The shared cache has its own lock
+        if ident:
+            ident_cache[flight_number] = ident
+    return ident
 
 
-def _background_refresh_flight_data(ident):
+def fetch_flight_data(ident):
     """
-    Worker function to fetch fresh data and update the cache in the background.
-    This runs in a separate thread and does not block the user's request.
+    Fetches fresh data and updates the cache. If the fetch fails, the old data persists.
+    If another worker process is already fetching the ident, its result is used instead.
     """
+    started = time.time()
+    if not flight_data_cache.claim(ident, FETCH_CLAIM_TTL):
+        entry = flight_data_cache.wait_for(ident, newer_than=started - FLIGHT_DATA_TTL, timeout=FETCH_CLAIM_TTL)
+        if entry:
+            flight_data_cache.count("fetched_by_other_worker")
+            return entry[0][0]
     try:
         fresh_data = get_flight_data(ident)
         if fresh_data:
-            with flight_data_cache_lock:
-                flight_data_cache[ident] = (fresh_data, time.time())
-    except Exception as e:
-        # Log the error but don't crash the thread. The old data will persist.
-        print(f"Background refresh for ident {ident} failed: {e}")
+            store_flight_data(ident, fresh_data)
+        return fresh_data
+    finally:
+        flight_data_cache.release(ident)
 
 
-def get_full_flight_data(flight_number):
-    ident = cached_get_flight_ident(flight_number)
-    if not ident:
-        return None
+def store_flight_data(ident, fresh_data):
+    flight_data_cache[ident] = (fresh_data, time.time())
+
+
+# At most one fetch runs per ident: concurrent requests share it, and stale data is refreshed by a bounded pool,
+# most requested flight first
+refresh_coordinator = RefreshCoordinator(fetch_flight_data, workers=REFRESH_WORKERS, max_queued=REFRESH_QUEUE_SIZE)
+
+# Runs scrape requests as coroutines instead of on the worker threads
+async_engine = AsyncScrapeEngine(
+    concurrency=int(environ.get("ASYNC_CONCURRENCY", 200)),
+    parse_workers=int(environ.get("PARSE_WORKERS", 2)),
+    cache_workers=int(environ.get("CACHE_WORKERS", 4))
+) if SCRAPE_ENGINE == "async" else None
 
-    with flight_data_cache_lock:
-        cached_item = flight_data_cache.get(ident)
+
+def cached_flight_data(ident):
+    """
+    Returns the cached data for an ident, and refreshes it in the background if it is stale.
+    :return: The cached data, or None if it has to be fetched now.
+    """
+    cached_item = flight_data_cache.get(ident)
 
     now = time.time()
 
     # Data is older than 15 mins
     if not cached_item or (now - cached_item[1]) > STALE_DATA_TTL:
-        fresh_data = get_flight_data(ident)
-        if fresh_data:
-            with flight_data_cache_lock:
-                flight_data_cache[ident] = (fresh_data, now)
-        return fresh_data
+        return None
 
     cached_data, fetch_time = cached_item
     age = now - fetch_time
 
     # Data is stale (> 5 mins old but < 15 mins old)
     if age > FLIGHT_DATA_TTL:
-        # Start a new thread so the current request is not blocked
-        threading.Thread(
-            target=_background_refresh_flight_data,
-            args=(ident,),
-            daemon=True
-        ).start()
+        flight_data_cache.count("stale_hits")
+        # Refresh in the background so the current request is not blocked, unless FlightAware is already busy
+        if not flightaware_governor.overloaded():
+            refresh_coordinator.request_refresh(ident)
 
     # Return cached data
     return cached_data
 
 
+def get_full_flight_data(flight_number):
+    ident = cached_get_flight_ident(flight_number)
+    if not ident:
+        return None
+
+    return cached_flight_data(ident) or refresh_coordinator.get(ident)
+
+
+async def fetch_flight_data_async(ident):
+    """
+    The async engine's counterpart of fetch_flight_data. The shared cache is queried on the engine's cache threads.
+    """
+    run_blocking = async_engine.run_blocking
+    started = time.time()
+    if not await run_blocking(flight_data_cache.claim, ident, FETCH_CLAIM_TTL):
+        while time.time() < started + FETCH_CLAIM_TTL:
+            entry = await run_blocking(flight_data_cache.get_entry, ident)
+            if entry and entry[1] > started - FLIGHT_DATA_TTL:
+                await run_blocking(flight_data_cache.count, "fetched_by_other_worker")
+                return entry[0][0]
+            await asyncio.sleep(0.2)
+    try:
+        fresh_data = await async_engine.get_flight_data(ident)
+        if fresh_data:
+            await run_blocking(store_flight_data, ident, fresh_data)
+        return fresh_data
+    finally:
+        await asyncio.shield(run_blocking(flight_data_cache.release, ident))  # Also when the fetch is cancelled
+
+
+async def get_full_flight_data_async(flight_number):
+    """
+    The async engine's counterpart of get_full_flight_data. Stale data is still refreshed by the refresh coordinator.
+    """
+    run_blocking = async_engine.run_blocking
+    ident = await run_blocking(ident_cache.get, flight_number)
+    if not ident:
+        ident = await async_engine.single_flight(
+            ("ident", flight_number), async_engine.get_flight_ident, flight_number, unknown_ident_cache
+        )
+        if ident:
+            await run_blocking(ident_cache.__setitem__, flight_number, ident)
+    if not ident:
+        return None
+
+    cached_data = await run_blocking(cached_flight_data, ident)
+    return cached_data or await async_engine.single_flight(ident, fetch_flight_data_async, ident)
+
+
+def start_task(scrape_request):
+    """
+    Marks a task of a request as running, or drops it if the request was abandoned.
+    :return: True if the task should run.
+    """
+    if not scrape_request or scrape_request.is_abandoned():
+        if scrape_request:
+            scrape_request.move("queued", "dropped")
+        with dropped_tasks_lock:
+            dropped_tasks["timeout" if scrape_request and not scrape_request.cancelled.is_set() else "cancelled"] += 1
+        return False
+    scrape_request.move("queued", "running")
+    return True
+
+
+def finish_task(scrape_request, original_flight_number, result=None, error=None):
+    """
+    Sends the result of a task, or the error it raised, to the request's stream.
+    """
+    if error:
+        print(f"Worker error for flight {original_flight_number}: {error}")
+        result_payload = {
+            "status": "error",
+            "result": {"error": f"An unexpected error occurred: {str(error)}"}
+        }
+        scrape_request.results.put({
+            "original_flight_number": original_flight_number,
+            "scraped_at": time.time(),
+            **result_payload
+        })
+    else:
+        if not result:
+            result = {"error": "Flight data not found or could not be scraped."}
+        result = dict(result)  # The cached data is shared with other requests
+
+        result['original_flight_number'] = original_flight_number
+        result['scraped_at'] = time.time()
+
+        scrape_request.results.put(result)
+    scrape_request.move("running", "completed")
+
+
 def worker():
     while True:
         request_id, original_flight_number, normalized_number = task_queue.get()
+        scrape_request = scrape_requests.get(request_id)
         try:
-            result = get_full_flight_data(normalized_number)
-            if not result:
-                result = {"error": "Flight data not found or could not be scraped."}
-
-            result['original_flight_number'] = original_flight_number
-            result['scraped_at'] = time.time()
-
-            if request_id in results:
-                results[request_id].put(result)
-        except Exception as e:
-            print(f"Worker error for flight {original_flight_number}: {e}")
-            result_payload = {
-                "status": "error",
-                "result": {"error": f"An unexpected error occurred: {str(e)}"}
-            }
-            if request_id in results:
-                results[request_id].put({
-                    "original_flight_number": original_flight_number,
-                    "scraped_at": time.time(),
-                    **result_payload
-                })
+            if start_task(scrape_request):
+                try:
+                    result = get_full_flight_data(normalized_number)
+                except Exception as e:
+                    finish_task(scrape_request, original_flight_number, error=e)
+                else:
+                    finish_task(scrape_request, original_flight_number, result)
         finally:
             task_queue.task_done()
 
 
+async def scrape_flight_async(scrape_request, original_flight_number, normalized_number):
+    """
+    The async engine's counterpart of a worker task.
+    """
+    if not start_task(scrape_request):
+        return
+    try:
+        result = await get_full_flight_data_async(normalized_number)
+    except asyncio.CancelledError:
+        scrape_request.move("running", "dropped")  # The stream closed
+        raise
+    except Exception as e:
+        finish_task(scrape_request, original_flight_number, error=e)
+    else:
+        finish_task(scrape_request, original_flight_number, result)
+
+
 worker_threads = []
 
 
 def start_worker_threads():
-    num_threads = int(os.environ.get("NUM_THREADS", os.cpu_count()))
-    for _ in range(num_threads):
-        threading.Thread(target=worker, daemon=True).start()
+    if async_engine:
+        async_engine.start()  # Fetches with its own client, the pool only serves refreshes
+        size_pool(REFRESH_WORKERS)
+    else:
+        num_threads = int(os.environ.get("NUM_THREADS", os.cpu_count()))
+        size_pool(num_threads + REFRESH_WORKERS)
+        for _ in range(num_threads):
+            threading.Thread(target=worker, daemon=True).start()
+    refresh_coordinator.start()
+
+
+@app.route("/api/cache/stats")
+def cache_stats():
+    """
+    Returns the hits and misses of the shared caches, added up across worker processes.
+    """
+    if not validate_token(request.args.get("token")):
+        return "Invalid token", 403
+    return {
+        "ident": ident_cache.stats(),
+        "unknown_ident": unknown_ident_cache.stats(),
+        "flight_data": flight_data_cache.stats(),
+        "refresh": refresh_coordinator.stats(),
+        **({"async_engine": async_engine.stats()} if async_engine else {})
+    }
+
+
+@app.route("/metrics")
+def metrics():
+    """
+    Returns the metrics of this worker process in the Prometheus text format. Cache events cover every worker.
+    """
+    if not validate_token(request.args.get("token")):
+        return "Invalid token", 403
+    return Response(metrics_registry.render(), content_type=CONTENT_TYPE)
+
+
+@app.route("/api/requests")
+def scrape_requests_status():
+    """
+    Returns the overall queue depth and how far each open scrape request is.
+    """
+    if not validate_token(request.args.get("token")):
+        return "Invalid token", 403
+    return {
+        "queue_depth": task_queue.qsize(),
+        "queued_tasks": queued_tasks(),
+        "flightaware": flightaware_governor.stats(),
+        "dropped_tasks": dict(dropped_tasks),
+        "requests": {request_id: scrape_request.status() for request_id, scrape_request in list(scrape_requests.items())}
+    }
 
 
 @app.route("/api/scrape/<flight_numbers>")
@@ -137,6 +390,12 @@ def scrape(flight_numbers):
     if not validate_token(request.args.get("token")):
         return "Invalid token", 403
 
+    # Clients may ask for a shorter deadline than the default
+    timeout = request.args.get("timeout", REQUEST_TIMEOUT, type=float)
+    if not math.isfinite(timeout) or timeout <= 0:
+        return {"error": "timeout must be a positive number of seconds"}, 400
+    timeout = min(timeout, REQUEST_TIMEOUT)
+
     request_id = str(uuid4())
     flight_list = []
     for number in flight_numbers.split(","):
@@ -145,17 +404,34 @@ def scrape(flight_numbers):
         if original_number and 2 <= len(normalized_number) <= 10:
             flight_list.append((original_number, normalized_number))
 
-    results[request_id] = Queue()
+    # Shed new work rather than queueing it without bound, the client can come back later
+    if queued_tasks() + len(flight_list) > MAX_QUEUED_TASKS:
+        return {"error": "Too many flights queued, try again later"}, 503, {"Retry-After": "30"}
+
+    scrape_request = scrape_requests[request_id] = ScrapeRequest(request_id, len(flight_list), timeout)
 
     for original, normalized in flight_list:
-        task_queue.put((request_id, original, normalized))
+        if async_engine:
+            scrape_request.futures.append(
+                async_engine.submit(scrape_flight_async(scrape_request, original, normalized))
+            )
+        else:
+            task_queue.put((request_id, original, normalized))
 
     def stream():
         items_processed = 0
         total_items = len(flight_list)
+        status = "completed"
         try:
             while items_processed < total_items:
-                result_data = results[request_id].get(timeout=480)
+                remaining_time = scrape_request.deadline - time.time()
+                if remaining_time <= 0:
+                    status = "timeout"
+                    break
+                try:
+                    result_data = scrape_request.results.get(timeout=remaining_time)
+                except Empty:
+                    continue
                 yield dumps({
                     "type": "flight_data",
                     "request_id": request_id,
@@ -166,16 +442,22 @@ def scrape(flight_numbers):
                 items_processed += 1
         except Exception as e:
             print(f"Error while streaming results: {e}")
-        finally:
-            yield dumps({
-                "type": "end",
-                "request_id": request_id,
-                "status": "completed"
-            }) + "\n"
-            if request_id in results:
-                del results[request_id]
-
-    return Response(stream(), mimetype='application/json')
+        yield dumps({
+            "type": "end",
+            "request_id": request_id,
+            "status": status
+        }) + "\n"
+
+    def close():
+        # Runs when the stream ends or the client disconnects, so the workers skip the remaining tasks
+        scrape_request.cancelled.set()
+        scrape_requests.pop(request_id, None)
+        for future in scrape_request.futures:
+            future.cancel()
+
+    response = Response(stream(), mimetype='application/json')
+    response.call_on_close(close)
+    return response
 
 
 if __name__ == "__main__":
@@ -1,79 +1,241 @@
 import logging
-from json import loads as json_loads
+import os
+import threading
+import time
+from contextlib import AbstractContextManager, contextmanager
+from json import JSONDecoder
+from typing import Iterable, MutableMapping, Optional
+from urllib.parse import urlparse
 
-from bs4 import BeautifulSoup
-from requests import get
+from cachetools import TTLCache
+
+from flight_number_extraction import could_be_ident, is_known_flight_number
+from http_transport import get
+from metrics import Counter, Histogram
+from rate_governor import RateGovernor
+from tracing import span
+
+# Can point to a stand-in server, e.g. for benchmarks
+FLIGHTAWARE_BASE_URL = os.environ.get("FLIGHTAWARE_BASE_URL", "https://www.flightaware.com").rstrip("/")
+OMNISEARCH_URL = f"{FLIGHTAWARE_BASE_URL}/ajax/ignoreall/omnisearch/flight.rvt"
+
+# Every request to FlightAware from this process, by the bot or the scraping API, waits for its turn here
+flightaware_governor = RateGovernor(
+    "FlightAware",
+    rate=float(os.environ.get("FLIGHTAWARE_RATE", 5)),
+    burst=int(os.environ.get("FLIGHTAWARE_BURST", 10)),
+    min_rate=float(os.environ.get("FLIGHTAWARE_MIN_RATE", 0.5)),
+    max_delay=float(os.environ.get("FLIGHTAWARE_MAX_QUEUE_DELAY", 30))
+)
+
+UNKNOWN_FLIGHT_NUMBER_TTL = int(os.environ.get("UNKNOWN_FLIGHT_NUMBER_TTL", 60 * 60 * 6))  # Seconds
+
+# Flight numbers omnisearch found no flight for. They are not looked up again until they expire
+unknown_flight_numbers = TTLCache(maxsize=4096, ttl=UNKNOWN_FLIGHT_NUMBER_TTL)
+unknown_flight_numbers_lock = threading.Lock()
+
+flightaware_request_seconds = Histogram(
+    "flightaware_request_seconds", "Time taken by ident lookups and flight page fetches, including retries",
+    labels=("kind",)
+)
+flightaware_errors = Counter(
+    "flightaware_errors_total", "Failed FlightAware requests by kind and error type", labels=("kind", "type")
+)
 
 headers = {
-    "Host": "www.flightaware.com",
+    "Host": urlparse(FLIGHTAWARE_BASE_URL).netloc,
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:140.0) Gecko/20100101 Firefox/140.0"
 }
 
+TRACKPOLL_MARKER = b"var trackpollBootstrap"
+SCRIPT_END = b"</script>"
+PAGE_CHUNK_SIZE = 64 * 1024
+
+bootstrap_decoder = JSONDecoder()
 
-def get_flight_ident(flight_number):
-    omnisearch_url = "https://www.flightaware.com/ajax/ignoreall/omnisearch/flight.rvt"
-    omnisearch_params = {
+
+def omnisearch_params(flight_number):
+    return {
         "v": "50",
         "locale": "en_US",
         "searchterm": flight_number,
         "q": flight_number
     }
-    resp = get(omnisearch_url, params=omnisearch_params, headers=headers)
-    if resp.status_code != 200:
-        logging.error(f"Failed to fetch ident from omnisearch for {flight_number}: {resp.status_code}")
-        return None
 
-    data = resp.json()
+
+def flight_page_url(ident):
+    return f"{FLIGHTAWARE_BASE_URL}/live/flight/{ident}"
+
+
+def parse_omnisearch(flight_number, data: dict) -> Optional[str]:
+    """
+    Returns the ident of the first omnisearch result, or None if there is none.
+    """
     if not data.get("data") or not len(data["data"]):
         logging.info(f"No ident found for {flight_number} via omnisearch.")
         return None
     return data["data"][0]["ident"]
 
 
-def get_flight_data(ident):
-    url = f"https://www.flightaware.com/live/flight/{ident}"
-    flight_page = get(url, headers=headers)
-    if flight_page.status_code == 200:
-        soup = BeautifulSoup(flight_page.text, "html.parser")
-        script = soup.find("script", string=lambda text: text and "var trackpollBootstrap" in text)
-        if script:
-            script_content = script.string.replace("var trackpollBootstrap = ", "", 1)
-            script_content = script_content[::-1].replace(";", "", 1).strip()[::-1]
-            flight_data = list(json_loads(script_content).get("flights", {}).values())[0]
-            if not flight_data:
-                logging.info(f"No flight data found for {flight_number}. Response: {data_response.text}")
-                return None
-            return {
-                "airline": (flight_data.get("airline", {}) or {}).get("shortName", "Unknown Airline"),
-                "identifier": flight_data.get("codeShare", {}).get("ident", ident),
-                "link": url,
-                "origin": {
-                    "airport": flight_data.get("origin", {}).get("friendlyName", "Unknown Origin"),
-                    "iata": flight_data.get("origin", {}).get("iata", "???"),
-                    "departure_time": flight_data.get("takeoffTimes", {}).get("scheduled"),
-                    "actual_departure_time": flight_data.get("takeoffTimes", {}).get("actual") or
-                                             flight_data.get("takeoffTimes", {}).get("estimated"),
-                    "coordinates": {
-                        "lat": (flight_data.get("origin", {}).get("coord") or [0, 0])[1],
-                        "lng": (flight_data.get("origin", {}).get("coord") or [0, 0])[0]
-                    }
-                },
-                "destination": {
-                    "airport": flight_data.get("destination", {}).get("friendlyName", "Unknown Destination"),
-                    "iata": flight_data.get("destination", {}).get("iata", "???"),
-                    "arrival_time": flight_data.get("landingTimes", {}).get("scheduled"),
-                    "actual_arrival_time": flight_data.get("landingTimes", {}).get("actual") or
-                                           flight_data.get("landingTimes", {}).get("estimated"),
-                    "coordinates": {
-                        "lat": (flight_data.get("destination", {}).get("coord") or [0, 0])[1],
-                        "lng": (flight_data.get("destination", {}).get("coord") or [0, 0])[0]
-                    }
-                },
-                "distance": {
-                    "elapsed": flight_data.get("distance", {}).get("elapsed", 0),
-                    "remaining": flight_data.get("distance", {}).get("remaining", 0)
-                },
-                "speed": flight_data.get("flightPlan", {}).get("speed", 0) if flight_data.get("flightPlan") else 0,
+def skip_ident_lookup(flight_number, unknown: MutableMapping) -> bool:
+    """
+    Returns whether omnisearch can be skipped because the flight number cannot have an ident:
+    it cannot be a flight or tail number, or omnisearch recently found no flight for it.
+    Flight numbers whose airline code is not in the bundled index are still looked up, as the index is not complete
+    and tail numbers have no airline code.
+    :param unknown: The negative cache of flight numbers omnisearch found no flight for.
+    """
+    if not could_be_ident(flight_number):
+        logging.info(f"Not looking up {flight_number}, it cannot be a flight or tail number.")
+        return True
+    if not is_known_flight_number(flight_number):
+        logging.info(f"Looking up {flight_number}, which does not start with a known airline code.")
+    return flight_number in unknown
+
+
+@contextmanager
+def flightaware_request(kind: str):
+    """
+    Times a request to FlightAware and counts the exception it raises, if any. It is a span of the current trace.
+    :param kind: "ident" or "flight_page".
+    """
+    started = time.perf_counter()
+    try:
+        with span(f"flightaware.{kind}"):
+            yield
+    except Exception as e:
+        flightaware_errors.inc(kind=kind, type=type(e).__name__)
+        raise
+    finally:
+        flightaware_request_seconds.observe(time.perf_counter() - started, kind=kind)
+
+
+def get_flight_ident(flight_number, unknown: MutableMapping = unknown_flight_numbers,
+                     unknown_lock: AbstractContextManager = unknown_flight_numbers_lock):
+    """
+    :param unknown: The negative cache of flight numbers omnisearch found no flight for. Failed requests are not cached.
+    :param unknown_lock: Held while the negative cache is used.
+    """
+    with unknown_lock:
+        if skip_ident_lookup(flight_number, unknown):
+            return None
+    with flightaware_request("ident"):
+        resp = get(OMNISEARCH_URL, flightaware_governor, params=omnisearch_params(flight_number), headers=headers)
+        if resp.status_code != 200:
+            flightaware_errors.inc(kind="ident", type=f"http_{resp.status_code}")
+            logging.error(f"Failed to fetch ident from omnisearch for {flight_number}: {resp.status_code}")
+            return None
+
+        ident = parse_omnisearch(flight_number, resp.json())
+    if not ident:
+        with unknown_lock:
+            unknown[flight_number] = True
+    return ident
+
+
+def extract_trackpoll_bootstrap(chunks: Iterable[bytes]) -> Optional[dict]:
+    """
+    Extracts the trackpollBootstrap object from a FlightAware flight page.
+    The page is scanned chunk by chunk: everything before the bootstrap script is discarded,
+    and reading stops at the end of the script, so the rest of the page is never buffered or parsed.
+    :param chunks: The page content, as an iterable of byte chunks.
+    :return: The bootstrap object, or None if the page does not contain one.
+    """
+    buffer = bytearray()
+    start = -1
+    end = -1
+    for chunk in chunks:
+        previous_length = len(buffer)
+        buffer += chunk
+        if start < 0:
+            start = buffer.find(TRACKPOLL_MARKER)
+            if start < 0:
+                del buffer[:-len(TRACKPOLL_MARKER)]  # Keep a marker that is split across chunks
+                continue
+            del buffer[:start]
+            previous_length = 0
+        end = buffer.find(SCRIPT_END, max(len(TRACKPOLL_MARKER), previous_length - len(SCRIPT_END) + 1))
+        if end >= 0:
+            break
+    if start < 0:
+        return None
+    if end < 0:
+        end = len(buffer)
+    script_content = buffer[len(TRACKPOLL_MARKER):end].decode("utf-8", errors="replace").lstrip()
+    if not script_content.startswith("="):
+        return None
+    try:
+        bootstrap, _ = bootstrap_decoder.raw_decode(script_content[1:].lstrip())
+    except ValueError as e:
+        logging.error(f"Failed to parse trackpollBootstrap: {e}")
+        return None
+    return bootstrap
+
+
+def flight_data_from_bootstrap(ident, url, bootstrap: dict) -> Optional[dict]:
+    """
+    Builds the flight information from the trackpollBootstrap object of a flight page.
+    :return: The flight information, or None if the page has no flight.
+    """
+    flight_data = list(bootstrap.get("flights", {}).values())[0]
+    if not flight_data:
+        logging.info(f"No flight data found for {ident}.")
+        return None
+    return {
+        "airline": (flight_data.get("airline", {}) or {}).get("shortName", "Unknown Airline"),
+        "identifier": flight_data.get("codeShare", {}).get("ident", ident),
+        "link": url,
+        "origin": {
+            "airport": flight_data.get("origin", {}).get("friendlyName", "Unknown Origin"),
+            "iata": flight_data.get("origin", {}).get("iata", "???"),
+            "departure_time": flight_data.get("takeoffTimes", {}).get("scheduled"),
+            "actual_departure_time": flight_data.get("takeoffTimes", {}).get("actual") or
+                                     flight_data.get("takeoffTimes", {}).get("estimated"),
+            "coordinates": {
+                "lat": (flight_data.get("origin", {}).get("coord") or [0, 0])[1],
+                "lng": (flight_data.get("origin", {}).get("coord") or [0, 0])[0]
             }
+        },
+        "destination": {
+            "airport": flight_data.get("destination", {}).get("friendlyName", "Unknown Destination"),
+            "iata": flight_data.get("destination", {}).get("iata", "???"),
+            "arrival_time": flight_data.get("landingTimes", {}).get("scheduled"),
+            "actual_arrival_time": flight_data.get("landingTimes", {}).get("actual") or
+                                   flight_data.get("landingTimes", {}).get("estimated"),
+            "coordinates": {
+                "lat": (flight_data.get("destination", {}).get("coord") or [0, 0])[1],
+                "lng": (flight_data.get("destination", {}).get("coord") or [0, 0])[0]
+            }
+        },
+        "distance": {
+            "elapsed": flight_data.get("distance", {}).get("elapsed", 0),
+            "remaining": flight_data.get("distance", {}).get("remaining", 0)
+        },
+        "speed": flight_data.get("flightPlan", {}).get("speed", 0) if flight_data.get("flightPlan") else 0,
+    }
+
+
+def get_flight_data(ident):
+    url = flight_page_url(ident)
+    with flightaware_request("flight_page"):
+        flight_page = get(url, flightaware_governor, headers=headers, stream=True)
+        if flight_page.status_code == 200:
+            with flight_page:
+                chunks = flight_page.iter_content(chunk_size=PAGE_CHUNK_SIZE)
+                bootstrap = extract_trackpoll_bootstrap(chunks)
+                for _ in chunks:
+                    pass  # Drain the rest of the page so the connection can be reused
+            if bootstrap:
+                return flight_data_from_bootstrap(ident, url, bootstrap)
+            flightaware_errors.inc(kind="flight_page", type="no_bootstrap")
+        else:
+            flightaware_errors.inc(kind="flight_page", type=f"http_{flight_page.status_code}")
     logging.error(f"Failed to fetch flight data from FlightAware: {flight_page.status_code}")
     return None
+
+
+def scrape_flightaware(flight_number):
+    ident = get_flight_ident(flight_number)
+    if not ident:
+        return None
+    return get_flight_data(ident)
@@ -0,0 +1,236 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from collections.abc import MutableMapping
+from json import dumps, loads
+from typing import Any, Iterator, Optional
+
+STATS_FLUSH_INTERVAL = 5  # Seconds between writes of a process's hit and miss counts
+
+
+def process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Running as another user
+    return True
+
+
+class SharedTTLCache(MutableMapping):
+    """
+    A TTL cache in a SQLite database in WAL mode, shared by every process that opens the same file
+    (e.g. gunicorn workers). It can be used anywhere a cachetools cache is, including with @cached.
+    Values must be JSON serialisable, and tuples come back as lists.
+
+    Hits and misses are counted per process and added up across the running processes by stats().
+    Claims let one process fetch a key while the others wait for the result instead of fetching it too.
+    """
+
+    def __init__(self, path: str, name: str, maxsize: int, ttl: float):
+        """
+        :param path: The database file. ":memory:" keeps the cache private to the process.
+        :param name: Separates caches that share a database.
+        :param maxsize: The number of entries kept. The oldest entries are removed first.
+        :param ttl: Seconds before an entry expires.
+        """
+        self.path = path
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.pid: Optional[int] = None
+        self._connection: Optional[sqlite3.Connection] = None
+        self.writes = 0
+        self.counts: Counter = Counter()  # Event: count not yet written to the database
+        self.last_flush = time.time()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # Connections cannot be shared with forked processes, so each process opens its own
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries (name TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "stored_at REAL NOT NULL, PRIMARY KEY (name, key))"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_claims (name TEXT NOT NULL, key TEXT NOT NULL, owner INTEGER NOT NULL, "
+                "expires_at REAL NOT NULL, PRIMARY KEY (name, key))"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_stats (name TEXT NOT NULL, pid INTEGER NOT NULL, event TEXT NOT NULL, "
+                "count INTEGER NOT NULL, PRIMARY KEY (name, pid, event))"
+            )
+        return self._connection
+
+    def get_entry(self, key: str) -> Optional[tuple[Any, float]]:
+        """
+        Returns an unexpired value and the time it was stored, or None. Does not count a hit or miss.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, stored_at FROM cache_entries WHERE name = ? AND key = ? AND stored_at > ?",
+                (self.name, key, time.time() - self.ttl)
+            ).fetchone()
+        if not row:
+            return None
+        return loads(row[0]), row[1]
+
+    def __getitem__(self, key: str) -> Any:
+        entry = self.get_entry(key)
+        self.count("hits" if entry else "misses")
+        if not entry:
+            raise KeyError(key)
+        return entry[0]
+
+    def __setitem__(self, key: str, value: Any):
+        data = dumps(value)
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO cache_entries (name, key, value, stored_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (name, key) DO UPDATE SET value = excluded.value, stored_at = excluded.stored_at",
+                (self.name, key, data, time.time())
+            )
+            self.writes += 1
+            if self.writes % 100 == 0:
+                self.evict()
+
+    def setdefault(self, key: str, default: Any = None) -> Any:
+        # Used by @cached after a miss, which must not count as another lookup
+        entry = self.get_entry(key)
+        if entry:
+            return entry[0]
+        self[key] = default
+        return default
+
+    def __delitem__(self, key: str):
+        with self.lock:
+            cursor = self.connection.execute(
+                "DELETE FROM cache_entries WHERE name = ? AND key = ?", (self.name, key)
+            )
+        if not cursor.rowcount:
+            raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT key FROM cache_entries WHERE name = ? AND stored_at > ?", (self.name, time.time() - self.ttl)
+            ).fetchall()
+        return iter([key for key, in rows])
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM cache_entries WHERE name = ? AND stored_at > ?", (self.name, time.time() - self.ttl)
+            ).fetchone()[0]
+
+    def evict(self):
+        """
+        Removes expired entries, then the oldest entries beyond maxsize. Called with the lock held.
+        """
+        self.connection.execute(
+            "DELETE FROM cache_entries WHERE name = ? AND stored_at <= ?", (self.name, time.time() - self.ttl)
+        )
+        self.connection.execute(
+            "DELETE FROM cache_entries WHERE name = ? AND key IN "
+            "(SELECT key FROM cache_entries WHERE name = ? ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+            (self.name, self.name, self.maxsize)
+        )
+
+    def claim(self, key: str, ttl: float) -> bool:
+        """
+        Claims a key for this process, so other processes wait for its result instead of fetching it.
+        :param ttl: Seconds after which the claim expires, in case the process exits without releasing it.
+        :return: True if the claim was free, expired, or already held by this process.
+        """
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT INTO cache_claims (name, key, owner, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (name, key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE cache_claims.expires_at < ? OR cache_claims.owner = excluded.owner",
+                (self.name, key, os.getpid(), now + ttl, now)
+            )
+            return cursor.rowcount > 0
+
+    def release(self, key: str):
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM cache_claims WHERE name = ? AND key = ? AND owner = ?", (self.name, key, os.getpid())
+            )
+
+    def wait_for(self, key: str, newer_than: float, timeout: float) -> Optional[tuple[Any, float]]:
+        """
+        Waits for another process to store a value for the key.
+        :param newer_than: The time the value must have been stored after.
+        :return: The value and the time it was stored, or None if none was stored before the timeout.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            entry = self.get_entry(key)
+            if entry and entry[1] > newer_than:
+                return entry
+            time.sleep(0.2)
+        return None
+
+    def count(self, event: str):
+        """
+        Counts a cache event, such as a hit. Counts are written to the database every few seconds.
+        """
+        with self.lock:
+            self.counts[event] += 1
+            if time.time() - self.last_flush > STATS_FLUSH_INTERVAL:
+                self.flush_counts()
+
+    def flush_counts(self):
+        """
+        Adds the counts of this process to the database. Called with the lock held.
+        """
+        for event, count in self.counts.items():
+            self.connection.execute(
+                "INSERT INTO cache_stats (name, pid, event, count) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (name, pid, event) DO UPDATE SET count = count + excluded.count",
+                (self.name, os.getpid(), event, count)
+            )
+        self.counts.clear()
+        self.last_flush = time.time()
+
+    def process_counts(self) -> dict[int, Counter]:
+        """
+        Returns the event counts of every running process using the cache, by pid.
+        The counts of processes that have exited (e.g. restarted gunicorn workers) are deleted.
+        """
+        with self.lock:
+            self.flush_counts()
+            rows = self.connection.execute(
+                "SELECT pid, event, count FROM cache_stats WHERE name = ?", (self.name,)
+            ).fetchall()
+            exited = {pid for pid, _, _ in rows if not process_exists(pid)}
+            for pid in exited:
+                self.connection.execute("DELETE FROM cache_stats WHERE name = ? AND pid = ?", (self.name, pid))
+        processes: dict[int, Counter] = {}
+        for pid, event, count in rows:
+            if pid not in exited:
+                processes.setdefault(pid, Counter())[event] = count
+        return processes
+
+    def stats(self) -> dict:
+        """
+        Returns the event counts of every process using the cache, their total and the overall hit ratio.
+        """
+        processes = self.process_counts()
+        total = sum(processes.values(), Counter())
+        lookups = total["hits"] + total["misses"]
+        return {
+            **total,
+            "hit_ratio": total["hits"] / lookups if lookups else 0.0,
+            "size": len(self),
+            "processes": {str(pid): dict(counts) for pid, counts in processes.items()}
+        }
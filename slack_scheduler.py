@@ -0,0 +1,213 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from enum import IntEnum
+from typing import Optional
+
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web import SlackResponse
+
+from metrics import Counter, Histogram
+from tracing import span
+
+# Requests per minute allowed by each Slack Web API rate limit tier
+TIER_LIMITS = {
+    1: 1,
+    2: 20,
+    3: 50,
+    4: 100
+}
+
+METHOD_TIERS = {
+    "auth_test": 4,
+    "files_info": 4,
+    "files_list": 3,
+    "canvases_edit": 3
+}
+DEFAULT_TIER = 3
+
+RATE_LIMIT_RETRIES = 3
+
+slack_request_seconds = Histogram(
+    "slack_request_seconds", "Time taken by Slack Web API calls, without the wait for the rate limit",
+    labels=("method",)
+)
+slack_errors = Counter(
+    "slack_errors_total", "Failed Slack Web API calls by method and error", labels=("method", "error")
+)
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # Work caused by a user, such as a file_change event
+    BACKGROUND = 1  # Periodic refreshes and discovery
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.rate = per_minute / 60
+        self.capacity = max(1, per_minute // 10)  # Allow short bursts, but not a whole minute's worth
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now: float) -> float:
+        """
+        Returns how long to wait until a token is available, 0 if one is available now.
+        """
+        self.refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        """
+        Stops handing out tokens, used when Slack responds with Retry-After.
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class MethodStats:
+    def __init__(self):
+        self.calls = 0
+        self.rate_limited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+class SlackScheduler:
+    """
+    Sends Slack Web API calls through per-method token buckets, so bursts of work wait instead of hitting 429s.
+    Waiting calls are served by priority, then in the order they arrived.
+    """
+
+    def __init__(self, client: WebClient):
+        self.client = client
+        self.condition = threading.Condition()
+        self.buckets: dict[str, TokenBucket] = {}
+        self.waiting: dict[str, list[tuple[int, int]]] = {}
+        self.stats_by_method: dict[str, MethodStats] = {}
+        self.sequence = itertools.count()
+        self.identity: Optional[SlackResponse] = None
+
+    def call(self, method: str, priority: Priority = Priority.BACKGROUND, **kwargs) -> SlackResponse:
+        """
+        Calls a WebClient method once the rate limit allows it.
+        :param method: The WebClient method name, such as "files_info".
+        :param priority: The lane to queue the call in.
+        :return: The Slack response.
+        """
+        attempt = 0
+        rate_limit_wait = 0.0
+        with span(f"slack.{method}") as call_span:  # Includes the wait for the rate limit and retries
+            while True:
+                queued_at = time.perf_counter()
+                self.acquire(method, priority)
+                started = time.perf_counter()
+                if call_span:
+                    rate_limit_wait += started - queued_at
+                    call_span.set("rate_limit_wait", rate_limit_wait)
+                    call_span.set("attempts", attempt + 1)
+                try:
+                    return getattr(self.client, method)(**kwargs)
+                except SlackApiError as e:
+                    error = e.response.get("error") or f"http_{e.response.status_code}"
+                    slack_errors.inc(method=method, error=error)
+                    if e.response.status_code != 429 or attempt >= RATE_LIMIT_RETRIES:
+                        raise
+                    attempt += 1
+                    retry_after = int(e.response.headers.get("Retry-After", 1))
+                    logging.warning(f"Slack rate limited {method}, retrying in {retry_after}s")
+                    with self.condition:
+                        self.buckets[method].pause(retry_after)
+                        self.stats_by_method[method].rate_limited += 1
+                        self.condition.notify_all()
+                except Exception as e:
+                    slack_errors.inc(method=method, error=type(e).__name__)
+                    raise
+                finally:
+                    slack_request_seconds.observe(time.perf_counter() - started, method=method)
+
+    def acquire(self, method: str, priority: Priority):
+        """
+        Blocks until the call is first in line for its method and a token is available.
+        """
+        ticket = (int(priority), next(self.sequence))
+        queued_at = time.monotonic()
+        with self.condition:
+            if method not in self.buckets:
+                self.buckets[method] = TokenBucket(TIER_LIMITS[METHOD_TIERS.get(method, DEFAULT_TIER)])
+                self.waiting[method] = []
+                self.stats_by_method[method] = MethodStats()
+            bucket = self.buckets[method]
+            waiting = self.waiting[method]
+            heapq.heappush(waiting, ticket)
+            while True:
+                if waiting[0] == ticket:
+                    wait_time = bucket.wait_time(time.monotonic())
+                    if wait_time <= 0:
+                        break
+                    self.condition.wait(wait_time)
+                else:
+                    self.condition.wait()
+            bucket.take()
+            heapq.heappop(waiting)
+            stats = self.stats_by_method[method]
+            waited = time.monotonic() - queued_at
+            stats.calls += 1
+            stats.total_wait += waited
+            stats.max_wait = max(stats.max_wait, waited)
+            self.condition.notify_all()
+
+    def auth_test(self) -> SlackResponse:
+        """
+        Returns the bot's identity. The result is memoised because it does not change while the bot runs.
+        """
+        if self.identity is None:
+            response = self.call("auth_test", Priority.INTERACTIVE)
+            if response.get("ok"):
+                self.identity = response
+            return response
+        return self.identity
+
+    def stats(self) -> dict:
+        """
+        Returns the queue depth, call count and wait times of each method.
+        """
+        with self.condition:
+            return {
+                method: {
+                    "queued": len(self.waiting[method]),
+                    "calls": stats.calls,
+                    "rate_limited": stats.rate_limited,
+                    "average_wait": stats.total_wait / stats.calls if stats.calls else 0,
+                    "max_wait": stats.max_wait
+                }
+                for method, stats in self.stats_by_method.items()
+            }
+
+
+schedulers: dict[int, SlackScheduler] = {}
+schedulers_lock = threading.Lock()
+
+
+def get_slack_scheduler(client: WebClient) -> SlackScheduler:
+    """
+    Returns the scheduler shared by everything that uses the given client.
+    """
+    with schedulers_lock:
+        if id(client) not in schedulers:
+            schedulers[id(client)] = SlackScheduler(client)
+        return schedulers[id(client)]
@@ -54,22 +54,36 @@ export class FlightManager {
         // Find the index of the flight in the flights array
         const index = this.flights.findIndex(f => f.identifier === updatedFlight.identifier);
         if (index === -1) {
-            console.warn(`Flight with identifier ${updatedFlight.identifier} does not exist. Cannot update.`);
-            return;
+            // A flight added to the canvas since the page was loaded
+            this.flights.push(updatedFlight);
+        } else {
+            // Update the flight in the flights array
+            this.flights[index] = updatedFlight;
         }
-        // Update the flight in the flights array
-        this.flights[index] = updatedFlight;
 
         // Remove the managed flight visuals if they exist
-        const managed = this.managedFlights[updatedFlight.identifier];
+        this.removeManagedFlight(updatedFlight.identifier);
+        // Re-create the managed flight visuals
+        this.createManagedFlight(updatedFlight);
+    }
+
+    removeFlight(identifier: string): void {
+        this.flights = this.flights.filter(f => f.identifier !== identifier);
+        this.removeManagedFlight(identifier);
+    }
+
+    getFlightIdentifiers(): string[] {
+        return this.flights.map(f => f.identifier);
+    }
+
+    private removeManagedFlight(identifier: string): void {
+        const managed = this.managedFlights[identifier];
         if (managed) {
             managed.marker?.remove();
             managed.elapsedPolyline?.remove();
             managed.remainingPolyline?.remove();
-            delete this.managedFlights[updatedFlight.identifier];
+            delete this.managedFlights[identifier];
         }
-        // Re-create the managed flight visuals
-        this.createManagedFlight(updatedFlight);
     }
 
     addFlights(currentlyTracking: boolean) {
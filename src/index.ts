@@ -23,10 +23,19 @@ interface ServerData {
         currentlyTracking: boolean;
     },
     file_id: string;
+    version: number;
+}
+
+interface MapChanges {
+    version: number;
+    since: number;
+    flights: Flight[];
+    removedFlights: string[];
 }
 
 const trackingStatus = document.getElementById('tracking-status') as HTMLSpanElement;
 let fileId;
+let version: number;
 
 function loadServerData() {
     const serverDataMeta = document.getElementById('server-data') as HTMLMetaElement;
@@ -52,22 +61,57 @@ function loadServerData() {
         trackingStatus.innerHTML = `<strong>Live tracking not active.</strong> Active dates: ${serverData.tracking.arrivalDates.join(', ')}`;
     } else {
         trackingStatus.innerHTML = `<strong>Live tracking active.</strong>`;
-        setInterval(fetchServerData, 1000 * 60); // Fetch server data every minute
     }
     fileId = serverData.file_id;
+    version = serverData.version;
+    if (serverData.tracking.currentlyTracking) {
+        subscribeToUpdates();
+    }
+}
+
+function subscribeToUpdates() {
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+    // The server pushes the flights that changed as soon as it has them. The browser reconnects on its own after
+    // network errors, but if the server turns the stream away (e.g. too many clients), poll instead.
+    const source = new EventSource(`/api/map/${fileId}/events?since=${version}`);
+    const applyEvent = (event: MessageEvent) => applyServerData(JSON.parse(event.data));
+    source.addEventListener('changes', applyEvent);
+    source.addEventListener('map', applyEvent);
+    source.onerror = () => {
+        if (source.readyState === EventSource.CLOSED) {
+            startPolling();
+        }
+    };
+}
+
+function startPolling() {
+    setInterval(fetchServerData, 1000 * 60); // Fetch server data every minute
+}
+
+function applyServerData(data: ServerData | MapChanges) {
+    const flightManager = themeManager.getFlightManager();
+    // Changes list the flights that left the map, full data leaves them out
+    const removedFlights = 'removedFlights' in data ? data.removedFlights : flightManager.getFlightIdentifiers()
+        .filter(identifier => !data.flights.some(flight => flight.identifier === identifier));
+    removedFlights.forEach(identifier => {
+        flightManager.removeFlight(identifier);
+    });
+    data.flights.forEach(flight => {
+        flightManager.updateFlight(flight);
+    });
+    version = data.version;
 }
 
 function fetchServerData() {
-    fetch(`/api/map/${fileId}`).then(response => {
+    // Only the flights that changed since our version are sent, or the full data if the server cannot tell
+    fetch(`/api/map/${fileId}?since=${version}`, {cache: 'no-cache'}).then(response => {
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
-        response.json().then(data => {
-            const serverData: ServerData = data;
-            serverData.flights.forEach(flight => {
-                themeManager.getFlightManager().updateFlight(flight);
-            });
-        });
+        response.json().then(applyServerData);
     });
 }
 
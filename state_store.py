@@ -0,0 +1,175 @@
+import logging
+import os
+import sqlite3
+import time
+from json import dumps, loads
+from typing import Optional
+
+from green_threads import native_lock, outside_hub
+
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "flights_canvas.db")
+
+
+class StateStore:
+    """
+    Keeps tracked canvases and their map data in SQLite, so a restarted bot can serve maps and resume tracking
+    without waiting for the next full file check.
+    Each canvas has one row per table that is updated in place, so the database grows with the number of canvases.
+    """
+
+    def __init__(self, path: str):
+        self.lock = native_lock()  # Held in gevent's native threads when threads are green, see outside_hub
+        # Other processes may hold the write lock briefly in multi-process deployments
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tracked_files (file_id TEXT PRIMARY KEY, tracked_since REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS map_data (file_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS file_fingerprints (file_id TEXT PRIMARY KEY, fingerprint TEXT NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS canvas_leases (file_id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        # One row per file_change event, so the leader can tell the user's events from the bot's own
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS pending_file_changes (file_id TEXT NOT NULL, event_at REAL NOT NULL)"
+        )
+        self.connection.execute("DROP TABLE IF EXISTS pending_updates")  # Replaced by pending_file_changes
+
+    @outside_hub
+    def set_tracked(self, file_id: str, tracked: bool):
+        with self.lock:
+            if tracked:
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO tracked_files (file_id, tracked_since) VALUES (?, ?)",
+                    (file_id, time.time())
+                )
+            else:
+                self.connection.execute("DELETE FROM tracked_files WHERE file_id = ?", (file_id,))
+
+    @outside_hub
+    def save_map_data(self, file_id: str, map_data: dict, updated_at: Optional[float] = None):
+        data = dumps(map_data)
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO map_data (file_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (file_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (file_id, data, updated_at or time.time())
+            )
+
+    @outside_hub
+    def load_tracked_files(self) -> list[str]:
+        with self.lock:
+            rows = self.connection.execute("SELECT file_id FROM tracked_files ORDER BY tracked_since").fetchall()
+        return [file_id for file_id, in rows]
+
+    @outside_hub
+    def load_map_data(self) -> dict[str, tuple[float, dict]]:
+        """
+        Loads the map data of every canvas.
+        :return: A dictionary mapping file IDs to the update time and the map data.
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT file_id, updated_at, data FROM map_data").fetchall()
+        map_data = {}
+        for file_id, updated_at, data in rows:
+            try:
+                map_data[file_id] = (updated_at, loads(data))
+            except ValueError as e:
+                logging.error(f"Failed to load saved map data for {file_id}: {e}")
+        return map_data
+
+    @outside_hub
+    def save_fingerprint(self, file_id: str, fingerprint: str):
+        """
+        Remembers the fingerprint a canvas had when it was last checked by the file discovery.
+        """
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO file_fingerprints (file_id, fingerprint) VALUES (?, ?) "
+                "ON CONFLICT (file_id) DO UPDATE SET fingerprint = excluded.fingerprint",
+                (file_id, fingerprint)
+            )
+
+    @outside_hub
+    def load_fingerprints(self) -> dict[str, str]:
+        with self.lock:
+            rows = self.connection.execute("SELECT file_id, fingerprint FROM file_fingerprints").fetchall()
+        return dict(rows)
+
+    @outside_hub
+    def load_map(self, file_id: str, known_updated_at: Optional[float] = None) -> Optional[tuple[float, Optional[dict]]]:
+        """
+        Loads the map data of a single canvas.
+        :param known_updated_at: The update time of a copy the caller already has. If it is still current,
+            the data is not loaded again and None is returned in its place.
+        :return: The update time and the map data, or None if the canvas has no map data.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT updated_at FROM map_data WHERE file_id = ?", (file_id,)).fetchone()
+            if not row:
+                return None
+            if row[0] == known_updated_at:
+                return row[0], None
+            row = self.connection.execute(
+                "SELECT updated_at, data FROM map_data WHERE file_id = ?", (file_id,)
+            ).fetchone()
+        if not row:
+            return None
+        return row[0], loads(row[1])
+
+    @outside_hub
+    def acquire_lease(self, file_id: str, owner: str, ttl: float) -> bool:
+        """
+        Takes the lease on a canvas, so no other process edits it at the same time.
+        The lease is granted if it is free, expired, or already held by the owner.
+        :return: True if the lease was acquired, False otherwise.
+        """
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT INTO canvas_leases (file_id, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (file_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE canvas_leases.expires_at < ? OR canvas_leases.owner = excluded.owner",
+                (file_id, owner, now + ttl, now)
+            )
+            return cursor.rowcount > 0
+
+    @outside_hub
+    def release_lease(self, file_id: str, owner: str):
+        with self.lock:
+            self.connection.execute("DELETE FROM canvas_leases WHERE file_id = ? AND owner = ?", (file_id, owner))
+
+    @outside_hub
+    def request_update(self, file_id: str, event_at: float):
+        """
+        Asks the leader process to update a canvas.
+        :param event_at: When Slack sent the file_change event.
+        """
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO pending_file_changes (file_id, event_at) VALUES (?, ?)", (file_id, event_at)
+            )
+
+    @outside_hub
+    def take_pending_updates(self) -> list[tuple[str, float]]:
+        """
+        Removes and returns the file_change events other processes received, as (file ID, event time), oldest first.
+        """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.connection.execute(
+                    "SELECT file_id, event_at FROM pending_file_changes ORDER BY event_at"
+                ).fetchall()
+                self.connection.execute("DELETE FROM pending_file_changes")
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return rows
@@ -0,0 +1,103 @@
+import threading
+import time
+
+from canvas_scheduler import CanvasScheduler
+
+TIMEOUT = 5  # Seconds a test waits for a worker before failing
+
+
+class Recorder:
+    """
+    Records the canvases a scheduler runs. Runs of the canvas in `block` wait until it is released.
+    """
+
+    def __init__(self, block: str = None):
+        self.block = block
+        self.runs = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.ran = threading.Semaphore(0)
+
+    def __call__(self, file_id: str):
+        self.runs.append(file_id)
+        if file_id == self.block:
+            self.started.set()
+            self.release.wait(TIMEOUT)
+        self.ran.release()
+
+    def wait_for_runs(self, count: int):
+        for _ in range(count):
+            assert self.ran.acquire(timeout=TIMEOUT)
+
+
+def test_runs_canvases_in_due_order():
+    recorder = Recorder()
+    scheduler = CanvasScheduler(recorder, workers=1, retry_interval=60)
+    scheduler.schedule("late", delay=0.1)
+    scheduler.schedule("early", delay=0.05)
+    scheduler.start()
+    recorder.wait_for_runs(2)
+    assert recorder.runs == ["early", "late"]
+
+
+def test_schedule_replaces_the_earlier_entry():
+    recorder = Recorder()
+    scheduler = CanvasScheduler(recorder, workers=1, retry_interval=60)
+    scheduler.schedule("F1", delay=60)
+    scheduler.schedule("F1")
+    scheduler.start()
+    recorder.wait_for_runs(1)
+    time.sleep(0.05)
+    assert recorder.runs == ["F1"]
+    assert scheduler.stats()["scheduled"] == 0
+
+
+def test_unscheduled_canvas_does_not_run():
+    recorder = Recorder()
+    scheduler = CanvasScheduler(recorder, workers=1, retry_interval=60)
+    scheduler.schedule("F1", delay=0.05)
+    scheduler.unschedule("F1")
+    scheduler.schedule("F2", delay=0.1)
+    scheduler.start()
+    recorder.wait_for_runs(1)
+    assert recorder.runs == ["F2"]
+
+
+def test_canvas_due_while_running_is_deferred_until_the_run_ends():
+    recorder = Recorder(block="F1")
+    scheduler = CanvasScheduler(recorder, workers=2, retry_interval=60)
+    scheduler.schedule("F1")
+    scheduler.start()
+    assert recorder.started.wait(TIMEOUT)
+
+    # Due twice while the first run is still going: the second worker must not run it in parallel
+    scheduler.schedule("F1")
+    scheduler.schedule("F1")
+    time.sleep(0.1)
+    assert recorder.runs == ["F1"]
+    assert "F1" in scheduler.deferred
+
+    recorder.block = None
+    recorder.release.set()
+    recorder.wait_for_runs(2)
+    time.sleep(0.1)
+    assert recorder.runs == ["F1", "F1"]  # The deferred runs are merged into one
+    assert scheduler.stats()["running"] == 0
+
+
+def test_failed_run_is_retried_after_the_retry_interval():
+    runs = []
+    ran = threading.Semaphore(0)
+
+    def run(file_id: str):
+        runs.append(time.monotonic())
+        ran.release()
+        if len(runs) == 1:
+            raise RuntimeError("Slack is down")
+
+    scheduler = CanvasScheduler(run, workers=1, retry_interval=0.1)
+    scheduler.schedule("F1")
+    scheduler.start()
+    assert ran.acquire(timeout=TIMEOUT)
+    assert ran.acquire(timeout=TIMEOUT)
+    assert runs[1] - runs[0] >= 0.09
@@ -0,0 +1,119 @@
+import threading
+import time
+
+import pytest
+
+from event_coalescer import BOT_EVENT_DELAY, BotEdit, FileChangeCoalescer
+
+DEBOUNCE = 0.05
+TIMEOUT = 5  # Seconds a test waits for a pass before failing
+
+
+class Passes:
+    def __init__(self):
+        self.files = []
+        self.done = threading.Semaphore(0)
+
+    def __call__(self, file_id: str):
+        self.files.append(file_id)
+        self.done.release()
+
+    def wait(self):
+        assert self.done.acquire(timeout=TIMEOUT)
+
+
+def make_coalescer(passes, is_own_change=lambda file_id, first, last: False, is_busy=lambda file_id: False):
+    return FileChangeCoalescer(passes, is_own_change, is_busy, debounce=DEBOUNCE, workers=2)
+
+
+def test_events_within_the_debounce_are_merged_into_one_pass():
+    passes = Passes()
+    coalescer = make_coalescer(passes)
+    for _ in range(5):
+        coalescer.submit("F1")
+    passes.wait()
+    time.sleep(DEBOUNCE * 3)
+    assert passes.files == ["F1"]
+    assert coalescer.stats() == {"merged": 4, "dropped": 0, "processed": 1, "pending": 0}
+
+
+def test_timer_is_rearmed_while_a_pass_is_running():
+    passes = Passes()
+    busy = threading.Event()
+    busy.set()
+    checks = []
+
+    def is_busy(file_id: str) -> bool:
+        checks.append(file_id)
+        return busy.is_set()
+
+    coalescer = make_coalescer(passes, is_busy=is_busy)
+    coalescer.submit("F1")
+    time.sleep(DEBOUNCE * 4)
+    assert passes.files == []  # Still waiting for the running pass
+    assert len(checks) >= 2  # The timer was armed again after each check
+    coalescer.submit("F1")  # Merged into the waiting event
+
+    busy.clear()
+    passes.wait()
+    time.sleep(DEBOUNCE * 3)
+    assert passes.files == ["F1"]
+    assert coalescer.stats()["merged"] == 1
+
+
+def test_event_times_are_passed_to_is_own_change():
+    passes = Passes()
+    windows = []
+    checked = threading.Event()
+
+    def is_own_change(file_id: str, first_event_at: float, last_event_at: float) -> bool:
+        windows.append((first_event_at, last_event_at))
+        checked.set()
+        return True
+
+    coalescer = make_coalescer(passes, is_own_change=is_own_change)
+    coalescer.submit("F1", 102.0)
+    coalescer.submit("F1", 101.0)
+    coalescer.submit("F1", 103.0)
+    assert checked.wait(TIMEOUT)
+    time.sleep(DEBOUNCE)
+    assert windows == [(101.0, 103.0)]
+    assert passes.files == []  # Dropped as the bot's own edit
+    assert coalescer.stats()["dropped"] == 1
+
+
+def test_failed_revision_check_processes_the_event():
+    passes = Passes()
+
+    def is_own_change(file_id: str, first_event_at: float, last_event_at: float) -> bool:
+        raise RuntimeError("files.info failed")
+
+    coalescer = make_coalescer(passes, is_own_change=is_own_change)
+    coalescer.submit("F1")
+    passes.wait()
+    assert passes.files == ["F1"]
+
+
+@pytest.mark.parametrize("first_event_at, last_event_at, covered", [
+    (1000, 1000, True),  # Sent in the second the revision was made
+    (1000.7, 1001, True),  # event_ts has fractions of a second
+    (1000, 1000 + BOT_EVENT_DELAY, True),  # Slack was slow to send it
+    (999, 1000, False),  # A user's edit during the pass, before the bot's
+    (1000, 1001 + BOT_EVENT_DELAY, False),
+    (0, 0, False),  # The event time is unknown
+])
+def test_bot_edit_covers_events_sent_just_after_its_revision(first_event_at, last_event_at, covered):
+    assert BotEdit(("1000", None, 42), updated=1000).covers(first_event_at, last_event_at) == covered
+
+
+def test_bot_edit_without_an_updated_time_covers_nothing():
+    assert not BotEdit(None, updated=None).covers(1000, 1000)
+
+
+def test_event_without_a_time_is_never_the_bots_own():
+    passes = Passes()
+    bot_edit = BotEdit(("1000", None, 42), updated=1000)
+    coalescer = make_coalescer(passes, is_own_change=lambda file_id, first, last: bot_edit.covers(first, last))
+    coalescer.submit("F1")
+    passes.wait()
+    assert passes.files == ["F1"]
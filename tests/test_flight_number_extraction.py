@@ -0,0 +1,23 @@
+import pytest
+
+from flight_number_extraction import could_be_ident, extract_flight_numbers, is_known_flight_number
+
+
+def test_only_flight_numbers_with_known_airline_codes_are_extracted():
+    text = "Alice lands on BA 123, Bob on EZY123 and U2-8123 in room 1204 at 1200 in 2025"
+    assert extract_flight_numbers(text) == ["BA 123", "EZY123", "U2-8123"]
+
+
+@pytest.mark.parametrize("text", ["N123AB", "G-ABCD", "JA123A", "UAL123", "UA 123", "ZZ9"])
+def test_tail_numbers_and_unknown_codes_could_be_idents(text):
+    assert could_be_ident(text)
+
+
+@pytest.mark.parametrize("text", ["", "1999", "12 34", "BA.123", "<script>"])
+def test_text_that_cannot_be_an_ident_is_ruled_out(text):
+    assert not could_be_ident(text)
+
+
+def test_tail_numbers_are_not_known_flight_numbers():
+    assert is_known_flight_number("BA123")
+    assert not is_known_flight_number("N123AB")
@@ -0,0 +1,112 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("gevent")
+
+MAX_STALL = 0.3  # Seconds a waiting stream may go without waking up
+
+# Runs in a fresh interpreter, as gevent must patch threading before anything else is imported. A stream waits on the
+# hub with a short heartbeat while the given blocking work runs in another thread, and the longest gap between its
+# wake-ups is printed.
+STREAM_SCRIPT = """
+from gevent import monkey
+monkey.patch_all()
+
+import json
+import sys
+import threading
+import time
+
+from map_events import MapEventHub
+
+hub = MapEventHub(max_clients=1)
+wake_ups = []
+stop = threading.Event()
+
+
+def stream():
+    while not stop.is_set():
+        hub.wait("F1", 0, 0.05)
+        wake_ups.append(time.monotonic())
+
+
+threading.Thread(target=stream, daemon=True).start()
+time.sleep(0.1)
+{work}
+stop.set()
+time.sleep(0.1)
+print(json.dumps({{"max_gap": max(b - a for a, b in zip(wake_ups, wake_ups[1:])), "result": result}}))
+"""
+
+
+def run_beside_stream(work: str) -> dict:
+    script = STREAM_SCRIPT.format(work=work)
+    output = subprocess.run(
+        [sys.executable, "-c", script], cwd=Path(__file__).parent.parent, capture_output=True, text=True, timeout=30
+    )
+    assert output.returncode == 0, output.stderr
+    return json.loads(output.stdout)
+
+
+def test_sqlite_waiting_for_another_connection_does_not_stall_streams(tmp_path):
+    # Another process holds the write lock for a second while passes take their leases
+    outcome = run_beside_stream(f"""
+import sqlite3
+from state_store import StateStore
+
+path = {str(tmp_path / "state.db")!r}
+store = StateStore(path)
+other_process = sqlite3.connect(path, isolation_level=None)
+other_process.execute("BEGIN IMMEDIATE")
+threading.Timer(1, lambda: other_process.execute("COMMIT")).start()
+leases = []
+passes = [
+    threading.Thread(target=lambda i=i: leases.append(store.acquire_lease(f"F{{i % 3}}", f"pass {{i}}", 60)))
+    for i in range(20)
+]
+for canvas_pass in passes:
+    canvas_pass.start()
+for canvas_pass in passes:
+    canvas_pass.join()
+result = sum(leases)
+""")
+    assert outcome["result"] == 3
+    assert outcome["max_gap"] < MAX_STALL
+
+
+def test_slow_scrapes_do_not_stall_streams():
+    # Passes scrape through the shared session, whose sockets yield to the hub while FlightAware is slow to answer
+    outcome = run_beside_stream("""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http_transport import session
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(0.5)
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = f"http://127.0.0.1:{server.server_port}/"
+bodies = []
+scrapes = [threading.Thread(target=lambda: bodies.append(session.get(url, timeout=5).text)) for _ in range(8)]
+for scrape in scrapes:
+    scrape.start()
+for scrape in scrapes:
+    scrape.join()
+result = bodies.count("ok")
+""")
+    assert outcome["result"] == 8
+    assert outcome["max_gap"] < MAX_STALL
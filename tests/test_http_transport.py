@@ -0,0 +1,27 @@
+import pytest
+
+import http_transport
+from http_transport import session, size_pool
+
+
+@pytest.fixture(autouse=True)
+def fresh_pool(monkeypatch):
+    monkeypatch.setattr(http_transport, "pool_size", 0)
+    monkeypatch.setattr(http_transport, "HTTP_POOL_SIZE", 0)
+
+
+def pool_maxsize() -> int:
+    return session.get_adapter("https://example.com")._pool_maxsize
+
+
+def test_pool_grows_to_the_declared_threads_but_never_shrinks():
+    size_pool(100)
+    assert pool_maxsize() == 100
+    size_pool(12)
+    assert pool_maxsize() == 100
+
+
+def test_fixed_pool_size_overrides_the_declared_threads(monkeypatch):
+    monkeypatch.setattr(http_transport, "HTTP_POOL_SIZE", 16)
+    size_pool(100)
+    assert pool_maxsize() == 16
@@ -0,0 +1,122 @@
+import pytest
+
+import rate_governor
+from rate_governor import GovernorOverloaded, RateGovernor
+
+
+class FakeTime:
+    """
+    Stands in for the time module in rate_governor, so delays can be checked without waiting.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeTime:
+    fake_time = FakeTime()
+    monkeypatch.setattr(rate_governor, "time", fake_time)
+    return fake_time
+
+
+def make_governor(rate: float = 10, burst: int = 2, min_rate: float = 1, max_delay: float = 5) -> RateGovernor:
+    return RateGovernor("test", rate=rate, burst=burst, min_rate=min_rate, max_delay=max_delay)
+
+
+def test_burst_is_sent_at_once_then_requests_are_spaced_at_the_rate(clock):
+    governor = make_governor(rate=10, burst=2)
+    delays = [governor.reserve() for _ in range(4)]
+    assert delays == pytest.approx([0, 0, 0.1, 0.2])
+    assert governor.stats()["queue_depth"] == 2
+
+
+def test_tokens_refill_while_idle(clock):
+    governor = make_governor(rate=10, burst=2)
+    governor.reserve()
+    governor.reserve()
+    clock.now += 1
+    assert governor.reserve() == 0
+
+
+def test_request_waiting_longer_than_max_delay_is_shed(clock):
+    governor = make_governor(rate=10, burst=1, max_delay=0.25)
+    delays = [governor.reserve() for _ in range(3)]
+    assert delays == pytest.approx([0, 0.1, 0.2])
+    with pytest.raises(GovernorOverloaded):
+        governor.reserve()
+    assert governor.stats()["shed"] == 1
+    assert governor.stats()["requests"] == 3
+
+
+def test_cancel_gives_the_turn_back(clock):
+    governor = make_governor(rate=10, burst=1)
+    governor.reserve()
+    assert governor.reserve() == pytest.approx(0.1)
+    governor.cancel()
+    assert governor.reserve() == pytest.approx(0.1)
+    assert governor.stats()["requests"] == 2
+
+
+def test_wait_sleeps_for_the_reserved_delay(clock):
+    governor = make_governor(rate=10, burst=1)
+    governor.wait()
+    governor.wait()
+    assert clock.slept == pytest.approx([0.1])
+
+
+def test_throttled_response_halves_the_rate_down_to_the_minimum(clock):
+    governor = make_governor(rate=8, min_rate=3)
+    governor.record(429)
+    assert governor.rate == 4
+    governor.record(503)
+    assert governor.rate == 3
+    assert governor.stats()["throttled"] == 2
+
+
+def test_successes_raise_the_rate_back_to_the_maximum(clock):
+    governor = make_governor(rate=10)
+    governor.record(429)
+    for _ in range(200):
+        governor.record(200)
+    assert governor.rate == 10
+    governor.record(404)  # Client errors say nothing about the host's load
+    assert governor.rate == 10
+
+
+def test_retry_after_pauses_every_request(clock):
+    governor = make_governor(rate=10, burst=5, max_delay=60)
+    governor.record(429, retry_after=30)
+    assert governor.stats()["paused_for"] == pytest.approx(30)
+    # The burst is gone too: requests resume one at a time at the lowered rate
+    assert governor.reserve() == pytest.approx(30 + 1 / 5)
+    clock.now += 31
+    assert governor.stats()["paused_for"] == 0
+
+
+def test_pause_longer_than_max_delay_sheds_requests(clock):
+    governor = make_governor(max_delay=5)
+    governor.record(503, retry_after=10)
+    assert governor.overloaded()
+    with pytest.raises(GovernorOverloaded):
+        governor.reserve()
+    clock.now += 10
+    assert not governor.overloaded()
+    assert governor.reserve() == pytest.approx(1 / 5)
+
+
+def test_overloaded_once_the_queue_is_half_of_max_delay(clock):
+    governor = make_governor(rate=10, burst=1, max_delay=1)
+    governor.reserve()
+    for _ in range(5):
+        assert not governor.overloaded()
+        governor.reserve()
+    assert governor.overloaded()
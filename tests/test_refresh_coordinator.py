@@ -0,0 +1,133 @@
+import threading
+import time
+
+import pytest
+
+from refresh_coordinator import RefreshCoordinator
+
+TIMEOUT = 5  # Seconds a test waits for a fetch before failing
+
+
+class SlowFetch:
+    """
+    Counts fetches per key. Fetches block until released, so callers pile up behind them.
+    """
+
+    def __init__(self, error: Exception = None):
+        self.error = error
+        self.fetches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, key: str) -> dict:
+        self.fetches.append(key)
+        self.started.set()
+        assert self.release.wait(TIMEOUT)
+        if self.error:
+            raise self.error
+        return {"key": key}
+
+
+def get_concurrently(coordinator: RefreshCoordinator, key: str, callers: int) -> tuple[list, list[threading.Thread]]:
+    results = []
+
+    def get():
+        try:
+            results.append(coordinator.get(key))
+        except Exception as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=get) for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    return results, threads
+
+
+def test_concurrent_gets_share_one_fetch():
+    fetch = SlowFetch()
+    coordinator = RefreshCoordinator(fetch, workers=1, max_queued=10)
+    results, threads = get_concurrently(coordinator, "UAL1", 10)
+    assert fetch.started.wait(TIMEOUT)
+    time.sleep(0.05)
+    fetch.release.set()
+    for thread in threads:
+        thread.join(TIMEOUT)
+    assert fetch.fetches == ["UAL1"]
+    assert results == [{"key": "UAL1"}] * 10
+    assert coordinator.stats() == {
+        "fetches": 1, "coalesced": 9, "refreshes": 0, "refreshes_dropped": 0, "in_flight": 0, "queued": 0
+    }
+
+
+def test_fetch_error_is_raised_in_every_caller():
+    fetch = SlowFetch(error=RuntimeError("FlightAware is down"))
+    coordinator = RefreshCoordinator(fetch, workers=1, max_queued=10)
+    results, threads = get_concurrently(coordinator, "UAL1", 3)
+    assert fetch.started.wait(TIMEOUT)
+    time.sleep(0.05)
+    fetch.release.set()
+    for thread in threads:
+        thread.join(TIMEOUT)
+    assert len(fetch.fetches) == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert coordinator.stats()["in_flight"] == 0
+
+
+def test_refresh_is_skipped_while_the_key_is_in_flight():
+    fetch = SlowFetch()
+    coordinator = RefreshCoordinator(fetch, workers=1, max_queued=10)
+    _, threads = get_concurrently(coordinator, "UAL1", 1)
+    assert fetch.started.wait(TIMEOUT)
+    coordinator.request_refresh("UAL1")
+    assert coordinator.stats()["queued"] == 0
+    fetch.release.set()
+    threads[0].join(TIMEOUT)
+
+
+def test_most_requested_refresh_runs_first():
+    fetch = SlowFetch()
+    fetch.release.set()
+    coordinator = RefreshCoordinator(fetch, workers=1, max_queued=10)
+    coordinator.request_refresh("UAL1")
+    for _ in range(3):
+        coordinator.request_refresh("UAL2")
+    coordinator.request_refresh("UAL3")
+    coordinator.request_refresh("UAL3")
+    coordinator.start()
+    deadline = time.monotonic() + TIMEOUT
+    while len(fetch.fetches) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert fetch.fetches == ["UAL2", "UAL3", "UAL1"]
+    assert coordinator.stats()["refreshes"] == 3
+
+
+def test_refreshes_beyond_the_queue_size_are_dropped():
+    coordinator = RefreshCoordinator(SlowFetch(), workers=1, max_queued=2)
+    for key in ["UAL1", "UAL2", "UAL3"]:
+        coordinator.request_refresh(key)
+    coordinator.request_refresh("UAL1")  # Already queued, so it is moved up instead
+    stats = coordinator.stats()
+    assert stats["queued"] == 2
+    assert stats["refreshes_dropped"] == 1
+
+
+def test_get_takes_over_a_queued_refresh():
+    fetch = SlowFetch()
+    fetch.release.set()
+    coordinator = RefreshCoordinator(fetch, workers=1, max_queued=10)
+    coordinator.request_refresh("UAL1")
+    assert coordinator.get("UAL1") == {"key": "UAL1"}
+    coordinator.start()
+    time.sleep(0.05)
+    assert fetch.fetches == ["UAL1"]
+    assert coordinator.stats()["refreshes"] == 0
+
+
+@pytest.mark.parametrize("callers", [1, 5])
+def test_keys_are_fetched_again_after_a_fetch_completes(callers):
+    fetch = SlowFetch()
+    fetch.release.set()
+    coordinator = RefreshCoordinator(fetch, workers=1, max_queued=10)
+    for _ in range(callers):
+        coordinator.get("UAL1")
+    assert fetch.fetches == ["UAL1"] * callers
@@ -0,0 +1,170 @@
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from json import dumps
+from logging.handlers import RotatingFileHandler
+from typing import Any, Callable, Iterator, Optional
+
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 1.0))  # Share of passes that are traced
+SLOW_PASS_THRESHOLD = float(os.environ.get("SLOW_PASS_THRESHOLD", 30))  # Seconds before a traced pass is written out
+SLOW_PASS_LOG_PATH = os.environ.get("SLOW_PASS_LOG_PATH", "slow_passes.jsonl")
+SLOW_PASS_LOG_MAX_BYTES = int(os.environ.get("SLOW_PASS_LOG_MAX_BYTES", 10 * 1024 * 1024))
+SLOW_PASS_LOG_BACKUPS = 3
+RECENT_TRACES = int(os.environ.get("RECENT_TRACES", 200))  # Traced passes kept for the debug endpoint
+
+
+class Span:
+    """
+    A timed step of a traced pass, such as loading the canvas or a request to Slack, with the steps it ran.
+    """
+    __slots__ = ("name", "attributes", "started_at", "start", "duration", "children", "error")
+
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.children: list[Span] = []  # Appended to from the threads the span's work runs on
+        self.error: Optional[str] = None
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            **({"attributes": self.attributes} if self.attributes else {}),
+            **({"error": self.error} if self.error else {}),
+            **({"children": [child.to_dict() for child in list(self.children)]} if self.children else {})
+        }
+
+
+current = threading.local()  # current.span: the span work on this thread belongs to
+
+
+def current_span() -> Optional[Span]:
+    return getattr(current, "span", None)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """
+    Records a step as a child of the current span. Outside a traced pass, nothing is recorded and None is yielded,
+    so steps can be instrumented unconditionally.
+    """
+    parent = current_span()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, attributes)
+    parent.children.append(child)
+    current.span = child
+    try:
+        yield child
+    except BaseException as e:
+        child.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        child.finish()
+        current.span = parent
+
+
+def run_in_span(parent: Optional[Span], function: Callable, *args) -> Any:
+    """
+    Runs a function on this thread as part of a span started on another thread, e.g. in a thread pool.
+    """
+    previous = current_span()
+    current.span = parent
+    try:
+        return function(*args)
+    finally:
+        current.span = previous
+
+
+class SlowPassRecorder:
+    """
+    Keeps the most recent traced passes for the debug endpoint, and writes passes slower than the threshold,
+    with their whole span tree, as JSON lines to a rotating file.
+    """
+
+    def __init__(self, threshold: float, log_path: str, max_bytes: int, backups: int, recent: int):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.recent: deque[Span] = deque(maxlen=recent)
+        self.logger = logging.getLogger("slow_passes")
+        self.logger.propagate = False  # The span trees would drown the application log
+        self.log_path = log_path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.slow_passes = 0
+
+    def open_log(self):
+        """
+        Opens the slow pass file on the first slow pass, so processes that never have one do not create it.
+        """
+        if not self.logger.handlers:
+            handler = RotatingFileHandler(self.log_path, maxBytes=self.max_bytes, backupCount=self.backups)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+
+    def record(self, root: Span):
+        with self.lock:
+            self.recent.append(root)
+            if root.duration < self.threshold:
+                return
+            self.slow_passes += 1
+            self.open_log()
+        logging.warning(f"Slow {root.name} took {root.duration:.1f}s: {root.attributes}")
+        self.logger.info(dumps(root.to_dict()))
+
+    def slowest(self, limit: int) -> list[dict]:
+        """
+        Returns the slowest of the recent traced passes, slowest first, with their span trees.
+        """
+        with self.lock:
+            recent = list(self.recent)
+        return [root.to_dict() for root in heapq.nlargest(limit, recent, key=lambda root: root.duration)]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"recent": len(self.recent), "slow_passes": self.slow_passes, "threshold": self.threshold}
+
+
+slow_pass_recorder = SlowPassRecorder(
+    SLOW_PASS_THRESHOLD, SLOW_PASS_LOG_PATH, SLOW_PASS_LOG_MAX_BYTES, SLOW_PASS_LOG_BACKUPS, RECENT_TRACES
+)
+
+
+@contextmanager
+def trace_pass(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """
+    Traces a pass on this thread if it is sampled: the steps run inside it are recorded as spans, and the finished
+    pass is handed to the slow pass recorder. Yields None if the pass is not sampled.
+    """
+    if random.random() >= TRACE_SAMPLE_RATE:
+        yield None
+        return
+    root = Span(name, attributes)
+    previous = current_span()
+    current.span = root
+    try:
+        yield root
+    except BaseException as e:
+        root.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        root.finish()
+        current.span = previous
+        slow_pass_recorder.record(root)